@@ -1,11 +1,15 @@
-import anthropic
 import os
-import openai
-import requests
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Iterator, Optional, Tuple
 import logging
 from dotenv import load_dotenv
 import re
+import threading
+from datetime import datetime
+from executors import run_blocking
+from http_client import http_client
+from llm_router import LLMRouter, XAIAdapter, AnthropicAdapter, OpenAIAdapter, XAI_CHAT_URL
+from response_cache import response_cache, make_cache_key
+from quota_service import quota_service
 
 # Load environment variables from .env file
 load_dotenv()
@@ -24,6 +28,14 @@ logger.info(f"ANTHROPIC_API_KEY present: {bool(ANTHROPIC_API_KEY)}")
 logger.info(f"OPENAI_API_KEY present: {bool(OPENAI_API_KEY)}")
 logger.info(f"XAI_API_KEY present: {bool(XAI_API_KEY)}")
 
+# Seconds to wait on a provider before giving up
+AI_REQUEST_TIMEOUT = float(os.environ.get("AI_REQUEST_TIMEOUT", "120"))
+AI_VALIDATION_TIMEOUT = float(os.environ.get("AI_VALIDATION_TIMEOUT", "10"))
+# Set to "false" to skip the background key check at startup
+AI_VALIDATE_KEYS = os.environ.get("AI_VALIDATE_KEYS", "true").lower() == "true"
+
+DEFAULT_SYSTEM_PROMPT = "You are an expert newsletter writer and designer. Help the user create engaging, professional newsletters. When asked to generate newsletter content, provide well-structured HTML that can be directly used in an email campaign. Focus on creating content that is visually appealing, mobile-responsive, and follows email marketing best practices."
+
 class AIService:
     def __init__(self, anthropic_api_key: Optional[str] = None, openai_api_key: Optional[str] = None, xai_api_key: Optional[str] = None):
         """Initialize the AI service with API keys for Anthropic, OpenAI, and X.AI."""
@@ -36,79 +48,22 @@ class AIService:
         logger.info(f"AIService init - OpenAI API key present: {bool(self.openai_api_key)}")
         logger.info(f"AIService init - X.AI API key present: {bool(self.xai_api_key)}")
         
-        # Initialize clients based on available API keys
-        self.anthropic_client = None
-        self.openai_client = None
-        self.preferred_provider = None
+        # Provider clients are created lazily on first use
+        self._anthropic_client = None
+        self._openai_client = None
+        self._client_lock = threading.Lock()
         
-        # Validate API keys by making a small test request
-        if self.xai_api_key:
-            try:
-                # Test with a minimal request to validate the X.AI API key
-                headers = {
-                    "Content-Type": "application/json",
-                    "Authorization": f"Bearer {self.xai_api_key}"
-                }
-                data = {
-                    "messages": [{"role": "user", "content": "Hello"}],
-                    "model": "grok-2-latest",
-                    "stream": False,
-                    "temperature": 0
-                }
-                response = requests.post(
-                    "https://api.x.ai/v1/chat/completions",
-                    headers=headers,
-                    json=data
-                )
-                if response.status_code == 200:
-                    self.preferred_provider = "xai"
-                    logger.info("X.AI API key validated successfully")
-                else:
-                    logger.error(f"X.AI API key validation failed: {response.text}")
-            except Exception as e:
-                logger.error(f"Failed to initialize X.AI API: {str(e)}")
-
-        if not self.preferred_provider and self.anthropic_api_key:
-            try:
-                self.anthropic_client = anthropic.Anthropic(api_key=self.anthropic_api_key)
-                # Test with a minimal request to validate the API key
-                try:
-                    self.anthropic_client.messages.create(
-                        model="claude-3-haiku-20240307",
-                        max_tokens=10,
-                        messages=[
-                            {"role": "user", "content": "Hello"}
-                        ]
-                    )
-                    self.preferred_provider = "anthropic"
-                    logger.info("Anthropic API key validated successfully")
-                except Exception as e:
-                    logger.error(f"Anthropic API key validation failed: {str(e)}")
-                    self.anthropic_client = None
-            except Exception as e:
-                logger.error(f"Failed to initialize Anthropic API: {str(e)}")
-                self.anthropic_client = None
+        # Result of the last key check per provider: None until it has run
+        self.providers = {
+            name: {"configured": bool(key), "ready": None, "error": None, "checked_at": None}
+            for name, key in (("xai", self.xai_api_key),
+                              ("anthropic", self.anthropic_api_key),
+                              ("openai", self.openai_api_key))
+        }
+        self._validation_thread = None
         
-        if not self.preferred_provider and self.openai_api_key:
-            try:
-                self.openai_client = openai.OpenAI(api_key=self.openai_api_key)
-                # Test with a minimal request to validate the API key
-                try:
-                    self.openai_client.chat.completions.create(
-                        model="gpt-3.5-turbo",
-                        max_tokens=10,
-                        messages=[
-                            {"role": "user", "content": "Hello"}
-                        ]
-                    )
-                    self.preferred_provider = "openai"
-                    logger.info("OpenAI API key validated successfully")
-                except Exception as e:
-                    logger.error(f"OpenAI API key validation failed: {str(e)}")
-                    self.openai_client = None
-            except Exception as e:
-                logger.error(f"Failed to initialize OpenAI API: {str(e)}")
-                self.openai_client = None
+        # Provider order follows self.providers; failures trip per-provider circuits
+        self.router = LLMRouter([XAIAdapter(self), AnthropicAdapter(self), OpenAIAdapter(self)])
         
         if not self.preferred_provider:
             logger.warning("No valid API keys provided. AI features will be simulated.")
@@ -121,15 +76,197 @@ class AIService:
         self.xai_model = "grok-2-latest"
         self.max_tokens = 4000
         self.temperature = 0.7
+    
+    @property
+    def preferred_provider(self) -> Optional[str]:
+        """The first configured provider whose circuit is not open.
         
-        # Track usage for quota management
-        self.chat_count = 0
-        self.max_chat_count = 10  # Default limit
+        When every circuit is open the first configured provider is still
+        preferred, so requests wait for a breaker trial instead of being
+        simulated.
+        """
+        configured = [name for name, status in self.providers.items() if status["configured"]]
+        return next(
+            (name for name in configured if self.router.breakers[name].state != "open"),
+            configured[0] if configured else None
+        )
+    
+    @property
+    def anthropic_client(self):
+        """The Anthropic client, created on first use"""
+        if self._anthropic_client is None and self.anthropic_api_key:
+            with self._client_lock:
+                if self._anthropic_client is None:
+                    try:
+                        # Imported here so the SDK does not slow down process startup
+                        import anthropic
+                        self._anthropic_client = anthropic.Anthropic(
+                            api_key=self.anthropic_api_key, timeout=AI_REQUEST_TIMEOUT
+                        )
+                    except Exception as e:
+                        logger.error(f"Failed to initialize Anthropic API: {str(e)}")
+                        self._mark_provider("anthropic", False, str(e))
+        return self._anthropic_client
+    
+    @property
+    def openai_client(self):
+        """The OpenAI client, created on first use"""
+        if self._openai_client is None and self.openai_api_key:
+            with self._client_lock:
+                if self._openai_client is None:
+                    try:
+                        import openai
+                        self._openai_client = openai.OpenAI(
+                            api_key=self.openai_api_key, timeout=AI_REQUEST_TIMEOUT
+                        )
+                    except Exception as e:
+                        logger.error(f"Failed to initialize OpenAI API: {str(e)}")
+                        self._mark_provider("openai", False, str(e))
+        return self._openai_client
+    
+    def _mark_provider(self, name: str, ready: bool, error: Optional[str] = None):
+        """Record a provider check on its status and circuit.
+        
+        A failed check opens the circuit rather than disabling the provider,
+        so a transient failure (e.g. a timeout during cold start) is retried
+        by the breaker's half-open trial once the reset timeout has passed.
+        """
+        self.providers[name].update(ready=ready, error=error, checked_at=datetime.utcnow())
+        breaker = self.router.breakers[name]
+        if ready:
+            breaker.record_success()
+        else:
+            breaker.trip()
+    
+    def _validate_provider(self, name: str):
+        """Make a minimal request to check that a provider's key works"""
+        if name == "xai":
+            response = http_client.post(
+                XAI_CHAT_URL,
+                headers={
+                    "Content-Type": "application/json",
+                    "Authorization": f"Bearer {self.xai_api_key}"
+                },
+                json={
+                    "messages": [{"role": "user", "content": "Hello"}],
+                    "model": "grok-2-latest",
+                    "stream": False,
+                    "temperature": 0
+                },
+                timeout=AI_VALIDATION_TIMEOUT
+            )
+            if response.status_code != 200:
+                raise Exception(response.text)
+        elif name == "anthropic":
+            client = self.anthropic_client
+            if client is None:
+                raise Exception(self.providers["anthropic"]["error"] or "Client unavailable")
+            client.with_options(timeout=AI_VALIDATION_TIMEOUT).messages.create(
+                model="claude-3-haiku-20240307",
+                max_tokens=10,
+                messages=[{"role": "user", "content": "Hello"}]
+            )
+        elif name == "openai":
+            client = self.openai_client
+            if client is None:
+                raise Exception(self.providers["openai"]["error"] or "Client unavailable")
+            client.with_options(timeout=AI_VALIDATION_TIMEOUT).chat.completions.create(
+                model="gpt-3.5-turbo",
+                max_tokens=10,
+                messages=[{"role": "user", "content": "Hello"}]
+            )
+    
+    def validate_providers(self):
+        """Check every configured provider and update readiness"""
+        for name, status in self.providers.items():
+            if not status["configured"]:
+                continue
+            try:
+                self._validate_provider(name)
+                self._mark_provider(name, True)
+                logger.info(f"{name} API key validated successfully")
+            except Exception as e:
+                self._mark_provider(name, False, str(e))
+                logger.error(f"{name} API key validation failed: {str(e)}")
         
+        if not self.preferred_provider:
+            logger.warning("No valid API keys provided. AI features will be simulated.")
+        else:
+            logger.info(f"Using {self.preferred_provider} as the preferred AI provider")
+    
+    def start_validation(self):
+        """Validate provider keys on a background thread so startup never waits on them"""
+        if not AI_VALIDATE_KEYS or (self._validation_thread and self._validation_thread.is_alive()):
+            return
+        self._validation_thread = threading.Thread(
+            target=self.validate_providers, name="ai-provider-validation", daemon=True
+        )
+        self._validation_thread.start()
+    
+    def provider_status(self) -> Dict[str, Any]:
+        """Readiness of each provider for health checks"""
+        return {
+            "preferred_provider": self.preferred_provider,
+            "providers": {name: dict(status) for name, status in self.providers.items()},
+            "routing": self.router.status()
+        }
+    
     def generate_response(self, 
                           prompt: str, 
                           context: Optional[List[Dict[str, str]]] = None,
-                          system_prompt: Optional[str] = None) -> Dict[str, Any]:
+                          system_prompt: Optional[str] = None,
+                          cache: bool = False,
+                          client_id: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Generate a response from the AI model, serving repeats from the response cache.
+        
+        Deterministic requests are always cached. Pass ``cache=True`` to also
+        cache sampled ones (temperature > 0), e.g. for "regenerate" flows
+        that re-send identical inputs. Cache hits do not use chat quota.
+        Calls without a ``client_id`` are internal and not metered.
+        """
+        if not self.preferred_provider or not response_cache.should_cache(self.temperature, opt_in=cache):
+            return self._generate_response(prompt, context, system_prompt, client_id)
+        
+        messages = list(context or []) + [{"role": "user", "content": prompt}]
+        key = make_cache_key(
+            self._model_for(self.preferred_provider),
+            system_prompt or DEFAULT_SYSTEM_PROMPT,
+            messages,
+            self.temperature
+        )
+        cached = response_cache.get(key)
+        if cached is not None:
+            return {**cached, "remaining_chats": self._remaining_chats(client_id), "cached": True}
+        
+        response = self._generate_response(prompt, context, system_prompt, client_id)
+        # The key names the preferred provider's model; a fallback's answer would be cached under it
+        if response.get("success") and response.get("provider") == self.preferred_provider:
+            response_cache.set(key, {
+                "success": True,
+                "message": response["message"],
+                "provider": response["provider"],
+                "usage": response.get("usage", {})
+            })
+        return response
+    
+    def _model_for(self, provider: str) -> str:
+        return {"xai": self.xai_model, "anthropic": self.anthropic_model, "openai": self.openai_model}[provider]
+    
+    def _remaining_chats(self, client_id: Optional[str]) -> Optional[int]:
+        return quota_service.remaining(client_id, 'chat') if client_id else None
+    
+    def _take_chat(self, client_id: Optional[str]) -> Tuple[bool, Optional[int]]:
+        """Use one chat from the client's quota; returns (allowed, remaining)"""
+        if not client_id:
+            return True, None
+        return quota_service.consume(client_id, 'chat')
+    
+    def _generate_response(self, 
+                           prompt: str, 
+                           context: Optional[List[Dict[str, str]]] = None,
+                           system_prompt: Optional[str] = None,
+                           client_id: Optional[str] = None) -> Dict[str, Any]:
         """
         Generate a response from the AI model.
         
@@ -137,22 +274,21 @@ class AIService:
             prompt: The user's input prompt
             context: Optional list of previous messages for context
             system_prompt: Optional system prompt to guide the AI
+            client_id: Quota key of the caller; None for internal calls
             
         Returns:
             Dictionary containing the AI response and metadata
         """
         try:
-            # Check if user has exceeded chat quota
-            if self.chat_count >= self.max_chat_count:
+            # Check and use the caller's chat quota in one step
+            allowed, remaining_chats = self._take_chat(client_id)
+            if not allowed:
                 return {
                     "success": False,
                     "error": "Chat quota exceeded",
                     "message": "You've reached your chat limit. Please join our waitlist for continued access."
                 }
             
-            # Increment chat count
-            self.chat_count += 1
-            
             # Log the current state
             logger.info(f"Generating response with provider: {self.preferred_provider}")
             
@@ -161,161 +297,20 @@ class AIService:
                 return {
                     "success": True,
                     "message": f"I would help you create a newsletter about '{prompt}', but I'm currently in demo mode without an API key. Please add your API key to use the full AI features.",
-                    "remaining_chats": self.max_chat_count - self.chat_count
+                    "remaining_chats": remaining_chats
                 }
             
-            # Default system prompt for newsletter generation if none provided
-            default_system_prompt = "You are an expert newsletter writer and designer. Help the user create engaging, professional newsletters. When asked to generate newsletter content, provide well-structured HTML that can be directly used in an email campaign. Focus on creating content that is visually appealing, mobile-responsive, and follows email marketing best practices."
-            
-            # Try X.AI first if it's the preferred provider
-            if self.preferred_provider == "xai":
-                try:
-                    # Prepare messages for X.AI
-                    messages = []
-                    
-                    # Add system prompt
-                    if system_prompt or default_system_prompt:
-                        messages.append({
-                            "role": "system",
-                            "content": system_prompt or default_system_prompt
-                        })
-                    
-                    # Add conversation context if provided
-                    if context:
-                        messages.extend(context)
-                    
-                    # Add the current user prompt
-                    messages.append({"role": "user", "content": prompt})
-                    
-                    # Call the X.AI API
-                    headers = {
-                        "Content-Type": "application/json",
-                        "Authorization": f"Bearer {self.xai_api_key}"
-                    }
-                    data = {
-                        "messages": messages,
-                        "model": self.xai_model,
-                        "stream": False,
-                        "temperature": self.temperature
-                    }
-                    response = requests.post(
-                        "https://api.x.ai/v1/chat/completions",
-                        headers=headers,
-                        json=data
-                    )
-                    response_data = response.json()
-                    
-                    return {
-                        "success": True,
-                        "message": response_data["choices"][0]["message"]["content"],
-                        "remaining_chats": self.max_chat_count - self.chat_count,
-                        "provider": "xai",
-                        "usage": response_data.get("usage", {})
-                    }
-                except Exception as e:
-                    logger.error(f"X.AI API error: {str(e)}")
-                    # If X.AI fails and another provider is available, fall back
-                    if self.anthropic_client:
-                        logger.info("Falling back to Anthropic API")
-                        self.preferred_provider = "anthropic"
-                    elif self.openai_client:
-                        logger.info("Falling back to OpenAI API")
-                        self.preferred_provider = "openai"
-                    else:
-                        raise e
-
-            # Try Anthropic if it's preferred or if X.AI failed
-            if self.preferred_provider == "anthropic" and self.anthropic_client:
-                try:
-                    # Prepare messages for Anthropic
-                    messages = []
-                    
-                    # Add system prompt
-                    messages.append({
-                        "role": "system", 
-                        "content": system_prompt or default_system_prompt
-                    })
-                    
-                    # Add conversation context if provided
-                    if context:
-                        messages.extend(context)
-                        
-                    # Add the current user prompt
-                    messages.append({"role": "user", "content": prompt})
-                    
-                    # Call the Anthropic API
-                    response = self.anthropic_client.messages.create(
-                        model=self.anthropic_model,
-                        messages=messages,
-                        max_tokens=self.max_tokens,
-                        temperature=self.temperature
-                    )
-                    
-                    # Extract and return the response
-                    return {
-                        "success": True,
-                        "message": response.content[0].text,
-                        "remaining_chats": self.max_chat_count - self.chat_count,
-                        "provider": "anthropic",
-                        "usage": {
-                            "input_tokens": response.usage.input_tokens,
-                            "output_tokens": response.usage.output_tokens
-                        }
-                    }
-                except Exception as e:
-                    logger.error(f"Anthropic API error: {str(e)}")
-                    # If Anthropic fails and OpenAI is available, fall back to OpenAI
-                    if self.openai_client:
-                        logger.info("Falling back to OpenAI API")
-                        self.preferred_provider = "openai"
-                    else:
-                        raise e
+            # The router tries providers in order, skipping any with an open circuit
+            messages = list(context or []) + [{"role": "user", "content": prompt}]
+            result = self.router.complete(messages, system_prompt or DEFAULT_SYSTEM_PROMPT)
             
-            # Use OpenAI if it's preferred or if Anthropic failed
-            if self.preferred_provider == "openai" and self.openai_client:
-                # Prepare messages for OpenAI
-                messages = []
-                
-                # Add system prompt
-                messages.append({
-                    "role": "system", 
-                    "content": system_prompt or default_system_prompt
-                })
-                
-                # Add conversation context if provided
-                if context:
-                    for msg in context:
-                        messages.append({
-                            "role": msg["role"],
-                            "content": msg["content"]
-                        })
-                
-                # Add the current user prompt
-                messages.append({"role": "user", "content": prompt})
-                
-                # Call the OpenAI API
-                response = self.openai_client.chat.completions.create(
-                    model=self.openai_model,
-                    messages=messages,
-                    max_tokens=self.max_tokens,
-                    temperature=self.temperature
-                )
-                
-                # Extract and return the response
-                return {
-                    "success": True,
-                    "message": response.choices[0].message.content,
-                    "remaining_chats": self.max_chat_count - self.chat_count,
-                    "provider": "openai",
-                    "usage": {
-                        "total_tokens": response.usage.total_tokens,
-                        "completion_tokens": response.usage.completion_tokens,
-                        "prompt_tokens": response.usage.prompt_tokens
-                    }
-                }
-            
-            # If we get here, both APIs failed
-            raise Exception("All AI providers failed to generate a response")
+            return {
+                "success": True,
+                "message": result["message"],
+                "remaining_chats": remaining_chats,
+                "provider": result["provider"],
+                "usage": result.get("usage", {})
+            }
             
         except Exception as e:
             logger.error(f"Error generating AI response: {str(e)}")
@@ -325,7 +320,59 @@ class AIService:
                 "message": f"An error occurred while generating the AI response: {str(e)}. Please check your API keys in the .env file or try again later."
             }
     
-    def generate_newsletter_html(self, content: str, style_preferences: Optional[str] = None, email_type: str = "professional") -> str:
+    async def agenerate_response(self,
+                                 prompt: str,
+                                 context: Optional[List[Dict[str, str]]] = None,
+                                 system_prompt: Optional[str] = None,
+                                 client_id: Optional[str] = None) -> Dict[str, Any]:
+        """Async wrapper around generate_response that runs it on the LLM executor."""
+        return await run_blocking(
+            self.generate_response,
+            pool='llm',
+            prompt=prompt,
+            context=context,
+            system_prompt=system_prompt,
+            client_id=client_id
+        )
+    
+    def stream_response(self,
+                        prompt: str,
+                        context: Optional[List[Dict[str, str]]] = None,
+                        system_prompt: Optional[str] = None,
+                        client_id: Optional[str] = None) -> Iterator[Dict[str, Any]]:
+        """
+        Stream a response from the AI model as it is generated.
+        
+        Yields ``{"type": "token", "content": ...}`` events as text arrives and
+        finishes with a ``{"type": "done", ...}`` event carrying the full
+        message, provider and usage, or a ``{"type": "error", ...}`` event.
+        The router falls back to the next provider only if nothing was
+        streamed yet.
+        """
+        allowed, remaining_chats = self._take_chat(client_id)
+        if not allowed:
+            yield {
+                "type": "error",
+                "error": "Chat quota exceeded",
+                "message": "You've reached your chat limit. Please join our waitlist for continued access."
+            }
+            return
+        
+        if not self.preferred_provider:
+            message = f"I would help you create a newsletter about '{prompt}', but I'm currently in demo mode without an API key. Please add your API key to use the full AI features."
+            yield {"type": "token", "content": message}
+            yield {"type": "done", "message": message, "remaining_chats": remaining_chats}
+            return
+        
+        messages = list(context or []) + [{"role": "user", "content": prompt}]
+        for event in self.router.stream(messages, system_prompt or DEFAULT_SYSTEM_PROMPT):
+            if event["type"] == "done":
+                event = {**event, "remaining_chats": remaining_chats}
+                event.pop("model", None)
+            yield event
+    
+    def generate_newsletter_html(self, content: str, style_preferences: Optional[str] = None, email_type: str = "professional",
+                                 client_id: Optional[str] = None) -> str:
         # Construct the prompt based on email type
         prompt = f"""Task: Generate an HTML email template for a {email_type}.
 
@@ -348,7 +395,8 @@ Technical requirements:
         prompt += "\nPlease output the HTML template:"
 
         # Generate the HTML content
-        response = self.generate_response(prompt)
+        # Identical newsletter requests are served from the cache
+        response = self.generate_response(prompt, cache=True, client_id=client_id)
         
         # Clean up the response
         html_content = self._extract_html_from_response(response)
@@ -410,14 +458,6 @@ Technical requirements:
             return html_content
         else:
             return None
-    
-    def reset_chat_count(self):
-        """Reset the chat count for the user."""
-        self.chat_count = 0
-        
-    def set_max_chat_count(self, count: int):
-        """Set the maximum number of chats allowed."""
-        self.max_chat_count = count
 
 # Create a singleton instance
 ai_service = AIService() 
\ No newline at end of file
@@ -0,0 +1,175 @@
+"""Concurrent chat load: the app's session endpoints vs. sync sessions on the loop.
+
+Drives the local chat service with concurrent ``/ai/chat`` turns and history
+reads against a scratch database, with Ollama stubbed by a short sleep. It
+runs the load twice. The first run uses the app's dependency-injected
+sessions and its chat write buffer; set ``DB_ASYNC_SESSIONS=true`` to
+measure aiosqlite sessions instead of the default blocking ones. The
+second uses the old pattern: a sync ``sessionmaker`` session inside the
+``async def`` handlers, committing each message on the request path.
+``/health`` is polled during the load to show how long the loop stalls.
+
+Run from the backend directory:
+
+    python -m benchmarks.bench_async_db --requests 200 --concurrency 32
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import tempfile
+import time
+from datetime import datetime
+
+_DB_DIR = tempfile.mkdtemp(prefix="bench-async-db-")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_DB_DIR, 'bench.db')}"
+
+import httpx  # noqa: E402
+from fastapi import FastAPI  # noqa: E402
+
+import local_ai_service  # noqa: E402
+from chat_context import build_context  # noqa: E402
+from models import ChatMessage, ChatSession  # noqa: E402
+
+
+class _StubResponse:
+    status_code = 200
+
+    def json(self):
+        return {"message": {"content": "Sure, here is a friendlier subject line."}}
+
+
+def _stub_ollama(latency: float):
+    def post(*args, **kwargs):
+        time.sleep(latency)
+        return _StubResponse()
+    return post
+
+
+def sync_app() -> FastAPI:
+    """The same two endpoints written the old way, with sync sessions inside async handlers"""
+    app = FastAPI()
+
+    @app.get("/health")
+    async def health():
+        return {"status": "ok"}
+
+    @app.get("/chat-sessions/{session_id}/messages")
+    async def get_chat_messages(session_id: int):
+        db = local_ai_service.SessionLocal()
+        try:
+            messages = (
+                db.query(ChatMessage)
+                .filter(ChatMessage.session_id == session_id)
+                .order_by(ChatMessage.timestamp.desc())
+                .limit(100)
+                .all()
+            )
+            return [{"role": m.role, "content": m.content, "timestamp": m.timestamp} for m in messages]
+        finally:
+            db.close()
+
+    @app.post("/ai/chat")
+    async def chat(request: local_ai_service.ChatRequest):
+        db = local_ai_service.SessionLocal()
+        try:
+            messages = build_context(db, request.session_id, local_ai_service.DEFAULT_SYSTEM_PROMPT,
+                                     prompt=request.prompt)
+            db.add(ChatMessage(session_id=request.session_id, role="user", content=request.prompt,
+                               timestamp=datetime.now()))
+            db.commit()
+            response = await local_ai_service.run_blocking(
+                local_ai_service.http_client.post, local_ai_service.OLLAMA_API, pool='llm',
+                json={"model": "mistral", "messages": messages, "stream": False}
+            )
+            text = response.json()["message"]["content"]
+            db.add(ChatMessage(session_id=request.session_id, role="assistant", content=text,
+                               timestamp=datetime.now()))
+            db.commit()
+            return {"content": text, "session_id": request.session_id}
+        finally:
+            db.close()
+
+    return app
+
+
+def seed(sessions: int, messages: int) -> list:
+    db = local_ai_service.SessionLocal()
+    try:
+        rows = [ChatSession(name=f"bench {i}") for i in range(sessions)]
+        db.add_all(rows)
+        db.commit()
+        db.bulk_insert_mappings(ChatMessage, [
+            {"session_id": s.id, "role": "user" if i % 2 == 0 else "assistant",
+             "content": f"message {i} " * 20, "timestamp": datetime.now()}
+            for s in rows for i in range(messages)
+        ])
+        db.commit()
+        return [s.id for s in rows]
+    finally:
+        db.close()
+
+
+async def drive(app: FastAPI, session_ids: list, count: int, concurrency: int) -> dict:
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    health = []
+    done = asyncio.Event()
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=60) as client:
+        async def one(i: int):
+            session_id = session_ids[i % len(session_ids)]
+            async with semaphore:
+                start = time.perf_counter()
+                if i % 2:
+                    response = await client.get(f"/chat-sessions/{session_id}/messages")
+                else:
+                    response = await client.post("/ai/chat", json={"prompt": f"turn {i}", "session_id": session_id})
+                assert response.status_code == 200, response.text
+                latencies.append(time.perf_counter() - start)
+
+        async def probe():
+            while not done.is_set():
+                start = time.perf_counter()
+                await client.get("/health")
+                health.append(time.perf_counter() - start)
+                await asyncio.sleep(0.01)
+
+        prober = asyncio.create_task(probe())
+        start = time.perf_counter()
+        await asyncio.gather(*[one(i) for i in range(count)])
+        elapsed = time.perf_counter() - start
+        done.set()
+        await prober
+
+    latencies.sort()
+    health.sort()
+    return {
+        "throughput_rps": round(count / elapsed, 1),
+        "p50_ms": round(statistics.median(latencies) * 1000, 1),
+        "p95_ms": round(latencies[int(0.95 * (len(latencies) - 1))] * 1000, 1),
+        "health_p95_ms": round(health[int(0.95 * (len(health) - 1))] * 1000, 1) if health else None,
+    }
+
+
+async def run(count: int, concurrency: int, latency: float) -> dict:
+    local_ai_service.http_client.post = _stub_ollama(latency)
+    session_ids = seed(sessions=20, messages=200)
+    return {
+        "requests": count,
+        "concurrency": concurrency,
+        "llm_latency_s": latency,
+        "app_sessions": await drive(local_ai_service.app, session_ids, count, concurrency),
+        "sync_sessions_on_loop": await drive(sync_app(), session_ids, count, concurrency),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--latency", type=float, default=0.05)
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(run(args.requests, args.concurrency, args.latency)), indent=2))
@@ -0,0 +1,126 @@
+"""Chat turn latency against a session with a long history.
+
+Fills a scratch SQLite database with one session of ``--messages`` messages.
+It then times the database side of a local chat turn (build the model
+context and store the user message) two ways: loading the full history, as
+turns used to, and with ``chat_context.build_context``. The context builder
+is timed with and without the (session_id, timestamp) index.
+
+Run from the backend directory:
+
+    python -m benchmarks.bench_chat_history --messages 10000 --turns 50
+"""
+import argparse
+import json
+import os
+import statistics
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+_DB_DIR = tempfile.mkdtemp(prefix="bench-chat-")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_DB_DIR, 'bench.db')}"
+
+from sqlalchemy import text  # noqa: E402
+from sqlalchemy.orm import sessionmaker  # noqa: E402
+
+from chat_context import build_context  # noqa: E402
+from models import ChatMessage, ChatSession, engine  # noqa: E402
+
+SessionLocal = sessionmaker(bind=engine)
+SYSTEM_PROMPT = "You are Boon, an AI email styling expert. " * 40
+
+
+def seed(count: int) -> int:
+    db = SessionLocal()
+    try:
+        session = ChatSession(name="bench")
+        db.add(session)
+        db.commit()
+        start = datetime(2024, 1, 1)
+        db.bulk_insert_mappings(ChatMessage, [
+            {
+                "session_id": session.id,
+                "role": "user" if i % 2 == 0 else "assistant",
+                "content": f"Message {i}: please tweak the header colour and spacing. " * 4,
+                "timestamp": start + timedelta(seconds=i),
+            }
+            for i in range(count)
+        ])
+        # A second session so the index has something to skip over
+        other = ChatSession(name="other")
+        db.add(other)
+        db.commit()
+        db.bulk_insert_mappings(ChatMessage, [
+            {"session_id": other.id, "role": "user", "content": "noise", "timestamp": start + timedelta(seconds=i)}
+            for i in range(count)
+        ])
+        db.commit()
+        return session.id
+    finally:
+        db.close()
+
+
+def full_history_turn(db, session_id: int, prompt: str) -> int:
+    history = (
+        db.query(ChatMessage)
+        .filter(ChatMessage.session_id == session_id)
+        .order_by(ChatMessage.timestamp)
+        .all()
+    )
+    messages = [{"role": "system", "content": SYSTEM_PROMPT}]
+    messages.extend({"role": m.role, "content": m.content} for m in history)
+    messages.append({"role": "user", "content": prompt})
+    return len(messages)
+
+
+def budgeted_turn(db, session_id: int, prompt: str) -> int:
+    return len(build_context(db, session_id, SYSTEM_PROMPT, prompt=prompt))
+
+
+def measure(turn, session_id: int, turns: int) -> dict:
+    samples = []
+    context_size = 0
+    for i in range(turns):
+        db = SessionLocal()
+        try:
+            start = time.perf_counter()
+            context_size = turn(db, session_id, f"turn {i}")
+            db.add(ChatMessage(session_id=session_id, role="user", content=f"turn {i}", timestamp=datetime.now()))
+            db.commit()
+            samples.append(time.perf_counter() - start)
+        finally:
+            db.close()
+    samples.sort()
+    return {
+        "p50_ms": round(statistics.median(samples) * 1000, 2),
+        "p95_ms": round(samples[int(0.95 * (len(samples) - 1))] * 1000, 2),
+        "context_messages": context_size,
+    }
+
+
+def run(messages: int, turns: int) -> dict:
+    session_id = seed(messages)
+    with engine.connect() as connection:
+        journal_mode = connection.execute(text("PRAGMA journal_mode")).scalar()
+
+    results = {
+        "messages": messages,
+        "turns": turns,
+        "journal_mode": journal_mode,
+        "full_history": measure(full_history_turn, session_id, turns),
+        "budgeted_context": measure(budgeted_turn, session_id, turns),
+    }
+
+    with engine.begin() as connection:
+        connection.execute(text("DROP INDEX ix_chat_messages_session_timestamp"))
+    results["budgeted_context_without_index"] = measure(budgeted_turn, session_id, turns)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=10000)
+    parser.add_argument("--turns", type=int, default=50)
+    args = parser.parse_args()
+    print(json.dumps(run(args.messages, args.turns), indent=2))
@@ -0,0 +1,82 @@
+"""Micro-benchmark: campaign message skeleton vs. a fresh MIME tree per recipient.
+
+Builds each message the way ``send_email`` used to, with
+``MIMEMultipart`` + ``MIMEText`` + ``as_string()``, and with
+``message_builder.CampaignMessageBuilder``. Checks that both produce the
+same bytes once the random values are pinned.
+
+Run from the backend directory:
+
+    python -m benchmarks.bench_mime --recipients 5000
+"""
+import argparse
+import json
+import time
+from datetime import datetime
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.utils import formataddr
+
+import message_builder
+from benchmarks.bench_templates import build_template
+
+SMTP_CONFIG = {"name": "Zirodelta Research", "email": "news@example.com"}
+
+
+def build_mime_tree(builder, recipient: dict, html: str, message_id: str, ref_id: str) -> str:
+    domain = SMTP_CONFIG['email'].split('@')[1]
+    msg = MIMEMultipart('alternative')
+    msg['Subject'] = 'Newsletter'
+    msg['From'] = formataddr((SMTP_CONFIG['name'], SMTP_CONFIG['email']))
+    msg['To'] = formataddr((recipient['name'], recipient['email']))
+    msg['Date'] = builder._date[len('Date: '):-1]
+    msg['Message-ID'] = message_id
+    msg['Authentication-Results'] = f"spf=pass smtp.mailfrom={SMTP_CONFIG['email']}"
+    msg['List-Unsubscribe'] = f'<https://research.zirodelta.com/unsubscribe?email={recipient["email"]}>'
+    msg['List-ID'] = f'Zirodelta Research <newsletter.{domain}>'
+    msg['Precedence'] = 'bulk'
+    msg['X-Entity-Ref-ID'] = ref_id
+    msg['X-Campaign-ID'] = f'bench-{datetime.now().strftime("%Y%m")}'
+    msg['X-Message-Category'] = 'education'
+    msg.attach(MIMEText(html, 'html', 'utf-8'))
+    msg.set_boundary(builder.boundary)
+    return msg.as_string()
+
+
+def run(count: int, size: int) -> dict:
+    html = build_template(size)
+    recipients = [{"name": f"Reader {i}", "email": f"reader{i}@example.com"} for i in range(count)]
+    builder = message_builder.CampaignMessageBuilder(SMTP_CONFIG, 'bench')
+
+    # Pin the random per-message values so the outputs can be compared
+    message_builder.make_msgid = lambda domain: f'<bench@{domain}>'
+    message_builder.uuid.uuid4 = lambda: 'bench-ref'
+    for recipient in recipients[:50]:
+        expected = build_mime_tree(builder, recipient, html, '<bench@example.com>', 'bench-ref')
+        assert builder.build(recipient, html) == expected
+
+    start = time.perf_counter()
+    for recipient in recipients:
+        build_mime_tree(builder, recipient, html, '<bench@example.com>', 'bench-ref')
+    mime_tree = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for recipient in recipients:
+        builder.build(recipient, html)
+    skeleton = time.perf_counter() - start
+
+    return {
+        "recipients": count,
+        "template_bytes": len(html),
+        "mime_tree_us_per_message": round(mime_tree / count * 1e6, 2),
+        "skeleton_us_per_message": round(skeleton / count * 1e6, 2),
+        "speedup": round(mime_tree / skeleton, 2),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--recipients", type=int, default=5000)
+    parser.add_argument("--size", type=int, default=30000)
+    args = parser.parse_args()
+    print(json.dumps(run(args.recipients, args.size), indent=2))
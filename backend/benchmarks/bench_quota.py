@@ -0,0 +1,75 @@
+"""Micro-benchmark: per-request cost of a quota check.
+
+Calls ``QuotaService.consume`` for many distinct clients from several
+threads against a scratch database while the background flush runs, then
+reports the latency per call and the time taken by one flush of every bucket.
+
+Run from the backend directory:
+
+    python -m benchmarks.bench_quota --clients 10000 --calls 200000 --threads 4
+"""
+import argparse
+import json
+import os
+import statistics
+import tempfile
+import threading
+import time
+
+_DB_DIR = tempfile.mkdtemp(prefix="bench-quota-")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_DB_DIR, 'bench.db')}"
+
+from quota_service import QuotaService  # noqa: E402
+
+
+def run(clients: int, calls: int, threads: int) -> dict:
+    service = QuotaService(limits={"chat": (1_000_000, 86400)}, flush_interval=0.5)
+    service.start()
+    per_thread = calls // threads
+    samples = []
+
+    def worker(offset: int):
+        local = []
+        for i in range(per_thread):
+            client = f"ip:10.0.{(offset + i) % clients}"
+            start = time.perf_counter()
+            service.consume(client, "chat")
+            local.append(time.perf_counter() - start)
+        samples.extend(local)
+
+    start = time.perf_counter()
+    pool = [threading.Thread(target=worker, args=(t * 7919,)) for t in range(threads)]
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    service.stop()
+    # Time one flush that touches every bucket
+    for i in range(clients):
+        service.consume(f"ip:10.0.{i}", "chat")
+    flush_start = time.perf_counter()
+    written = service.flush()
+    flush_s = time.perf_counter() - flush_start
+
+    samples.sort()
+    return {
+        "clients": clients,
+        "calls": per_thread * threads,
+        "threads": threads,
+        "calls_per_s": round(per_thread * threads / elapsed),
+        "p50_us": round(statistics.median(samples) * 1e6, 2),
+        "p99_us": round(samples[int(0.99 * (len(samples) - 1))] * 1e6, 2),
+        "flush_buckets": written,
+        "flush_ms": round(flush_s * 1000, 1),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clients", type=int, default=10000)
+    parser.add_argument("--calls", type=int, default=200000)
+    parser.add_argument("--threads", type=int, default=4)
+    args = parser.parse_args()
+    print(json.dumps(run(args.clients, args.calls, args.threads), indent=2))
@@ -0,0 +1,64 @@
+"""Startup benchmark: time to import the API and serve its first request.
+
+Each run starts a fresh interpreter with dummy provider keys. It imports
+``main`` and then calls ``/health`` through the ASGI app. Provider clients
+are created lazily and keys are validated in the background, so neither
+step should touch the network.
+
+Run from the backend directory:
+
+    python -m benchmarks.bench_startup --runs 5
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+PROBE = r"""
+import asyncio, json, time
+start = time.perf_counter()
+import main
+imported = time.perf_counter()
+import httpx
+
+async def first_request():
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        response = await client.get("/health")
+        assert response.status_code == 200, response.text
+
+asyncio.run(first_request())
+served = time.perf_counter()
+print(json.dumps({"import_s": imported - start, "first_request_s": served - start}))
+"""
+
+
+def run(runs: int) -> dict:
+    env = dict(os.environ)
+    env.update({
+        "XAI_API_KEY": "bench-xai",
+        "ANTHROPIC_API_KEY": "bench-anthropic",
+        "OPENAI_API_KEY": "bench-openai",
+    })
+    samples = []
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, "-c", PROBE], env=env, capture_output=True, text=True, check=True
+        ).stdout
+        samples.append(json.loads(output.strip().splitlines()[-1]))
+
+    return {
+        "runs": runs,
+        "import_s_median": round(statistics.median(s["import_s"] for s in samples), 3),
+        "first_request_s_median": round(statistics.median(s["first_request_s"] for s in samples), 3),
+        "first_request_s_max": round(max(s["first_request_s"] for s in samples), 3),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+    print(json.dumps(run(args.runs), indent=2))
@@ -0,0 +1,93 @@
+"""Micro-benchmark: compiled template rendering vs. the str.replace chain.
+
+Renders a newsletter-sized HTML body for many recipients with the
+replace chain ``send_email`` used to run and with
+``template_engine.CompiledTemplate.render``. Reports time and peak
+allocations per recipient.
+
+Run from the backend directory:
+
+    python -m benchmarks.bench_templates --recipients 20000 --size 30000
+"""
+import argparse
+import json
+import time
+import tracemalloc
+
+from template_engine import compile_template, recipient_fields
+
+SMTP_CONFIG = {"name": "Zirodelta Research", "email": "news@example.com"}
+
+
+def build_template(size: int) -> str:
+    block = (
+        "<tr><td style=\"padding: 12px; font-family: Arial, sans-serif;\">"
+        "<p>Hello [[RECIPIENT_NAME]], here is this week's research digest.</p>"
+        "<p>Sent by [[NAME]] to [[RECIPIENT_EMAIL]] at [[ORGANIZATION]].</p>"
+        "</td></tr>\n"
+    )
+    filler = "<tr><td><p>" + "Market structure notes and funding rate analysis. " * 8 + "</p></td></tr>\n"
+    body = []
+    while sum(map(len, body)) < size:
+        body.append(block)
+        body.extend([filler] * 4)
+    return "<!DOCTYPE html><html><body><table>" + "".join(body) + "</table></body></html>"
+
+
+def render_replace_chain(html_content: str, recipient: dict) -> str:
+    personalized_content = html_content.replace('[[NAME]]', SMTP_CONFIG['name'])
+    personalized_content = personalized_content.replace('[[RECIPIENT_NAME]]', recipient['name'])
+    personalized_content = personalized_content.replace('[[RECIPIENT_EMAIL]]', recipient['email'])
+    if recipient.get('organization'):
+        personalized_content = personalized_content.replace('[[ORGANIZATION]]', recipient['organization'])
+    return personalized_content
+
+
+def render_compiled(html_content: str, recipient: dict) -> str:
+    return compile_template(html_content).render(recipient_fields(recipient, SMTP_CONFIG))
+
+
+def measure(render, html_content: str, recipients: list) -> dict:
+    start = time.perf_counter()
+    for recipient in recipients:
+        render(html_content, recipient)
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    render(html_content, recipients[0])
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "total_s": round(elapsed, 4),
+        "us_per_recipient": round(elapsed / len(recipients) * 1e6, 2),
+        "peak_alloc_bytes_per_recipient": peak,
+    }
+
+
+def run(count: int, size: int) -> dict:
+    html_content = build_template(size)
+    recipients = [
+        {"name": f"Reader {i}", "email": f"reader{i}@example.com", "organization": f"Org {i % 50}"}
+        for i in range(count)
+    ]
+    for recipient in recipients[:100]:
+        assert render_compiled(html_content, recipient) == render_replace_chain(html_content, recipient)
+
+    replace_chain = measure(render_replace_chain, html_content, recipients)
+    compiled = measure(render_compiled, html_content, recipients)
+    return {
+        "recipients": count,
+        "template_bytes": len(html_content),
+        "replace_chain": replace_chain,
+        "compiled": compiled,
+        "speedup": round(replace_chain["total_s"] / compiled["total_s"], 2),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--recipients", type=int, default=20000)
+    parser.add_argument("--size", type=int, default=30000)
+    args = parser.parse_args()
+    print(json.dumps(run(args.recipients, args.size), indent=2))
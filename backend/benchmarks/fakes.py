@@ -0,0 +1,265 @@
+"""Local stand-ins for the SMTP server and the LLM provider APIs.
+
+Both run in-process on background threads and bind to a free port on
+127.0.0.1, so benchmarks need no network access or credentials.
+
+``FakeSMTPServer`` speaks enough ESMTP for ``smtplib``: EHLO, a real
+STARTTLS upgrade with a throwaway self-signed certificate, AUTH, and
+multi-recipient transactions. ``FakeLLMServer`` answers the X.AI and
+OpenAI chat completion, Anthropic messages and Ollama chat APIs, streamed
+or not. Both wait ``latency`` seconds before accepting a message or
+answering a request.
+"""
+import asyncio
+import datetime
+import json
+import os
+import ssl
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List
+
+REPLY_WORDS = ["Here", " is", " a", " friendlier", " subject", " line", "."]
+
+
+def _self_signed_context() -> ssl.SSLContext:
+    """A server TLS context with a fresh self-signed certificate for localhost"""
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.x509.oid import NameOID
+
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "localhost")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(days=1))
+        .not_valid_after(now + datetime.timedelta(days=1))
+        .sign(key, hashes.SHA256())
+    )
+    directory = tempfile.mkdtemp(prefix="bench-tls-")
+    cert_path, key_path = os.path.join(directory, "cert.pem"), os.path.join(directory, "key.pem")
+    with open(cert_path, "wb") as f:
+        f.write(cert.public_bytes(serialization.Encoding.PEM))
+    with open(key_path, "wb") as f:
+        f.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                  serialization.NoEncryption()))
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(cert_path, key_path)
+    return context
+
+
+class FakeSMTPServer:
+    """An ESMTP sink that counts connections, logins, transactions and recipients"""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.connections = 0
+        self.logins = 0
+        self.transactions = 0
+        self.recipients = 0
+        self._tls = _self_signed_context()
+        self._loop = asyncio.new_event_loop()
+        self._ready = threading.Event()
+        self._server = None
+        self.port = 0
+        threading.Thread(target=self._run, name="fake-smtp", daemon=True).start()
+        self._ready.wait()
+
+    def _run(self):
+        asyncio.set_event_loop(self._loop)
+        self._server = self._loop.run_until_complete(asyncio.start_server(self._handle, "127.0.0.1", 0))
+        self.port = self._server.sockets[0].getsockname()[1]
+        self._ready.set()
+        self._loop.run_forever()
+
+    def config(self) -> dict:
+        """An SMTP configuration dict pointing at this server"""
+        return {"server": "127.0.0.1", "port": str(self.port), "email": "bench@example.com",
+                "password": "secret", "name": "Bench"}
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.connections += 1
+        writer.write(b"220 fake ESMTP\r\n")
+        recipients = 0
+        tls = False
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                command = line.decode("utf-8", "replace").strip().upper()
+                if command.startswith(("EHLO", "HELO")):
+                    extensions = [b"AUTH PLAIN LOGIN", b"8BITMIME", b"SIZE 52428800"]
+                    if not tls:
+                        extensions.append(b"STARTTLS")
+                    writer.write(b"250-fake\r\n" + b"".join(b"250-" + e + b"\r\n" for e in extensions[:-1])
+                                 + b"250 " + extensions[-1] + b"\r\n")
+                elif command.startswith("STARTTLS"):
+                    writer.write(b"220 ready for TLS\r\n")
+                    await writer.drain()
+                    await writer.start_tls(self._tls)
+                    tls = True
+                    continue
+                elif command.startswith("AUTH"):
+                    self.logins += 1
+                    writer.write(b"235 authenticated\r\n")
+                elif command.startswith("RCPT"):
+                    recipients += 1
+                    writer.write(b"250 ok\r\n")
+                elif command.startswith("DATA"):
+                    writer.write(b"354 go ahead\r\n")
+                    await writer.drain()
+                    while await reader.readline() not in (b".\r\n", b".\n", b""):
+                        pass
+                    if self.latency:
+                        await asyncio.sleep(self.latency)
+                    self.transactions += 1
+                    self.recipients += recipients
+                    recipients = 0
+                    writer.write(b"250 queued\r\n")
+                elif command.startswith("RSET"):
+                    recipients = 0
+                    writer.write(b"250 ok\r\n")
+                elif command.startswith("QUIT"):
+                    writer.write(b"221 bye\r\n")
+                    await writer.drain()
+                    break
+                else:
+                    writer.write(b"250 ok\r\n")
+                await writer.drain()
+        except (ConnectionError, ssl.SSLError):
+            pass
+        finally:
+            writer.close()
+
+    def close(self):
+        self._loop.call_soon_threadsafe(self._server.close)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+
+class _LLMHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        self.server.requests += 1
+        time.sleep(self.server.latency)
+        prompt_tokens = sum(len(str(m.get("content", "")).split()) for m in body.get("messages", []))
+        usage = (prompt_tokens, len(REPLY_WORDS))
+        if self.path.endswith("/api/chat"):
+            self._ollama(body, usage)
+        elif self.path.endswith("/messages"):
+            self._anthropic(body, usage)
+        elif self.path.endswith("/chat/completions"):
+            self._openai(body, usage)
+        else:
+            self.send_error(404)
+
+    def _json(self, payload: dict):
+        data = json.dumps(payload).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _stream(self, content_type: str, chunks: List[str]):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for chunk in chunks:
+            data = chunk.encode()
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+            self.wfile.flush()
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _ollama(self, body, usage):
+        final = {"model": body.get("model"), "message": {"role": "assistant", "content": ""}, "done": True,
+                 "prompt_eval_count": usage[0], "eval_count": usage[1]}
+        if not body.get("stream", True):
+            self._json({**final, "message": {"role": "assistant", "content": "".join(REPLY_WORDS)}})
+            return
+        lines = [json.dumps({"message": {"role": "assistant", "content": w}, "done": False}) + "\n"
+                 for w in REPLY_WORDS]
+        self._stream("application/x-ndjson", lines + [json.dumps(final) + "\n"])
+
+    def _openai(self, body, usage):
+        base = {"id": "chatcmpl-bench", "created": int(time.time()), "model": body.get("model")}
+        if not body.get("stream"):
+            self._json({**base, "object": "chat.completion", "choices": [{
+                "index": 0, "finish_reason": "stop",
+                "message": {"role": "assistant", "content": "".join(REPLY_WORDS)}}],
+                "usage": {"prompt_tokens": usage[0], "completion_tokens": usage[1],
+                          "total_tokens": sum(usage)}})
+            return
+        events = ["data: " + json.dumps({**base, "object": "chat.completion.chunk", "choices": [{
+            "index": 0, "finish_reason": None, "delta": {"content": w}}]}) + "\n\n" for w in REPLY_WORDS]
+        self._stream("text/event-stream", events + ["data: [DONE]\n\n"])
+
+    def _anthropic(self, body, usage):
+        message = {"id": "msg_bench", "type": "message", "role": "assistant", "model": body.get("model"),
+                   "stop_reason": "end_turn", "stop_sequence": None,
+                   "usage": {"input_tokens": usage[0], "output_tokens": usage[1]}}
+        if not body.get("stream"):
+            self._json({**message, "content": [{"type": "text", "text": "".join(REPLY_WORDS)}]})
+            return
+
+        def event(name, data):
+            return f"event: {name}\ndata: {json.dumps({'type': name, **data})}\n\n"
+
+        events = [event("message_start", {"message": {**message, "content": [],
+                                                      "usage": {"input_tokens": usage[0], "output_tokens": 0}}}),
+                  event("content_block_start", {"index": 0, "content_block": {"type": "text", "text": ""}})]
+        events += [event("content_block_delta", {"index": 0, "delta": {"type": "text_delta", "text": w}})
+                   for w in REPLY_WORDS]
+        events += [event("content_block_stop", {"index": 0}),
+                   event("message_delta", {"delta": {"stop_reason": "end_turn", "stop_sequence": None},
+                                           "usage": {"output_tokens": usage[1]}}),
+                   event("message_stop", {})]
+        self._stream("text/event-stream", events)
+
+
+class FakeLLMServer:
+    """One HTTP server answering the X.AI, OpenAI, Anthropic and Ollama chat APIs"""
+
+    def __init__(self, latency: float = 0.0):
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", 0), _LLMHandler)
+        self._httpd.daemon_threads = True
+        self._httpd.latency = latency
+        self._httpd.requests = 0
+        self.port = self._httpd.server_address[1]
+        threading.Thread(target=self._httpd.serve_forever, name="fake-llm", daemon=True).start()
+
+    @property
+    def requests(self) -> int:
+        return self._httpd.requests
+
+    def environ(self) -> dict:
+        """Environment variables that point the services at this server"""
+        base = f"http://127.0.0.1:{self.port}"
+        return {
+            "XAI_API_URL": f"{base}/v1/chat/completions",
+            "XAI_API_KEY": "bench-xai",
+            "ANTHROPIC_BASE_URL": base,
+            "ANTHROPIC_API_KEY": "bench-anthropic",
+            "OPENAI_BASE_URL": f"{base}/v1",
+            "OPENAI_API_KEY": "bench-openai",
+            "OLLAMA_API_URL": f"{base}/api/chat",
+        }
+
+    def close(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
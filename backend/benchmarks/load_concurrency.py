@@ -0,0 +1,76 @@
+"""Load test: concurrent requests to blocking endpoints must not serialize.
+
+Stubs the LLM call and the campaign enqueue with a fixed ``time.sleep`` and fires
+concurrent requests at ``/ai/chat`` and ``/send-email`` through the ASGI
+app. With the work off-loaded, wall time stays close to one call's latency
+instead of growing with the number of requests.
+
+Run from the backend directory:
+
+    python -m benchmarks.load_concurrency --requests 16 --latency 0.5
+"""
+import argparse
+import asyncio
+import json
+import time
+
+import httpx
+
+import main
+
+
+def _slow_chat(*args, latency: float = 0.5, **kwargs):
+    time.sleep(latency)
+    return {"success": True, "message": "stub", "remaining_chats": 1}
+
+
+def _slow_enqueue(*args, latency: float = 0.5, **kwargs):
+    time.sleep(latency)
+    return 1
+
+
+async def _fire(client: httpx.AsyncClient, path: str, payload: dict, count: int) -> float:
+    start = time.perf_counter()
+    responses = await asyncio.gather(*[client.post(path, json=payload) for _ in range(count)])
+    elapsed = time.perf_counter() - start
+    assert all(r.status_code == 200 for r in responses), [r.text for r in responses]
+    return elapsed
+
+
+async def run(count: int, latency: float) -> dict:
+    main.ai_service.generate_response = lambda *a, **k: _slow_chat(latency=latency)
+    main.campaign_queue.enqueue = lambda *a, **k: _slow_enqueue(latency=latency)
+    main.quota_service.set_limit("email", count)
+    main.quota_service.set_limit("chat", count)
+
+    chat_payload = {"prompt": "hello"}
+    send_payload = {
+        "content": "<p>Hi</p>",
+        "recipients": [{"name": "Test", "email": "test@example.com"}],
+        "smtp": {"server": "localhost", "port": "587", "email": "me@example.com",
+                 "password": "secret", "name": "Me"},
+    }
+
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        chat_time = await _fire(client, "/ai/chat", chat_payload, count)
+        send_time = await _fire(client, "/send-email", send_payload, count)
+
+    serialized = count * latency
+    return {
+        "requests": count,
+        "latency_s": latency,
+        "serialized_s": serialized,
+        "ai_chat_s": round(chat_time, 3),
+        "send_email_s": round(send_time, 3),
+        "ai_chat_speedup": round(serialized / chat_time, 2),
+        "send_email_speedup": round(serialized / send_time, 2),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=16)
+    parser.add_argument("--latency", type=float, default=0.5)
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(run(args.requests, args.latency)), indent=2))
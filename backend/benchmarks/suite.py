@@ -0,0 +1,383 @@
+"""Benchmark suite: mail and chat paths against local SMTP and LLM stand-ins.
+
+Each scenario runs in a fresh interpreter with its own scratch database,
+an in-process fake SMTP server and a fake LLM server (see ``fakes.py``).
+The services are pointed at them through their usual environment
+variables. Scenarios:
+
+- ``send_email``: ``email_service.send_email`` called directly, for a
+  personalized and a static template, and for the static template with
+  multi-RCPT batching
+- ``send_email_api``: concurrent ``POST /send-email`` on ``main.app``,
+  timed until the campaign queue has delivered every job
+- ``ai_chat_main``: concurrent ``POST /ai/chat`` on ``main.app``, once per
+  provider (X.AI, Anthropic, OpenAI)
+- ``ai_chat_local``: concurrent ``POST /ai/chat`` on ``local_ai_service.app``
+  against the fake Ollama API
+- ``scheduler``: scheduled newsletter runs to a stored recipient group
+
+The report is JSON with throughput, p50/p95/p99 latency and the peak RSS
+of each scenario's process, so runs can be diffed against each other.
+The suite exits non-zero when a scenario crashes or every one of its
+operations failed, since its timings would then measure nothing.
+
+Run from the backend directory:
+
+    python -m benchmarks.suite --output report.json
+    python -m benchmarks.suite --only ai_chat_main ai_chat_local --llm-latency 0.2
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from typing import Callable, Dict, List
+
+DOMAINS = ["example.com", "example.org", "example.net", "mail.example.com", "news.example.org"]
+
+PERSONALIZED_TEMPLATE = """<html><body>
+<h1>Hi [[RECIPIENT_NAME|there]],</h1>
+<p>Here is this week's update from [[NAME]]. Thanks for reading!</p>
+</body></html>"""
+
+STATIC_TEMPLATE = """<html><body>
+<h1>Hi there,</h1>
+<p>Here is this week's update. Thanks for reading!</p>
+</body></html>"""
+
+
+def recipients(count: int, offset: int = 0) -> List[dict]:
+    """Recipients spread round-robin over a few domains"""
+    return [{"name": f"Reader {i}", "email": f"reader{i}@{DOMAINS[i % len(DOMAINS)]}"}
+            for i in range(offset, offset + count)]
+
+
+def summarize(latencies: List[float], elapsed: float, operations: int) -> dict:
+    """Throughput and latency percentiles, in operations per second and milliseconds"""
+    ordered = sorted(latencies)
+
+    def percentile(p: float) -> float:
+        if not ordered:
+            return None
+        return round(ordered[min(len(ordered) - 1, int(round(p * (len(ordered) - 1))))] * 1000, 2)
+
+    return {
+        "operations": operations,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_per_s": round(operations / elapsed, 1) if elapsed else None,
+        "p50_ms": percentile(0.50),
+        "p95_ms": percentile(0.95),
+        "p99_ms": percentile(0.99),
+    }
+
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of this process"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+async def _concurrently(count: int, concurrency: int, call: Callable) -> tuple:
+    """Run ``call(i)`` for i in range(count), at most ``concurrency`` at a time"""
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = 0
+
+    async def one(i: int):
+        nonlocal errors
+        async with semaphore:
+            start = time.perf_counter()
+            ok = await call(i)
+            latencies.append(time.perf_counter() - start)
+            errors += not ok
+
+    start = time.perf_counter()
+    await asyncio.gather(*[one(i) for i in range(count)])
+    return latencies, time.perf_counter() - start, errors
+
+
+def scenario_send_email(args, smtp, llm) -> dict:
+    from email_service import send_email
+
+    result = {}
+    variants = (
+        ("personalized", PERSONALIZED_TEMPLATE, {}),
+        ("static", STATIC_TEMPLATE, {"per_recipient_unsubscribe": True}),
+        ("static_batched", STATIC_TEMPLATE, {"per_recipient_unsubscribe": False}),
+    )
+    for label, template, options in variants:
+        before = (smtp.connections, smtp.transactions)
+        latencies = []
+        start = time.perf_counter()
+        sent = 0
+        for offset in range(0, args.recipients, args.batch):
+            batch = recipients(min(args.batch, args.recipients - offset), offset)
+            call_start = time.perf_counter()
+            outcome = send_email(template, batch, smtp.config(), **options)
+            latencies.append(time.perf_counter() - call_start)
+            sent += outcome["successful_sends"]
+        elapsed = time.perf_counter() - start
+        result[label] = {
+            **summarize(latencies, elapsed, len(latencies)),
+            "messages": sent,
+            "messages_per_s": round(sent / elapsed, 1),
+            "smtp_connections": smtp.connections - before[0],
+            "smtp_transactions": smtp.transactions - before[1],
+        }
+    return result
+
+
+async def scenario_send_email_api(args, smtp, llm) -> dict:
+    import httpx
+    import main
+
+    main.campaign_queue.start()
+    job_ids = []
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=60) as client:
+        async def post(i: int) -> bool:
+            response = await client.post("/send-email", json={
+                "content": PERSONALIZED_TEMPLATE,
+                "recipients": recipients(args.batch, i * args.batch),
+                "smtp": smtp.config(),
+            })
+            body = response.json()
+            if body.get("job_id"):
+                job_ids.append(body["job_id"])
+            return response.status_code == 200 and body.get("status") == "queued"
+
+        start = time.perf_counter()
+        latencies, elapsed, errors = await _concurrently(args.requests, args.concurrency, post)
+
+        # Delivery is done by the queue worker; wait for it to drain
+        pending = set(job_ids)
+        deadline = time.monotonic() + args.timeout
+        while pending and time.monotonic() < deadline:
+            for job_id in list(pending):
+                job = (await client.get(f"/send-jobs/{job_id}")).json()
+                if job["status"] in ("completed", "failed"):
+                    pending.discard(job_id)
+            await asyncio.sleep(0.05)
+        delivered_s = time.perf_counter() - start
+    main.campaign_queue.stop()
+
+    return {
+        **summarize(latencies, elapsed, args.requests),
+        "errors": errors,
+        "jobs_unfinished": len(pending),
+        "messages": smtp.recipients,
+        "delivery_s": round(delivered_s, 3),
+        "messages_per_s": round(smtp.recipients / delivered_s, 1),
+    }
+
+
+async def scenario_ai_chat_main(args, smtp, llm) -> dict:
+    import httpx
+    import main
+
+    router = main.ai_service.router
+    adapters = list(router.adapters)
+    result = {}
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=60) as client:
+        for adapter in adapters:
+            # Route every request to this one provider
+            router.adapters = [adapter]
+
+            async def chat(i: int) -> bool:
+                response = await client.post("/ai/chat", json={
+                    "prompt": f"Suggest a subject line for issue {i} ({adapter.name})",
+                })
+                return response.status_code == 200 and response.json().get("success") is True
+
+            latencies, elapsed, errors = await _concurrently(args.requests, args.concurrency, chat)
+            result[adapter.name] = {**summarize(latencies, elapsed, args.requests), "errors": errors}
+    router.adapters = adapters
+    return result
+
+
+async def scenario_ai_chat_local(args, smtp, llm) -> dict:
+    import httpx
+    import local_ai_service
+
+    transport = httpx.ASGITransport(app=local_ai_service.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=60) as client:
+        session_ids = []
+        for i in range(min(args.concurrency, args.requests)):
+            response = await client.post("/chat-sessions", json={"name": f"bench {i}"})
+            session_ids.append(response.json()["id"])
+
+        async def chat(i: int) -> bool:
+            response = await client.post("/ai/chat", json={
+                "prompt": f"Suggest a subject line for issue {i}",
+                "session_id": session_ids[i % len(session_ids)],
+            })
+            return response.status_code == 200
+
+        latencies, elapsed, errors = await _concurrently(args.requests, args.concurrency, chat)
+    return {**summarize(latencies, elapsed, args.requests), "errors": errors, "llm_requests": llm.requests}
+
+
+async def scenario_scheduler(args, smtp, llm) -> dict:
+    import httpx
+    import main
+
+    config = smtp.config()
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=60) as client:
+        group = (await client.post("/recipient-groups", json={"name": "bench"})).json()
+        await client.post(f"/recipient-groups/{group['id']}/recipients", json=recipients(args.recipients))
+        await client.post("/smtp-profiles", json={**config, "profile_name": "bench", "is_default": True})
+        await client.post("/schedule-newsletter", json={
+            "name": "bench", "template_content": PERSONALIZED_TEMPLATE, "recipient_group": "bench",
+            "frequency": "weekly", "start_date": "2030-01-01T09:00:00",
+        })
+        schedule_id = (await client.get("/scheduled-newsletters")).json()[-1]["id"]
+
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(args.runs):
+        run_start = time.perf_counter()
+        await main.scheduler_service._send_newsletter(schedule_id)
+        latencies.append(time.perf_counter() - run_start)
+    elapsed = time.perf_counter() - start
+    return {
+        **summarize(latencies, elapsed, args.runs),
+        "messages": smtp.recipients,
+        "messages_per_s": round(smtp.recipients / elapsed, 1),
+    }
+
+
+SCENARIOS: Dict[str, Callable] = {
+    "send_email": scenario_send_email,
+    "send_email_api": scenario_send_email_api,
+    "ai_chat_main": scenario_ai_chat_main,
+    "ai_chat_local": scenario_ai_chat_local,
+    "scheduler": scenario_scheduler,
+}
+
+
+def run_scenario(name: str, args) -> dict:
+    """Run one scenario in this process; the environment must not have imported the services yet"""
+    from benchmarks.fakes import FakeLLMServer, FakeSMTPServer
+
+    directory = tempfile.mkdtemp(prefix=f"bench-{name}-")
+    smtp = FakeSMTPServer(latency=args.smtp_latency)
+    llm = FakeLLMServer(latency=args.llm_latency)
+    os.environ.update(llm.environ())
+    os.environ.update({
+        "DATABASE_URL": f"sqlite:///{os.path.join(directory, 'bench.db')}",
+        "AI_VALIDATE_KEYS": "false",
+        # Quotas would cut the load short
+        "QUOTA_CHAT_LIMIT": "1000000000",
+        "QUOTA_EMAIL_LIMIT": "1000000000",
+    })
+    logging.disable(logging.WARNING)
+
+    scenario = SCENARIOS[name]
+    try:
+        if asyncio.iscoroutinefunction(scenario):
+            result = asyncio.run(scenario(args, smtp, llm))
+        else:
+            result = scenario(args, smtp, llm)
+    finally:
+        smtp.close()
+        llm.close()
+    return {**result, "peak_rss_mb": peak_rss_mb()}
+
+
+def _git_revision() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def run(args) -> dict:
+    """Run the selected scenarios, each in its own interpreter"""
+    report = {
+        "started_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "revision": _git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "parameters": {key: getattr(args, key) for key in (
+            "requests", "concurrency", "recipients", "batch", "runs", "llm_latency", "smtp_latency")},
+        "scenarios": {},
+    }
+    passthrough = []
+    for key, value in report["parameters"].items():
+        passthrough += [f"--{key.replace('_', '-')}", str(value)]
+
+    for name in args.only or SCENARIOS:
+        with tempfile.NamedTemporaryFile(suffix=".json") as result_file:
+            process = subprocess.run(
+                [sys.executable, "-m", "benchmarks.suite", "--scenario", name,
+                 "--result-file", result_file.name, "--timeout", str(args.timeout), *passthrough],
+                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True,
+            )
+            if process.returncode != 0:
+                report["scenarios"][name] = {"error": process.stderr.strip().splitlines()[-1:]}
+                continue
+            with open(result_file.name) as f:
+                report["scenarios"][name] = json.load(f)
+    return report
+
+
+def broken(report: dict) -> List[str]:
+    """Scenarios, or providers within one, that crashed or had no successful operation"""
+    names = []
+
+    def check(name: str, result: dict):
+        if "error" in result:
+            names.append(name)
+        elif "errors" in result:
+            if result["operations"] and result["errors"] >= result["operations"]:
+                names.append(name)
+        else:
+            for key, value in result.items():
+                if isinstance(value, dict):
+                    check(f"{name}.{key}", value)
+
+    for name, result in report["scenarios"].items():
+        check(name, result)
+    return names
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--only", nargs="+", choices=list(SCENARIOS), help="scenarios to run (default: all)")
+    parser.add_argument("--requests", type=int, default=200, help="HTTP requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--recipients", type=int, default=500, help="recipients for send_email and scheduler")
+    parser.add_argument("--batch", type=int, default=50, help="recipients per send_email call or request")
+    parser.add_argument("--runs", type=int, default=3, help="scheduled runs")
+    parser.add_argument("--llm-latency", type=float, default=0.05, help="seconds per fake LLM response")
+    parser.add_argument("--smtp-latency", type=float, default=0.0, help="seconds per fake SMTP message")
+    parser.add_argument("--timeout", type=float, default=300, help="seconds to wait for queued sends")
+    parser.add_argument("--output", help="write the report here instead of stdout")
+    parser.add_argument("--scenario", choices=list(SCENARIOS), help=argparse.SUPPRESS)
+    parser.add_argument("--result-file", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.scenario:
+        with open(args.result_file, "w") as f:
+            json.dump(run_scenario(args.scenario, args), f)
+    else:
+        report = run(args)
+        if args.output:
+            with open(args.output, "w") as f:
+                f.write(json.dumps(report, indent=2) + "\n")
+        else:
+            print(json.dumps(report, indent=2))
+        failed = broken(report)
+        if failed:
+            sys.exit(f"Failed scenarios: {', '.join(failed)}")
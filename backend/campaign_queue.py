@@ -0,0 +1,310 @@
+import json
+import logging
+import os
+import socket
+import threading
+import uuid
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import func, or_, update
+from sqlalchemy.orm import sessionmaker
+
+from credentials import seal, unseal
+from metrics import QUEUE_DEPTH
+from models import SendJob, engine
+from email_service import send_email
+
+logger = logging.getLogger(__name__)
+Session = sessionmaker(bind=engine)
+
+# Recipients sent between two checkpoints
+SEND_JOB_CHUNK_SIZE = int(os.getenv('SEND_JOB_CHUNK_SIZE', '50'))
+# Seconds between polls for new work when the worker is idle
+SEND_QUEUE_POLL_INTERVAL = float(os.getenv('SEND_QUEUE_POLL_INTERVAL', '5'))
+# A running job whose heartbeat is older than this is considered abandoned. The
+# heartbeat is refreshed every quarter of this while the job runs, independent
+# of how long a chunk takes, so it only has to cover a few missed beats.
+SEND_JOB_STALE_AFTER = float(os.getenv('SEND_JOB_STALE_AFTER', '120'))
+
+
+def job_run_key(job_id: int) -> str:
+    """Send ledger key of a campaign job"""
+    return f"send_job:{job_id}"
+
+
+def _job_to_dict(job: SendJob) -> Dict[str, Any]:
+    return {
+        "id": job.id,
+        "campaign_name": job.campaign_name,
+        "status": job.status,
+        "total": job.total,
+        "processed": job.cursor,
+        "sent": job.sent_count,
+        "failed": job.failed_count,
+        "deferred": job.deferred_count,
+        "progress": round(job.cursor / job.total, 4) if job.total else 1.0,
+        "failures": json.loads(job.failures) if job.failures else [],
+        "error": job.error,
+        "created_at": job.created_at,
+        "started_at": job.started_at,
+        "finished_at": job.finished_at
+    }
+
+
+class CampaignQueue:
+    """Durable campaign send queue backed by the ``send_jobs`` table.
+
+    Jobs are claimed with a conditional UPDATE so several API workers can
+    share the queue. Progress is checkpointed after every chunk of
+    recipients. While a job runs, a side thread keeps its heartbeat fresh;
+    a job left running by a crashed worker is picked up again once its
+    heartbeat goes stale, and it resumes from the last checkpoint.
+    """
+
+    def __init__(self, chunk_size: int = SEND_JOB_CHUNK_SIZE,
+                 poll_interval: float = SEND_QUEUE_POLL_INTERVAL,
+                 stale_after: float = SEND_JOB_STALE_AFTER):
+        self.chunk_size = chunk_size
+        self.poll_interval = poll_interval
+        self.stale_after = stale_after
+        self.worker_id = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def enqueue(self, content: str, recipients: List[dict], smtp_config: dict,
+                campaign_name: str = 'newsletter') -> int:
+        """Persist a new campaign job and wake the worker"""
+        session = Session()
+        try:
+            job = SendJob(
+                campaign_name=campaign_name,
+                status='queued',
+                content=content,
+                recipients=json.dumps(recipients),
+                smtp_config=seal(smtp_config),
+                total=len(recipients)
+            )
+            session.add(job)
+            session.commit()
+            job_id = job.id
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+        self._wakeup.set()
+        return job_id
+
+    def retry(self, job_id: int, smtp_config: dict) -> bool:
+        """Requeue a finished job; only addresses it has not delivered to are sent again.
+
+        The credentials are passed again because they are cleared when a
+        job finishes. Returns False if the job is missing or still active.
+        """
+        session = Session()
+        try:
+            result = session.execute(
+                update(SendJob)
+                .where(SendJob.id == job_id, SendJob.status.in_(('completed', 'failed')))
+                .values(status='queued', cursor=0, failed_count=0, deferred_count=0, failures=None, error=None,
+                        finished_at=None, smtp_config=seal(smtp_config))
+            )
+            session.commit()
+        finally:
+            session.close()
+
+        if result.rowcount:
+            self._wakeup.set()
+        return bool(result.rowcount)
+
+    def get_job(self, job_id: int) -> Optional[Dict[str, Any]]:
+        """Return the status and progress of a job"""
+        session = Session()
+        try:
+            job = session.get(SendJob, job_id)
+            return _job_to_dict(job) if job else None
+        finally:
+            session.close()
+
+    def queued_count(self) -> int:
+        """Jobs waiting for a worker"""
+        session = Session()
+        try:
+            return session.query(func.count(SendJob.id)).filter(SendJob.status == 'queued').scalar()
+        finally:
+            session.close()
+
+    def list_jobs(self, limit: int = 20) -> List[Dict[str, Any]]:
+        """Return the most recent jobs"""
+        session = Session()
+        try:
+            jobs = session.query(SendJob).order_by(SendJob.id.desc()).limit(limit).all()
+            return [_job_to_dict(job) for job in jobs]
+        finally:
+            session.close()
+
+    def start(self):
+        """Start the background worker thread"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='campaign-queue', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 10):
+        """Stop the worker after its current chunk"""
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join(timeout)
+
+    def _run(self):
+        logger.info(f"Campaign queue worker {self.worker_id} started")
+        while not self._stop.is_set():
+            try:
+                job_id = self._claim_next()
+            except Exception as e:
+                logger.error(f"Error claiming send job: {str(e)}")
+                job_id = None
+
+            if job_id is None:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+                continue
+
+            try:
+                self._process(job_id)
+            except Exception as e:
+                logger.error(f"Send job {job_id} failed: {str(e)}")
+                self._finish(job_id, 'failed', error=str(e))
+
+    def _claim_next(self) -> Optional[int]:
+        """Atomically claim a queued job or one abandoned by a dead worker"""
+        session = Session()
+        try:
+            now = datetime.utcnow()
+            stale = now - timedelta(seconds=self.stale_after)
+            claimable = or_(
+                SendJob.status == 'queued',
+                (SendJob.status == 'running') & (SendJob.heartbeat_at < stale)
+            )
+            candidates = (
+                session.query(SendJob.id)
+                .filter(claimable)
+                .order_by(SendJob.id)
+                .limit(5)
+                .all()
+            )
+            for (job_id,) in candidates:
+                result = session.execute(
+                    update(SendJob)
+                    .where(SendJob.id == job_id)
+                    .where(claimable)
+                    .values(status='running', worker_id=self.worker_id, heartbeat_at=now)
+                )
+                session.commit()
+                if result.rowcount:
+                    return job_id
+            return None
+        finally:
+            session.close()
+
+    def _keep_alive(self, job_id: int, done: threading.Event):
+        """Refresh the heartbeat of a job this worker holds until ``done`` is set"""
+        while not done.wait(self.stale_after / 4):
+            session = Session()
+            try:
+                result = session.execute(
+                    update(SendJob)
+                    .where(SendJob.id == job_id, SendJob.worker_id == self.worker_id,
+                           SendJob.status == 'running')
+                    .values(heartbeat_at=datetime.utcnow())
+                )
+                session.commit()
+                if not result.rowcount:
+                    return
+            except Exception as e:
+                logger.error(f"Error refreshing heartbeat of send job {job_id}: {str(e)}")
+            finally:
+                session.close()
+
+    def _process(self, job_id: int):
+        done = threading.Event()
+        threading.Thread(target=self._keep_alive, args=(job_id, done),
+                         name=f'send-job-{job_id}-heartbeat', daemon=True).start()
+        try:
+            self._send_chunks(job_id)
+        finally:
+            done.set()
+
+    def _send_chunks(self, job_id: int):
+        session = Session()
+        try:
+            job = session.get(SendJob, job_id)
+            if job.started_at is None:
+                job.started_at = datetime.utcnow()
+                session.commit()
+            elif job.cursor:
+                logger.info(f"Resuming send job {job_id} at recipient {job.cursor}/{job.total}")
+
+            recipients = json.loads(job.recipients)
+            smtp_config = unseal(job.smtp_config)
+            failures = json.loads(job.failures) if job.failures else []
+            content, campaign_name, total, cursor = job.content, job.campaign_name, job.total, job.cursor
+
+            while cursor < total:
+                if self._stop.is_set():
+                    # Leave the job running so another worker resumes it
+                    return
+
+                chunk = recipients[cursor:cursor + self.chunk_size]
+                result = send_email(
+                    content=content,
+                    recipients=chunk,
+                    smtp_config=smtp_config,
+                    campaign_name=campaign_name,
+                    # A chunk cut short by a crash is resent without its delivered addresses
+                    run_key=job_run_key(job_id)
+                )
+
+                # Checkpoint the chunk, unless another worker has claimed the job meanwhile
+                failures.extend(result['failed_sends'])
+                cursor += len(chunk)
+                checkpoint = session.execute(
+                    update(SendJob)
+                    .where(SendJob.id == job_id, SendJob.worker_id == self.worker_id)
+                    .values(cursor=cursor,
+                            sent_count=SendJob.sent_count + result['successful_sends'],
+                            failed_count=SendJob.failed_count + len(result['failed_sends']),
+                            deferred_count=SendJob.deferred_count + len(result['deferred_sends']),
+                            failures=json.dumps(failures),
+                            heartbeat_at=datetime.utcnow())
+                )
+                session.commit()
+                if not checkpoint.rowcount:
+                    logger.warning(f"Send job {job_id} was claimed by another worker; stopping")
+                    return
+        finally:
+            session.close()
+
+        self._finish(job_id, 'completed')
+
+    def _finish(self, job_id: int, status: str, error: Optional[str] = None):
+        session = Session()
+        try:
+            session.execute(
+                update(SendJob)
+                .where(SendJob.id == job_id, SendJob.worker_id == self.worker_id)
+                # Credentials are only needed while the job can still run
+                .values(status=status, error=error, finished_at=datetime.utcnow(), smtp_config=None)
+            )
+            session.commit()
+        finally:
+            session.close()
+
+
+campaign_queue = CampaignQueue()
+QUEUE_DEPTH.set_function(campaign_queue.queued_count, 'send_jobs')
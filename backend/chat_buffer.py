@@ -0,0 +1,232 @@
+import atexit
+import logging
+import os
+import threading
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import insert
+from sqlalchemy.orm import sessionmaker
+
+from metrics import QUEUE_DEPTH
+from models import ChatMessage, ChatSummary, conflict_insert, engine
+
+logger = logging.getLogger(__name__)
+Session = sessionmaker(bind=engine)
+
+# Seconds between background flushes, and pending messages that trigger an early one
+CHAT_FLUSH_INTERVAL = float(os.getenv('CHAT_FLUSH_INTERVAL', '0.5'))
+CHAT_FLUSH_BATCH = int(os.getenv('CHAT_FLUSH_BATCH', '200'))
+# Pending messages kept while the database is unavailable; the oldest are dropped beyond it
+CHAT_BUFFER_MAX_PENDING = int(os.getenv('CHAT_BUFFER_MAX_PENDING', '10000'))
+# Consecutive failed flushes after which the entries in them are dropped
+CHAT_FLUSH_MAX_FAILURES = int(os.getenv('CHAT_FLUSH_MAX_FAILURES', '5'))
+
+
+class PendingMessage:
+    """A chat message accepted but not yet written; duck-types ChatMessage for readers"""
+
+    __slots__ = ('session_id', 'role', 'content', 'timestamp')
+
+    def __init__(self, session_id: int, role: str, content: str, timestamp: datetime):
+        self.session_id = session_id
+        self.role = role
+        self.content = content
+        self.timestamp = timestamp
+
+    @property
+    def key(self) -> Tuple:
+        return (self.timestamp, self.role, self.content)
+
+
+class ChatWriteBuffer:
+    """Write-behind buffer for chat messages and rolling summaries.
+
+    Chat turns hand their messages to the buffer instead of committing them.
+    A background thread writes everything pending in one transaction every
+    ``flush_interval`` seconds, or sooner once ``max_batch`` messages are
+    waiting. Messages are written in the order they were added, so every
+    session keeps its order. Entries stay visible through ``pending()``
+    until their transaction commits, so readers never miss a message. A
+    reader may see one both pending and in the database for a moment;
+    ``merge()`` removes such duplicates. ``stop()`` flushes what is left
+    and is also registered with atexit.
+
+    The buffer is bounded: past ``max_pending`` messages the oldest are
+    dropped, and entries that fail ``max_failures`` flushes in a row are
+    dropped so one bad row cannot block every later one. Both are logged
+    as errors.
+    """
+
+    def __init__(self, flush_interval: float = CHAT_FLUSH_INTERVAL, max_batch: int = CHAT_FLUSH_BATCH,
+                 max_pending: int = CHAT_BUFFER_MAX_PENDING, max_failures: int = CHAT_FLUSH_MAX_FAILURES):
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.max_pending = max_pending
+        self.max_failures = max_failures
+        self._failures = 0
+        self._messages: List[PendingMessage] = []
+        self._summaries: Dict[int, Tuple[str, Optional[datetime]]] = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._last_timestamp = datetime.min
+
+    def add(self, session_id: int, role: str, content: str) -> PendingMessage:
+        """Queue a message; its timestamp is fixed now, so order matches arrival"""
+        with self._lock:
+            # Strictly increasing timestamps keep (timestamp, id) ordering stable
+            timestamp = datetime.utcnow()
+            if timestamp <= self._last_timestamp:
+                timestamp = self._last_timestamp + timedelta(microseconds=1)
+            self._last_timestamp = timestamp
+            message = PendingMessage(session_id, role, content, timestamp)
+            self._messages.append(message)
+            backlog = len(self._messages)
+            overflow = backlog - self.max_pending
+            if overflow > 0:
+                del self._messages[:overflow]
+        if overflow > 0:
+            logger.error(f"Chat write buffer is full; dropped {overflow} unwritten messages")
+        if backlog >= self.max_batch:
+            self._wakeup.set()
+        self.start()
+        return message
+
+    def set_summary(self, session_id: int, summary: str, covered_until: Optional[datetime]):
+        """Queue the new rolling summary of a session"""
+        with self._lock:
+            self._summaries[session_id] = (summary, covered_until)
+        self.start()
+
+    def pending(self, session_id: int) -> List[PendingMessage]:
+        """Messages of a session that are not yet written, oldest first"""
+        with self._lock:
+            return [m for m in self._messages if m.session_id == session_id]
+
+    def pending_counts(self) -> Dict[int, int]:
+        with self._lock:
+            counts: Dict[int, int] = {}
+            for message in self._messages:
+                counts[message.session_id] = counts.get(message.session_id, 0) + 1
+            return counts
+
+    def pending_summary(self, session_id: int) -> Optional[Tuple[str, Optional[datetime]]]:
+        with self._lock:
+            return self._summaries.get(session_id)
+
+    @staticmethod
+    def merge(stored: list, pending: List[PendingMessage]) -> list:
+        """Combine stored rows and pending messages in timestamp order, dropping duplicates.
+
+        Take the ``pending()`` snapshot before querying the database, so a
+        flush that commits in between shows up as a duplicate, not a gap.
+        """
+        stored_keys = {(m.timestamp, m.role, m.content) for m in stored}
+        extra = [m for m in pending if m.key not in stored_keys]
+        if not extra:
+            return list(stored)
+        return sorted(list(stored) + extra, key=lambda m: m.timestamp)
+
+    def flush(self) -> int:
+        """Write everything pending in one transaction; returns the messages written"""
+        with self._flush_lock:
+            with self._lock:
+                messages = list(self._messages)
+                summaries = dict(self._summaries)
+            if not messages and not summaries:
+                return 0
+
+            session = Session()
+            try:
+                if messages:
+                    session.execute(insert(ChatMessage), [
+                        {"session_id": m.session_id, "role": m.role, "content": m.content, "timestamp": m.timestamp}
+                        for m in messages
+                    ])
+                for session_id, (summary, covered_until) in summaries.items():
+                    self._write_summary(session, session_id, summary, covered_until)
+                session.commit()
+            except Exception as e:
+                session.rollback()
+                self._failures += 1
+                logger.error(f"Failed to flush {len(messages)} chat messages "
+                             f"({self._failures}/{self.max_failures}): {str(e)}")
+                if self._failures >= self.max_failures:
+                    logger.error(f"Dropping {len(messages)} chat messages and {len(summaries)} summaries "
+                                 f"for sessions {sorted({m.session_id for m in messages} | set(summaries))}")
+                    self._remove(messages, summaries)
+                    self._failures = 0
+                raise
+            finally:
+                session.close()
+
+            self._failures = 0
+            self._remove(messages, summaries)
+            return len(messages)
+
+    def _remove(self, messages: List[PendingMessage], summaries: Dict[int, Tuple[str, Optional[datetime]]]):
+        with self._lock:
+            # Only drop what was flushed; anything added meanwhile stays queued
+            flushed = {id(m) for m in messages}
+            self._messages = [m for m in self._messages if id(m) not in flushed]
+            for session_id, value in summaries.items():
+                if self._summaries.get(session_id) is value:
+                    del self._summaries[session_id]
+
+    @staticmethod
+    def _write_summary(session, session_id: int, summary: str, covered_until: Optional[datetime]):
+        values = {"session_id": session_id, "summary": summary, "covered_until": covered_until,
+                  "updated_at": datetime.utcnow()}
+        stmt = conflict_insert(ChatSummary, session.get_bind().dialect.name)
+        if stmt is None:
+            session.merge(ChatSummary(**values))
+            return
+        session.execute(
+            stmt.values(**values).on_conflict_do_update(
+                index_elements=['session_id'],
+                set_={k: v for k, v in values.items() if k != 'session_id'}
+            )
+        )
+
+    def discard(self, session_id: int):
+        """Drop everything pending for a session, e.g. when it is deleted"""
+        with self._flush_lock, self._lock:
+            self._messages = [m for m in self._messages if m.session_id != session_id]
+            self._summaries.pop(session_id, None)
+
+    def start(self):
+        """Start the background flush thread if it is not running"""
+        if self._thread and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='chat-write-buffer', daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout: float = 10):
+        """Stop the flush thread and write whatever is still pending"""
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join(timeout)
+        self.flush()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                # flush() logged it; the entries are retried on the next tick unless dropped
+                pass
+
+
+chat_buffer = ChatWriteBuffer()
+atexit.register(chat_buffer.stop)
+QUEUE_DEPTH.set_function(lambda: len(chat_buffer._messages), 'chat_write_buffer')
@@ -0,0 +1,132 @@
+import logging
+import os
+from typing import Dict, List, Optional
+
+from sqlalchemy.orm import Session
+
+from chat_buffer import chat_buffer
+from models import ChatMessage, ChatSummary
+
+logger = logging.getLogger(__name__)
+
+# Token budget for everything sent to the model, including the system prompt
+CHAT_CONTEXT_TOKENS = int(os.getenv('CHAT_CONTEXT_TOKENS', '3000'))
+# Most recent user/assistant turns kept verbatim
+CHAT_RECENT_TURNS = int(os.getenv('CHAT_RECENT_TURNS', '6'))
+# Upper bound for the rolling summary of older turns
+CHAT_SUMMARY_TOKENS = int(os.getenv('CHAT_SUMMARY_TOKENS', '500'))
+# Characters of each older message kept in the summary
+SUMMARY_LINE_CHARS = 200
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count; about four characters per token for English text"""
+    return len(text) // 4 + 1
+
+
+def _summary_line(message: ChatMessage) -> str:
+    content = ' '.join(message.content.split())
+    if len(content) > SUMMARY_LINE_CHARS:
+        content = content[:SUMMARY_LINE_CHARS] + '...'
+    return f"{message.role}: {content}"
+
+
+def _trim_summary(summary: str, max_tokens: int) -> str:
+    """Drop the oldest summary lines until it fits the budget"""
+    lines = summary.splitlines()
+    while lines and estimate_tokens('\n'.join(lines)) > max_tokens:
+        lines.pop(0)
+    return '\n'.join(lines)
+
+
+def update_summary(db: Session, session_id: int, before, pending: Optional[list] = None) -> str:
+    """Fold messages older than ``before`` into the session's rolling summary.
+
+    Only messages newer than what the summary already covers are read, so
+    each message is folded in once. Messages still in the write buffer
+    count too; pass the ``pending`` snapshot taken before any query. The
+    summary is an extractive digest and keeps a short line per message,
+    most recent last, capped at ``CHAT_SUMMARY_TOKENS``. The new summary
+    is written through the chat write buffer, so building a context never
+    commits.
+    """
+    queued = chat_buffer.pending_summary(session_id)
+    if queued is not None:
+        summary, covered_until = queued
+    else:
+        row = db.get(ChatSummary, session_id)
+        summary, covered_until = (row.summary, row.covered_until) if row else ('', None)
+
+    if before is None:
+        return summary
+
+    if pending is None:
+        pending = chat_buffer.pending(session_id)
+    query = db.query(ChatMessage).filter(
+        ChatMessage.session_id == session_id,
+        ChatMessage.timestamp < before.timestamp
+    )
+    if covered_until is not None:
+        query = query.filter(ChatMessage.timestamp > covered_until)
+    older = query.order_by(ChatMessage.timestamp).all()
+    older = chat_buffer.merge(older, [
+        m for m in pending
+        if m.timestamp < before.timestamp and (covered_until is None or m.timestamp > covered_until)
+    ])
+
+    if not older:
+        return summary
+
+    lines = [summary] if summary else []
+    lines.extend(_summary_line(msg) for msg in older)
+    summary = _trim_summary('\n'.join(lines), CHAT_SUMMARY_TOKENS)
+    chat_buffer.set_summary(session_id, summary, older[-1].timestamp)
+    return summary
+
+
+def build_context(db: Session, session_id: int, system_prompt: str,
+                  extra: Optional[List[Dict[str, str]]] = None,
+                  prompt: str = '',
+                  budget: int = CHAT_CONTEXT_TOKENS,
+                  recent_turns: int = CHAT_RECENT_TURNS) -> List[Dict[str, str]]:
+    """Build the model messages for a chat turn within a token budget.
+
+    The result holds the system prompt, a summary of older turns, the most
+    recent turns verbatim (including ones still in the write buffer), any
+    client-supplied context and the new prompt. If that is over budget,
+    the oldest verbatim turns are dropped first and then the summary is
+    shortened. The prompt itself is always kept.
+    """
+    # Messages still in the write buffer are the newest; snapshot them before querying
+    pending = chat_buffer.pending(session_id)
+    recent = (
+        db.query(ChatMessage)
+        .filter(ChatMessage.session_id == session_id)
+        .order_by(ChatMessage.timestamp.desc(), ChatMessage.id.desc())
+        .limit(recent_turns * 2)
+        .all()
+    )
+    recent.reverse()
+    recent = chat_buffer.merge(recent, pending)[-recent_turns * 2:]
+
+    summary = update_summary(db, session_id, recent[0] if recent else None, pending)
+
+    history = [{"role": msg.role, "content": msg.content} for msg in recent]
+    tail = list(extra or [])
+    if prompt:
+        tail.append({"role": "user", "content": prompt})
+
+    fixed = estimate_tokens(system_prompt) + sum(estimate_tokens(m["content"]) for m in tail)
+    used = fixed + sum(estimate_tokens(m["content"]) for m in history)
+    if summary:
+        used += estimate_tokens(summary)
+
+    while history and used > budget:
+        used -= estimate_tokens(history.pop(0)["content"])
+    if summary and used > budget:
+        summary = _trim_summary(summary, max(0, budget - (used - estimate_tokens(summary))))
+
+    messages = [{"role": "system", "content": system_prompt}]
+    if summary:
+        messages.append({"role": "system", "content": f"Summary of the earlier conversation:\n{summary}"})
+    return messages + history + tail
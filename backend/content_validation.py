@@ -0,0 +1,149 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+from collections import OrderedDict
+from html.parser import HTMLParser
+from typing import List, Optional, Tuple
+
+from sqlalchemy.orm import sessionmaker
+
+from models import ContentValidation, engine
+
+logger = logging.getLogger(__name__)
+Session = sessionmaker(bind=engine)
+
+# Number of validation results kept in memory
+VALIDATION_CACHE_SIZE = int(os.getenv('VALIDATION_CACHE_SIZE', '256'))
+
+SPAM_TRIGGERS = ['free', 'guarantee', 'no cost', 'winner', 'won', 'prize']
+
+# One pass finds every trigger; the lookahead also reports overlapping matches
+_TRIGGER_PATTERN = re.compile('(?=(' + '|'.join(re.escape(t) for t in SPAM_TRIGGERS) + '))')
+
+# Elements whose text BeautifulSoup's get_text() leaves out
+_SKIPPED_ELEMENTS = {'script', 'style', 'template'}
+
+
+class _TextExtractor(HTMLParser):
+    """Collects visible text and counts images in a single streaming pass"""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts: List[str] = []
+        self.image_count = 0
+        self._skip_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'img':
+            self.image_count += 1
+        elif tag in _SKIPPED_ELEMENTS:
+            self._skip_depth += 1
+
+    def handle_startendtag(self, tag, attrs):
+        if tag == 'img':
+            self.image_count += 1
+
+    def handle_endtag(self, tag):
+        if tag in _SKIPPED_ELEMENTS and self._skip_depth:
+            self._skip_depth -= 1
+
+    def handle_data(self, data):
+        if not self._skip_depth:
+            self.parts.append(data)
+
+    def unknown_decl(self, data):
+        if data.upper().startswith('CDATA[') and not self._skip_depth:
+            self.parts.append(data[6:])
+
+
+def extract_text(html_content: str) -> Tuple[str, int]:
+    """Return the visible text of an HTML document and its number of images"""
+    parser = _TextExtractor()
+    parser.feed(html_content)
+    parser.close()
+    return ''.join(parser.parts), parser.image_count
+
+
+def compute_warnings(html_content: str) -> List[str]:
+    """Check content for spam triggers without consulting the cache"""
+    text_content, image_count = extract_text(html_content)
+    text_length = len(text_content)
+
+    warnings = []
+    if image_count > 0 and text_length / image_count < 100:
+        warnings.append("High image-to-text ratio detected")
+
+    found = set(_TRIGGER_PATTERN.findall(text_content.lower()))
+    for trigger in SPAM_TRIGGERS:
+        if trigger in found:
+            warnings.append(f"Potential spam trigger word found: {trigger}")
+
+    return warnings
+
+
+class ValidationCache:
+    """Validation results keyed by content hash, in memory and in SQLite.
+
+    Scheduled newsletters resend the same template every period, so a
+    persisted result skips the parse entirely after a restart.
+    """
+
+    def __init__(self, max_size: int = VALIDATION_CACHE_SIZE):
+        self.max_size = max_size
+        self._memory: "OrderedDict[str, List[str]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _remember(self, content_hash: str, warnings: List[str]):
+        with self._lock:
+            self._memory[content_hash] = warnings
+            self._memory.move_to_end(content_hash)
+            while len(self._memory) > self.max_size:
+                self._memory.popitem(last=False)
+
+    def _load(self, content_hash: str) -> Optional[List[str]]:
+        session = Session()
+        try:
+            row = session.get(ContentValidation, content_hash)
+            return json.loads(row.warnings) if row else None
+        except Exception as e:
+            # Treated as a miss; the content is validated again instead
+            logger.warning(f"Could not load validation result: {str(e)}")
+            return None
+        finally:
+            session.close()
+
+    def _store(self, content_hash: str, warnings: List[str]):
+        session = Session()
+        try:
+            session.merge(ContentValidation(content_hash=content_hash, warnings=json.dumps(warnings)))
+            session.commit()
+        except Exception as e:
+            # The cache is an optimization; never fail a send over it
+            logger.warning(f"Could not persist validation result: {str(e)}")
+            session.rollback()
+        finally:
+            session.close()
+
+    def validate(self, html_content: str) -> List[str]:
+        """Return the warnings for the content, computing them at most once"""
+        content_hash = hashlib.sha256(html_content.encode('utf-8')).hexdigest()
+
+        with self._lock:
+            warnings = self._memory.get(content_hash)
+            if warnings is not None:
+                self._memory.move_to_end(content_hash)
+                return list(warnings)
+
+        warnings = self._load(content_hash)
+        if warnings is None:
+            warnings = compute_warnings(html_content)
+            self._store(content_hash, warnings)
+
+        self._remember(content_hash, warnings)
+        return list(warnings)
+
+
+validation_cache = ValidationCache()
@@ -0,0 +1,76 @@
+import json
+import logging
+import os
+from typing import Optional
+
+from cryptography.fernet import Fernet, InvalidToken
+
+logger = logging.getLogger(__name__)
+
+# Fernet key that seals SMTP credentials stored for queued sends. Set the same
+# key on every host that shares the database; without it a key file is
+# created next to the backend and shared by the workers on this host.
+SMTP_CREDENTIALS_KEY = os.getenv('SMTP_CREDENTIALS_KEY')
+SMTP_CREDENTIALS_KEY_FILE = os.getenv(
+    'SMTP_CREDENTIALS_KEY_FILE',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '.smtp_credentials.key')
+)
+
+_fernet: Optional[Fernet] = None
+
+
+# Every Fernet token starts with its version byte, base64-encoded
+FERNET_PREFIX = 'gAAAAA'
+
+
+class CredentialsUnavailable(Exception):
+    """Raised when stored credentials were sealed with a different key"""
+
+
+def _load_key_file(path: str) -> bytes:
+    """Read the key file, creating it readable by its owner only if it is missing"""
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        with open(path, 'rb') as f:
+            return f.read().strip()
+    key = Fernet.generate_key()
+    with os.fdopen(fd, 'wb') as f:
+        f.write(key)
+    logger.info(f"Created SMTP credentials key at {path}")
+    return key
+
+
+def _get_fernet() -> Fernet:
+    global _fernet
+    if _fernet is None:
+        key = SMTP_CREDENTIALS_KEY.encode() if SMTP_CREDENTIALS_KEY else _load_key_file(SMTP_CREDENTIALS_KEY_FILE)
+        _fernet = Fernet(key)
+    return _fernet
+
+
+def seal_secret(value: str) -> str:
+    """Encrypt a single secret, e.g. a stored SMTP password"""
+    return _get_fernet().encrypt(value.encode()).decode()
+
+
+def unseal_secret(token: str) -> str:
+    """Decrypt a value written by ``seal_secret``; a plaintext value from before encryption is read as is"""
+    if not token.startswith(FERNET_PREFIX):
+        return token
+    try:
+        return _get_fernet().decrypt(token.encode()).decode()
+    except InvalidToken:
+        raise CredentialsUnavailable("Stored SMTP credentials cannot be decrypted with this key")
+
+
+def seal(smtp_config: dict) -> str:
+    """Encrypt an smtp_config dict for storage"""
+    return seal_secret(json.dumps(smtp_config))
+
+
+def unseal(token: str) -> dict:
+    """Decrypt a value written by ``seal``; plain JSON from before encryption is read as is"""
+    if token.lstrip().startswith('{'):
+        return json.loads(token)
+    return json.loads(unseal_secret(token))
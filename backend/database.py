@@ -0,0 +1,166 @@
+import asyncio
+import os
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+from executors import run_blocking
+from metrics import instrument_engine
+from models import (DATABASE_URL, DB_MAX_OVERFLOW, DB_POOL_SIZE, DB_POOL_TIMEOUT, SQL_ECHO,
+                    SQLITE_BUSY_TIMEOUT, engine, set_sqlite_pragmas)
+
+# Async driver URL for the same database; SQLite goes through aiosqlite
+ASYNC_DATABASE_URL = os.getenv(
+    'ASYNC_DATABASE_URL', DATABASE_URL.replace('sqlite://', 'sqlite+aiosqlite://', 1)
+)
+# Serve request sessions from the async driver. Off by default: requests get a
+# sync session whose calls run on the 'db' executor instead, which keeps the
+# event loop just as free and makes one thread hop per run_sync call rather
+# than one per statement (see benchmarks/bench_async_db.py).
+DB_ASYNC_SESSIONS = os.getenv('DB_ASYNC_SESSIONS', 'false').lower() == 'true'
+
+
+def _create_async_engine(url: str):
+    options = {
+        'echo': SQL_ECHO,
+        'pool_size': DB_POOL_SIZE,
+        'max_overflow': DB_MAX_OVERFLOW,
+        'pool_timeout': DB_POOL_TIMEOUT,
+    }
+    if not url.startswith('sqlite'):
+        return create_async_engine(url, pool_pre_ping=True, **options)
+
+    # aiosqlite defaults to NullPool, which would reopen the file and rerun the pragmas per request
+    db_engine = create_async_engine(url, poolclass=AsyncAdaptedQueuePool,
+                                    connect_args={'timeout': SQLITE_BUSY_TIMEOUT}, **options)
+    event.listen(db_engine.sync_engine, 'connect', set_sqlite_pragmas)
+    return db_engine
+
+
+# The schema is created and migrated by models on import; this engine only serves queries
+async_engine = _create_async_engine(ASYNC_DATABASE_URL)
+instrument_engine(async_engine.sync_engine)
+AsyncSessionLocal = async_sessionmaker(async_engine, expire_on_commit=False)
+SyncSessionLocal = sessionmaker(bind=engine, expire_on_commit=False)
+
+
+def _buffered_execute(session: Session, *args, **kwargs):
+    """Execute and fetch every row, so the result can be read off the worker thread"""
+    result = session.execute(*args, **kwargs)
+    if not getattr(result, 'returns_rows', True):
+        return result
+    try:
+        return result.freeze()()
+    except NotImplementedError:
+        # Results without rows, such as ORM bulk inserts, have nothing to buffer
+        return result
+
+
+# A BlockingSession takes one of these before its first statement and gives
+# it back when its transaction ends. With no more sessions holding connections
+# than the pool has, a 'db' worker never sits in the pool waiting for a
+# connection that only a queued call could give back.
+_connection_slots = asyncio.Semaphore(DB_POOL_SIZE + DB_MAX_OVERFLOW)
+
+
+class BlockingSession:
+    """The part of the AsyncSession interface the endpoints use, over a sync Session.
+
+    Every call that may touch the database runs on the 'db' executor, so
+    the event loop never waits on SQLite. ``run_sync`` runs the whole
+    function in one hop, where an AsyncSession hops per statement.
+    """
+
+    def __init__(self, session: Session):
+        self.sync_session = session
+        self._has_slot = False
+
+    async def _call(self, fn, *args, ends_transaction: bool = False, **kwargs):
+        if not self._has_slot:
+            await _connection_slots.acquire()
+            self._has_slot = True
+        try:
+            return await run_blocking(fn, *args, pool='db', **kwargs)
+        finally:
+            if ends_transaction:
+                self._has_slot = False
+                _connection_slots.release()
+
+    def add(self, instance):
+        self.sync_session.add(instance)
+
+    def get_bind(self):
+        return self.sync_session.get_bind()
+
+    async def run_sync(self, fn, *args, **kwargs):
+        return await self._call(fn, self.sync_session, *args, **kwargs)
+
+    async def get(self, *args, **kwargs):
+        return await self._call(self.sync_session.get, *args, **kwargs)
+
+    async def execute(self, *args, **kwargs):
+        return await self._call(_buffered_execute, self.sync_session, *args, **kwargs)
+
+    async def scalar(self, *args, **kwargs):
+        return await self._call(self.sync_session.scalar, *args, **kwargs)
+
+    async def scalars(self, *args, **kwargs):
+        return (await self.execute(*args, **kwargs)).scalars()
+
+    async def delete(self, instance):
+        await self._call(self.sync_session.delete, instance)
+
+    async def commit(self):
+        await self._call(self.sync_session.commit, ends_transaction=True)
+
+    async def rollback(self):
+        await self._call(self.sync_session.rollback, ends_transaction=True)
+
+    async def close(self):
+        if not self._has_slot:
+            # No transaction, so no connection to give back
+            self.sync_session.close()
+            return
+        await self._call(self.sync_session.close, ends_transaction=True)
+
+
+async def get_db() -> AsyncIterator[AsyncSession]:
+    """FastAPI dependency yielding one session per request.
+
+    The session is an AsyncSession when ``DB_ASYNC_SESSIONS`` is on and a
+    ``BlockingSession`` otherwise. Uncommitted work is rolled back and the
+    connection goes back to the pool when the request finishes.
+    """
+    if not DB_ASYNC_SESSIONS:
+        session = BlockingSession(SyncSessionLocal())
+        try:
+            yield session
+        finally:
+            await session.close()
+        return
+    async with AsyncSessionLocal() as session:
+        yield session
+
+
+# SQLite allows one writer at a time. A second writer would sit in SQLite's
+# sleeping busy handler, so writers queue on this lock instead.
+_sqlite_write_lock = asyncio.Lock()
+
+
+@asynccontextmanager
+async def serialized_writes():
+    """Hold around a block that writes and commits, so concurrent writers take turns"""
+    if async_engine.dialect.name != 'sqlite':
+        yield
+        return
+    async with _sqlite_write_lock:
+        yield
+
+
+async def dispose_async_engine():
+    """Close pooled connections; call on application shutdown"""
+    await async_engine.dispose()
@@ -1,36 +1,123 @@
+from smtp_pool import smtp_pool
+from send_engine import send_engine
+from template_engine import compile_template, recipient_fields
+from message_builder import CampaignMessageBuilder
+from content_validation import validation_cache
+import send_ledger
+from retry_queue import SMTP_RETRY_TRANSIENT, retry_queue
 import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-from email.utils import formatdate, make_msgid, formataddr
-import uuid
-from datetime import datetime
-from bs4 import BeautifulSoup
+import logging
+import os
+from collections import defaultdict
+
+logger = logging.getLogger(__name__)
+
+# Most recipients per multi-RCPT transaction for static templates; 1 disables batching
+SMTP_RCPT_BATCH_SIZE = int(os.getenv('SMTP_RCPT_BATCH_SIZE', '50'))
+# Give every message its own List-Unsubscribe link; batching only happens when this is off
+SMTP_PER_RECIPIENT_UNSUBSCRIBE = os.getenv('SMTP_PER_RECIPIENT_UNSUBSCRIBE', 'true').lower() == 'true'
 
 def validate_html_content(html_content):
     """Validate HTML content for potential spam triggers"""
-    soup = BeautifulSoup(html_content, 'html.parser')
+    return validation_cache.validate(html_content)
+
+def rcpt_batches(recipients: list, size: int) -> list:
+    """Group recipients by destination domain into batches of at most ``size``"""
+    by_domain = defaultdict(list)
+    for recipient in recipients:
+        by_domain[recipient['email'].rsplit('@', 1)[-1].lower()].append(recipient)
+    return [group[i:i + size] for group in by_domain.values() for i in range(0, len(group), size)]
+
+def _send_batched(html_content: str, builder: CampaignMessageBuilder, smtp_config: dict,
+                  recipients: list, batch_size: int, max_connections: int = None):
+    """Send one shared message per domain batch; returns per-recipient (sent, failed)"""
+    refused = {}
+
+    def send_one(batch):
+        # Addresses the server refused while accepting the rest
+        result = smtp_pool.send(smtp_config, [r['email'] for r in batch], builder.build_shared(html_content))
+        refused.update(result or {})
+        print(f"✓ Sent to {len(batch) - len(result or {})} recipients at {batch[0]['email'].rsplit('@', 1)[-1]}")
+
+    sent_batches, failed_batches = send_engine.run(smtp_config['server'], rcpt_batches(recipients, batch_size),
+                                                   send_one, max_connections=max_connections)
+
+    sent, failed = [], []
+    for batch in sent_batches:
+        for recipient in batch:
+            if recipient['email'] in refused:
+                failed.append((recipient, smtplib.SMTPRecipientsRefused({recipient['email']: refused[recipient['email']]})))
+            else:
+                sent.append(recipient)
+    for batch, e in failed_batches:
+        replies = e.recipients if isinstance(e, smtplib.SMTPRecipientsRefused) else {}
+        for recipient in batch:
+            reply = replies.get(recipient['email'])
+            failed.append((recipient, smtplib.SMTPRecipientsRefused({recipient['email']: reply}) if reply else e))
+    return sent, failed
+
+def deliver(html_content: str, recipients: list, smtp_config: dict, campaign_name: str = 'newsletter',
+            max_connections: int = None, rcpt_batch_size: int = None,
+            per_recipient_unsubscribe: bool = None):
+    """Send final HTML to recipients; returns (sent recipients, [(recipient, error)]).
+
+    A template without placeholders is the same for everyone. If messages
+    do not need their own List-Unsubscribe link either, recipients are
+    grouped by domain and each group gets one message with up to
+    ``rcpt_batch_size`` RCPTs (``SMTP_RCPT_BATCH_SIZE`` by default).
+    Otherwise every recipient gets their own message.
+    """
+    # Parse the placeholders once for the whole campaign
+    template = compile_template(html_content)
     
-    # Check image-to-text ratio
-    text_content = soup.get_text()
-    images = soup.find_all('img')
-    image_count = len(images)
-    text_length = len(text_content)
+    # Serialize the invariant headers and MIME structure once per campaign
+    builder = CampaignMessageBuilder(smtp_config, campaign_name)
     
-    warnings = []
-    if image_count > 0 and text_length / image_count < 100:
-        warnings.append("High image-to-text ratio detected")
+    if per_recipient_unsubscribe is None:
+        per_recipient_unsubscribe = SMTP_PER_RECIPIENT_UNSUBSCRIBE
+    batch_size = rcpt_batch_size or SMTP_RCPT_BATCH_SIZE
     
-    # Check for common spam trigger words
-    spam_triggers = ['free', 'guarantee', 'no cost', 'winner', 'won', 'prize']
-    for trigger in spam_triggers:
-        if trigger in text_content.lower():
-            warnings.append(f"Potential spam trigger word found: {trigger}")
+    def send_one(recipient):
+        # Fill in the placeholders for this recipient
+        personalized_content = template.render(recipient_fields(recipient, smtp_config))
+        message = builder.build(recipient, personalized_content)
+        
+        # Send over a pooled, already-authenticated connection
+        smtp_pool.send(smtp_config, recipient['email'], message)
+        print(f"✓ Sent to {recipient['name']} <{recipient['email']}>")
     
-    return warnings
+    if template.is_static and not per_recipient_unsubscribe and batch_size > 1:
+        return _send_batched(html_content, builder, smtp_config, recipients, batch_size,
+                             max_connections=max_connections)
+    # Fan the recipients out over parallel SMTP sessions
+    return send_engine.run(smtp_config['server'], recipients, send_one, max_connections=max_connections)
 
-def send_email(content: str, recipients: list, smtp_config: dict, campaign_name: str = 'newsletter'):
-    """Send email to recipients using the provided SMTP configuration"""
+def send_email(content: str, recipients: list, smtp_config: dict, campaign_name: str = 'newsletter',
+               max_connections: int = None, run_key: str = None, rcpt_batch_size: int = None,
+               per_recipient_unsubscribe: bool = None, retry_transient: bool = None):
+    """Send email to recipients using the provided SMTP configuration.
+
+    Recipients are spread over up to ``max_connections`` parallel SMTP
+    sessions (``SMTP_MAX_CONNECTIONS`` by default). With a ``run_key`` the
+    outcomes are recorded in the send ledger, and addresses the run has
+    already delivered to are skipped, so retries never mail anyone twice.
+    See ``deliver`` for when recipients share a multi-RCPT message.
+
+    Transient failures (4xx replies, dropped connections) are handed to
+    the retry queue and returned in ``deferred_sends`` rather than
+    ``failed_sends``, unless ``retry_transient`` is False
+    (``SMTP_RETRY_TRANSIENT`` by default). Recipients at a domain that
+    recently signalled throttling are deferred without being attempted.
+    """
     try:
+        skipped_sends = 0
+        if run_key:
+            already = send_ledger.delivered(run_key, [r['email'] for r in recipients])
+            if already:
+                recipients = [r for r in recipients if r['email'] not in already]
+                skipped_sends = len(already)
+        
+
         # Create HTML template from content if not already HTML
         if not content.strip().startswith('<'):
             html_content = f"""
@@ -54,74 +141,51 @@ def send_email(content: str, recipients: list, smtp_config: dict, campaign_name:
         if warnings:
             print("Content warnings:", warnings)
         
-        successful_sends = 0
+        if retry_transient is None:
+            retry_transient = SMTP_RETRY_TRANSIENT
+        held = []
+        if retry_transient:
+            recipients, held = retry_queue.hold_throttled(recipients)
+        
+        sent, failed = deliver(html_content, recipients, smtp_config, campaign_name,
+                               max_connections=max_connections, rcpt_batch_size=rcpt_batch_size,
+                               per_recipient_unsubscribe=per_recipient_unsubscribe)
+        failed = list(failed) + held
+        
+        deferred_sends = []
+        if retry_transient and failed:
+            try:
+                failed, deferred_sends = retry_queue.defer(html_content, smtp_config, campaign_name,
+                                                           run_key, failed)
+            except Exception as e:
+                # Without a stored retry they are reported as failed
+                logger.error(f"Failed to queue retries for {len(failed)} recipients: {str(e)}")
+        for d in deferred_sends:
+            print(f"↻ Deferred {d['email']}: {d['error']}")
+        
+        successful_sends = len(sent)
         failed_sends = []
+        for recipient, e in failed:
+            failed_sends.append({
+                'email': recipient['email'],
+                'error': str(e),
+                'code': send_ledger.smtp_code(e)
+            })
+            print(f"✗ Failed to send to {recipient['email']}: {str(e)}")
         
-        for recipient in recipients:
+        if run_key:
             try:
-                # Create message container
-                msg = MIMEMultipart('alternative')
-                
-                # Format sender and recipient addresses
-                sender_addr = formataddr((smtp_config['name'], smtp_config['email']))
-                recipient_addr = formataddr((recipient['name'], recipient['email']))
-                domain = smtp_config['email'].split('@')[1]
-                
-                # Add headers
-                msg['Subject'] = 'Newsletter'
-                msg['From'] = sender_addr
-                msg['To'] = recipient_addr
-                msg['Date'] = formatdate(localtime=True)
-                msg['Message-ID'] = make_msgid(domain=domain)
-                
-                # Authentication headers
-                msg['Authentication-Results'] = f"spf=pass smtp.mailfrom={smtp_config['email']}"
-                
-                # List management headers
-                msg['List-Unsubscribe'] = f'<https://research.zirodelta.com/unsubscribe?email={recipient["email"]}>'
-                msg['List-ID'] = f'Zirodelta Research <newsletter.{domain}>'
-                msg['Precedence'] = 'bulk'
-                
-                # Additional headers
-                msg['X-Entity-Ref-ID'] = str(uuid.uuid4())
-                msg['X-Campaign-ID'] = f'{campaign_name}-{datetime.now().strftime("%Y%m")}'
-                msg['X-Message-Category'] = 'education'
-                
-                # Replace placeholders in content
-                personalized_content = html_content.replace('[[NAME]]', smtp_config['name'])
-                personalized_content = personalized_content.replace('[[RECIPIENT_NAME]]', recipient['name'])
-                personalized_content = personalized_content.replace('[[RECIPIENT_EMAIL]]', recipient['email'])
-                if recipient.get('organization'):
-                    personalized_content = personalized_content.replace('[[ORGANIZATION]]', recipient['organization'])
-                
-                # Add HTML content
-                msg.attach(MIMEText(personalized_content, 'html', 'utf-8'))
-                
-                # Create secure connection and send
-                if smtp_config['port'] == "465":
-                    server = smtplib.SMTP_SSL(smtp_config['server'], int(smtp_config['port']))
-                else:
-                    server = smtplib.SMTP(smtp_config['server'], int(smtp_config['port']))
-                    server.starttls()
-                
-                server.login(smtp_config['email'], smtp_config['password'])
-                server.sendmail(smtp_config['email'], recipient['email'], msg.as_string())
-                server.quit()
-                
-                successful_sends += 1
-                print(f"✓ Sent to {recipient['name']} <{recipient['email']}>")
-                
+                send_ledger.record(run_key, [r['email'] for r in sent], failed_sends, deferred_sends)
             except Exception as e:
-                failed_sends.append({
-                    'email': recipient['email'],
-                    'error': str(e)
-                })
-                print(f"✗ Failed to send to {recipient['email']}: {str(e)}")
+                # The mail is out either way; a lost entry only weakens retry dedup
+                logger.error(f"Failed to record {len(recipients)} sends for {run_key}: {str(e)}")
         
         return {
             'success': True,
             'successful_sends': successful_sends,
-            'failed_sends': failed_sends
+            'failed_sends': failed_sends,
+            'deferred_sends': deferred_sends,
+            'skipped_sends': skipped_sends
         }
         
     except Exception as e:
@@ -0,0 +1,49 @@
+import asyncio
+import functools
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict
+
+from metrics import QUEUE_DEPTH
+
+logger = logging.getLogger(__name__)
+
+# Worker counts for each blocking workload, overridable from the environment
+EXECUTOR_WORKERS = {
+    'llm': int(os.getenv('LLM_EXECUTOR_WORKERS', '16')),
+    'smtp': int(os.getenv('SMTP_EXECUTOR_WORKERS', '8')),
+    'db': int(os.getenv('DB_EXECUTOR_WORKERS', '8')),
+    'default': int(os.getenv('DEFAULT_EXECUTOR_WORKERS', '8')),
+}
+
+_executors: Dict[str, ThreadPoolExecutor] = {}
+
+
+def get_executor(pool: str = 'default') -> ThreadPoolExecutor:
+    """Return the bounded executor for a workload, creating it on first use"""
+    if pool not in _executors:
+        _executors[pool] = ThreadPoolExecutor(
+            max_workers=EXECUTOR_WORKERS.get(pool, EXECUTOR_WORKERS['default']),
+            thread_name_prefix=f'{pool}-worker'
+        )
+        # Calls submitted but not yet picked up by a worker
+        QUEUE_DEPTH.set_function(_executors[pool]._work_queue.qsize, f'executor_{pool}')
+    return _executors[pool]
+
+
+async def run_blocking(func: Callable, *args, pool: str = 'default', **kwargs):
+    """Run a blocking call on a bounded executor so the event loop stays free.
+
+    Each workload gets its own pool, so a burst of slow LLM calls cannot
+    starve SMTP sends and vice versa.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_executor(pool), functools.partial(func, *args, **kwargs))
+
+
+def shutdown_executors(wait: bool = True):
+    """Shut down every executor that has been created"""
+    for pool, executor in list(_executors.items()):
+        executor.shutdown(wait=wait)
+        del _executors[pool]
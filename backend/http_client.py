@@ -0,0 +1,79 @@
+import os
+from typing import Any, Dict
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Timeouts in seconds; the read timeout applies between bytes, so streams stay open
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', '5'))
+HTTP_READ_TIMEOUT = float(os.getenv('HTTP_READ_TIMEOUT', '120'))
+# Number of hosts to keep pools for, and connections kept open per host
+HTTP_POOL_HOSTS = int(os.getenv('HTTP_POOL_HOSTS', '10'))
+HTTP_POOL_MAXSIZE = int(os.getenv('HTTP_POOL_MAXSIZE', '16'))
+
+
+class PooledHTTPClient:
+    """Shared keep-alive HTTP session for the LLM providers and Ollama.
+
+    Each host gets at most ``pool_maxsize`` open connections. When they are
+    all busy, further requests wait for one to be returned instead of
+    opening more. Every request gets default connect and read timeouts, so
+    a hung upstream cannot pin a worker forever.
+    """
+
+    def __init__(self, connect_timeout: float = HTTP_CONNECT_TIMEOUT,
+                 read_timeout: float = HTTP_READ_TIMEOUT,
+                 pool_hosts: int = HTTP_POOL_HOSTS,
+                 pool_maxsize: int = HTTP_POOL_MAXSIZE):
+        self.timeout = (connect_timeout, read_timeout)
+        self.adapter = HTTPAdapter(pool_connections=pool_hosts, pool_maxsize=pool_maxsize, pool_block=True)
+        self.session = requests.Session()
+        self.session.mount('http://', self.adapter)
+        self.session.mount('https://', self.adapter)
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.request(method, url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request('POST', url, **kwargs)
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request('GET', url, **kwargs)
+
+    def stats(self) -> Dict[str, Any]:
+        """Pool hit/miss counters per host.
+
+        A miss is a request that had to open a new connection; every other
+        request reused a kept-alive one.
+        """
+        hosts = {}
+        pools = self.adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            requests_made = pool.num_requests
+            misses = pool.num_connections
+            hosts[f"{pool.scheme}://{pool.host}:{pool.port}"] = {
+                "requests": requests_made,
+                "hits": requests_made - misses,
+                "misses": misses
+            }
+
+        total_requests = sum(h["requests"] for h in hosts.values())
+        total_misses = sum(h["misses"] for h in hosts.values())
+        return {
+            "hosts": hosts,
+            "requests": total_requests,
+            "hits": total_requests - total_misses,
+            "misses": total_misses,
+            "hit_ratio": round((total_requests - total_misses) / total_requests, 4) if total_requests else None
+        }
+
+    def close(self):
+        self.session.close()
+
+
+# Shared client used for every outbound LLM call
+http_client = PooledHTTPClient()
@@ -0,0 +1,456 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from http_client import http_client
+from metrics import record_llm_call
+
+logger = logging.getLogger(__name__)
+
+# Override to point at a proxy or a local stand-in
+XAI_CHAT_URL = os.getenv('XAI_API_URL', "https://api.x.ai/v1/chat/completions")
+
+# Consecutive failures that open a provider's circuit, and how long it stays open
+AI_BREAKER_FAILURES = int(os.getenv('AI_BREAKER_FAILURES', '3'))
+AI_BREAKER_RESET = float(os.getenv('AI_BREAKER_RESET', '30'))
+# Seconds after which a half-open trial that never reported back lets another one through
+AI_BREAKER_TRIAL_TIMEOUT = float(os.getenv('AI_BREAKER_TRIAL_TIMEOUT', '120'))
+# Fire a second provider when the first is slower than its p95
+AI_HEDGE_REQUESTS = os.getenv('AI_HEDGE_REQUESTS', 'false').lower() == 'true'
+# Hedge delay in seconds until enough latency samples exist for a p95
+AI_HEDGE_DELAY = float(os.getenv('AI_HEDGE_DELAY', '10'))
+# Threads for hedged requests; unused when hedging is off
+AI_HEDGE_WORKERS = int(os.getenv('AI_HEDGE_WORKERS', '16'))
+AI_HEDGE_MIN_SAMPLES = 20
+EWMA_ALPHA = 0.2
+
+
+class CircuitBreaker:
+    """Closed -> open after repeated failures -> half-open trial -> closed.
+
+    While open, the provider is skipped. Once ``reset_timeout`` has passed,
+    a single trial request goes through. Its outcome closes the circuit
+    again or re-opens it. A trial that is abandoned, or that has not
+    reported back within ``trial_timeout``, frees the slot for another.
+    """
+
+    def __init__(self, failure_threshold: int = AI_BREAKER_FAILURES, reset_timeout: float = AI_BREAKER_RESET,
+                 trial_timeout: float = AI_BREAKER_TRIAL_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.trial_timeout = trial_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self._trial_in_flight = False
+        self._trial_started = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = "half_open"
+                self._trial_in_flight = False
+            if self.state == "half_open" and self._trial_in_flight \
+                    and time.monotonic() - self._trial_started >= self.trial_timeout:
+                self._trial_in_flight = False
+            if self.state == "half_open" and not self._trial_in_flight:
+                self._trial_in_flight = True
+                self._trial_started = time.monotonic()
+                return True
+            return False
+
+    def release(self):
+        """End a request without an outcome, e.g. a stream the client closed"""
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record_success(self):
+        with self._lock:
+            self.state = "closed"
+            self.failures = 0
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial_in_flight = False
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+    def trip(self):
+        """Open the circuit now, e.g. after a failed key check"""
+        with self._lock:
+            self.failures = max(self.failures + 1, self.failure_threshold)
+            self._trial_in_flight = False
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+
+class ProviderStats:
+    """EWMA latency and error rate plus a window of recent latencies for p95"""
+
+    def __init__(self, window: int = 200):
+        self.ewma_latency: Optional[float] = None
+        self.ewma_error = 0.0
+        self.samples = deque(maxlen=window)
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def record(self, latency: float, ok: bool):
+        with self._lock:
+            self.calls += 1
+            self.ewma_error = EWMA_ALPHA * (0.0 if ok else 1.0) + (1 - EWMA_ALPHA) * self.ewma_error
+            if ok:
+                self.samples.append(latency)
+                if self.ewma_latency is None:
+                    self.ewma_latency = latency
+                else:
+                    self.ewma_latency = EWMA_ALPHA * latency + (1 - EWMA_ALPHA) * self.ewma_latency
+
+    def p95(self) -> Optional[float]:
+        with self._lock:
+            if len(self.samples) < AI_HEDGE_MIN_SAMPLES:
+                return None
+            ordered = sorted(self.samples)
+        return ordered[int(0.95 * (len(ordered) - 1))]
+
+
+class ProviderAdapter:
+    """Uniform completion and streaming interface over one provider"""
+
+    name = ""
+
+    def __init__(self, service):
+        self.service = service
+
+    @property
+    def model(self) -> str:
+        raise NotImplementedError
+
+    def available(self) -> bool:
+        """Whether the provider can be called at all; health is the breaker's job"""
+        return True
+
+    def complete(self, messages: List[Dict[str, str]], system_prompt: str) -> Dict[str, Any]:
+        """Return {"message": text, "usage": {...}}"""
+        raise NotImplementedError
+
+    def stream(self, messages: List[Dict[str, str]], system_prompt: str) -> Iterator[Tuple[Optional[str], Optional[dict]]]:
+        """Yield (text, usage) pairs"""
+        raise NotImplementedError
+
+
+class XAIAdapter(ProviderAdapter):
+    name = "xai"
+
+    @property
+    def model(self) -> str:
+        return self.service.xai_model
+
+    def available(self) -> bool:
+        return bool(self.service.xai_api_key)
+
+    def _request(self, messages, system_prompt, stream: bool) -> dict:
+        return {
+            "headers": {
+                "Content-Type": "application/json",
+                "Authorization": f"Bearer {self.service.xai_api_key}"
+            },
+            "json": {
+                "messages": [{"role": "system", "content": system_prompt}] + messages,
+                "model": self.model,
+                "stream": stream,
+                "temperature": self.service.temperature
+            }
+        }
+
+    def complete(self, messages, system_prompt):
+        response = http_client.post(XAI_CHAT_URL, **self._request(messages, system_prompt, False))
+        response.raise_for_status()
+        response_data = response.json()
+        return {
+            "message": response_data["choices"][0]["message"]["content"],
+            "usage": response_data.get("usage", {})
+        }
+
+    def stream(self, messages, system_prompt):
+        with http_client.post(XAI_CHAT_URL, stream=True, **self._request(messages, system_prompt, True)) as response:
+            response.raise_for_status()
+            for line in response.iter_lines():
+                line = line.decode("utf-8")
+                if not line.startswith("data:"):
+                    continue
+                payload = line[len("data:"):].strip()
+                if payload == "[DONE]":
+                    break
+                event = json.loads(payload)
+                choices = event.get("choices") or [{}]
+                yield choices[0].get("delta", {}).get("content"), event.get("usage")
+
+
+class AnthropicAdapter(ProviderAdapter):
+    name = "anthropic"
+
+    @property
+    def model(self) -> str:
+        return self.service.anthropic_model
+
+    def available(self) -> bool:
+        return self.service.anthropic_client is not None
+
+    def complete(self, messages, system_prompt):
+        response = self.service.anthropic_client.messages.create(
+            model=self.model,
+            system=system_prompt,
+            messages=messages,
+            max_tokens=self.service.max_tokens,
+            temperature=self.service.temperature
+        )
+        return {
+            "message": response.content[0].text,
+            "usage": {
+                "input_tokens": response.usage.input_tokens,
+                "output_tokens": response.usage.output_tokens
+            }
+        }
+
+    def stream(self, messages, system_prompt):
+        with self.service.anthropic_client.messages.stream(
+            model=self.model,
+            system=system_prompt,
+            messages=messages,
+            max_tokens=self.service.max_tokens,
+            temperature=self.service.temperature
+        ) as stream:
+            for text in stream.text_stream:
+                yield text, None
+            final = stream.get_final_message()
+            yield None, {
+                "input_tokens": final.usage.input_tokens,
+                "output_tokens": final.usage.output_tokens
+            }
+
+
+class OpenAIAdapter(ProviderAdapter):
+    name = "openai"
+
+    @property
+    def model(self) -> str:
+        return self.service.openai_model
+
+    def available(self) -> bool:
+        return self.service.openai_client is not None
+
+    def _messages(self, messages, system_prompt):
+        return [{"role": "system", "content": system_prompt}] + [
+            {"role": msg["role"], "content": msg["content"]} for msg in messages
+        ]
+
+    def complete(self, messages, system_prompt):
+        response = self.service.openai_client.chat.completions.create(
+            model=self.model,
+            messages=self._messages(messages, system_prompt),
+            max_tokens=self.service.max_tokens,
+            temperature=self.service.temperature
+        )
+        return {
+            "message": response.choices[0].message.content,
+            "usage": {
+                "total_tokens": response.usage.total_tokens,
+                "completion_tokens": response.usage.completion_tokens,
+                "prompt_tokens": response.usage.prompt_tokens
+            }
+        }
+
+    def stream(self, messages, system_prompt):
+        stream = self.service.openai_client.chat.completions.create(
+            model=self.model,
+            messages=self._messages(messages, system_prompt),
+            max_tokens=self.service.max_tokens,
+            temperature=self.service.temperature,
+            stream=True
+        )
+        for chunk in stream:
+            if chunk.choices:
+                yield chunk.choices[0].delta.content, None
+
+
+class LLMRouter:
+    """Routes requests across provider adapters.
+
+    Providers are tried in priority order. Those with an open circuit are
+    skipped, and those with a high recent error rate are moved to the back.
+    Failures only affect the failing provider's breaker and stats; the
+    configured priority itself never changes. With hedging enabled, a
+    second provider is started when the first has not answered within its
+    p95 latency. The first successful answer wins.
+    """
+
+    def __init__(self, adapters: List[ProviderAdapter], hedge: bool = AI_HEDGE_REQUESTS,
+                 hedge_delay: float = AI_HEDGE_DELAY, hedge_workers: int = AI_HEDGE_WORKERS):
+        self.adapters = adapters
+        self.hedge = hedge
+        self.hedge_delay = hedge_delay
+        self.breakers = {a.name: CircuitBreaker() for a in adapters}
+        self.stats = {a.name: ProviderStats() for a in adapters}
+        # Only hedged requests need a second thread; the rest run on the caller's
+        self._executor = ThreadPoolExecutor(max_workers=hedge_workers, thread_name_prefix='llm-hedge') if hedge else None
+
+    def candidates(self) -> List[ProviderAdapter]:
+        """Available providers in the order they should be tried"""
+        ready = [a for a in self.adapters if a.available()]
+        return sorted(ready, key=lambda a: self.stats[a.name].ewma_error > 0.5)
+
+    def _call(self, adapter: ProviderAdapter, messages, system_prompt) -> Dict[str, Any]:
+        start = time.monotonic()
+        try:
+            result = adapter.complete(messages, system_prompt)
+        except Exception:
+            elapsed = time.monotonic() - start
+            self.stats[adapter.name].record(elapsed, ok=False)
+            self.breakers[adapter.name].record_failure()
+            record_llm_call(adapter.name, adapter.model, elapsed, ok=False)
+            raise
+        elapsed = time.monotonic() - start
+        self.stats[adapter.name].record(elapsed, ok=True)
+        self.breakers[adapter.name].record_success()
+        record_llm_call(adapter.name, adapter.model, elapsed, usage=result.get("usage"))
+        return {**result, "provider": adapter.name, "model": adapter.model}
+
+    def _hedge_delay(self, adapter: ProviderAdapter) -> float:
+        return self.stats[adapter.name].p95() or self.hedge_delay
+
+    def complete(self, messages: List[Dict[str, str]], system_prompt: str) -> Dict[str, Any]:
+        """Return the first successful completion, raising if every provider fails"""
+        queue = [a for a in self.candidates()]
+        if not queue:
+            raise Exception("No AI provider is available")
+
+        last_error = None
+        if not self.hedge:
+            for adapter in queue:
+                if not self.breakers[adapter.name].allow():
+                    continue
+                try:
+                    return self._call(adapter, messages, system_prompt)
+                except Exception as e:
+                    logger.error(f"{adapter.name} API error: {str(e)}")
+                    last_error = e
+            raise last_error or Exception("All AI providers failed to generate a response")
+
+        pending = {}
+        while queue or pending:
+            # Start the next provider whose circuit lets a request through
+            while queue and not pending:
+                adapter = queue.pop(0)
+                if self.breakers[adapter.name].allow():
+                    pending[self._executor.submit(self._call, adapter, messages, system_prompt)] = adapter
+            if not pending:
+                break
+
+            timeout = None
+            if self.hedge and queue and len(pending) == 1:
+                timeout = self._hedge_delay(next(iter(pending.values())))
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+
+            if not done:
+                # The primary is slower than usual: hedge with the next provider
+                while queue:
+                    adapter = queue.pop(0)
+                    if self.breakers[adapter.name].allow():
+                        logger.info(f"Hedging AI request with {adapter.name}")
+                        pending[self._executor.submit(self._call, adapter, messages, system_prompt)] = adapter
+                        break
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                adapter = pending.pop(future)
+                try:
+                    return future.result()
+                except Exception as e:
+                    logger.error(f"{adapter.name} API error: {str(e)}")
+                    last_error = e
+
+        raise last_error or Exception("All AI providers failed to generate a response")
+
+    def stream(self, messages: List[Dict[str, str]], system_prompt: str) -> Iterator[Dict[str, Any]]:
+        """Stream tokens from the first provider that works.
+
+        Falls back to the next provider only while no token has been sent.
+        Ends with a ``done`` or ``error`` event.
+        """
+        last_error = None
+        for adapter in self.candidates():
+            breaker = self.breakers[adapter.name]
+            if not breaker.allow():
+                continue
+
+            start = time.monotonic()
+            chunks = []
+            usage = {}
+            finished = False
+            try:
+                for text, chunk_usage in adapter.stream(messages, system_prompt):
+                    if chunk_usage:
+                        usage = chunk_usage
+                    if text:
+                        chunks.append(text)
+                        yield {"type": "token", "content": text}
+                finished = True
+            except Exception as e:
+                finished = True
+                logger.error(f"{adapter.name} streaming error: {str(e)}")
+                elapsed = time.monotonic() - start
+                self.stats[adapter.name].record(elapsed, ok=False)
+                breaker.record_failure()
+                record_llm_call(adapter.name, adapter.model, elapsed, ok=False)
+                last_error = e
+                if chunks:
+                    # Tokens already reached the client, so we cannot switch providers
+                    break
+                continue
+            finally:
+                if not finished:
+                    # The client went away mid-stream: say nothing about the provider's health
+                    breaker.release()
+
+            elapsed = time.monotonic() - start
+            self.stats[adapter.name].record(elapsed, ok=True)
+            breaker.record_success()
+            record_llm_call(adapter.name, adapter.model, elapsed, usage=usage)
+            yield {
+                "type": "done",
+                "message": "".join(chunks),
+                "provider": adapter.name,
+                "model": adapter.model,
+                "usage": usage
+            }
+            return
+
+        yield {
+            "type": "error",
+            "error": str(last_error) if last_error else "All AI providers failed to generate a response",
+            "message": "An error occurred while generating the AI response. Please try again later."
+        }
+
+    def status(self) -> Dict[str, Any]:
+        """Breaker state and latency/error tracking for each provider"""
+        return {
+            a.name: {
+                "circuit": self.breakers[a.name].state,
+                "ewma_latency_s": round(self.stats[a.name].ewma_latency, 3) if self.stats[a.name].ewma_latency else None,
+                "ewma_error_rate": round(self.stats[a.name].ewma_error, 3),
+                "p95_latency_s": self.stats[a.name].p95(),
+                "calls": self.stats[a.name].calls
+            }
+            for a in self.adapters
+        }
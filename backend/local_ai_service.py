@@ -1,17 +1,30 @@
-from fastapi import FastAPI, HTTPException # type: ignore
+from fastapi import Depends, FastAPI, HTTPException, Query, Response # type: ignore
 from fastapi.middleware.cors import CORSMiddleware  # type: ignore
+from fastapi.responses import PlainTextResponse, StreamingResponse  # type: ignore
 from pydantic import BaseModel # type: ignore
 from typing import List, Optional, Dict, Any
 import requests
 import json
 import re
+import base64
+import random
+import time
 from datetime import datetime
+from sqlalchemy import and_, delete, func, or_, select # type: ignore
+from sqlalchemy.ext.asyncio import AsyncSession # type: ignore
 from sqlalchemy.orm import Session, sessionmaker # type: ignore
-from models import ChatSession, ChatMessage, engine
+from models import ChatSession, ChatMessage, ChatSummary, engine
+from database import get_db, dispose_async_engine, serialized_writes
+from chat_buffer import chat_buffer
+from chat_context import build_context
 import logging
 import uvicorn # type: ignore
 import os
 from dotenv import load_dotenv # type: ignore
+from executors import run_blocking, shutdown_executors
+from http_client import http_client
+from response_cache import response_cache, make_cache_key
+import metrics
 
 # Load environment variables
 env_file = os.getenv('ENV_FILE', '.env')
@@ -24,6 +37,9 @@ logging.basicConfig(level=logging.INFO)
 
 # Ollama API Configuration
 OLLAMA_API = os.getenv('OLLAMA_API_URL', 'http://localhost:11434/api/chat')
+OLLAMA_MODEL = 'mistral'
+# Share of chat requests whose full Ollama payload is logged at DEBUG level
+PAYLOAD_LOG_SAMPLE_RATE = float(os.getenv('PAYLOAD_LOG_SAMPLE_RATE', '0.01'))
 DEFAULT_SYSTEM_PROMPT = """You are Boon, an AI email styling expert who helps people create beautifully designed emails that make great first impressions. Your personality is friendly and conversational, but also professional.
 
 Follow these principles:
@@ -86,9 +102,34 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
-    expose_headers=["Content-Type", "Authorization"]
+    expose_headers=["Content-Type", "Authorization", "X-Next-Cursor"]
 )
 
+@app.on_event("shutdown")
+async def stop_executors():
+    """Release pooled connections and worker threads when the service stops"""
+    # Write any chat messages still in the buffer
+    await run_blocking(chat_buffer.stop)
+    http_client.close()
+    await dispose_async_engine()
+    shutdown_executors(wait=False)
+
+@app.get("/health")
+async def health():
+    """Report service liveness and Ollama connection pool usage"""
+    return {"status": "ok", "http_pool": http_client.stats()}
+
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheus metrics: LLM latency and tokens, DB query time and queue depths"""
+    # Some gauges query the database, so render off the loop
+    return PlainTextResponse(await run_blocking(metrics.render), media_type=metrics.CONTENT_TYPE)
+
+def log_payload(messages: List[Dict[str, str]]):
+    """Log the full model payload for a sample of requests, only when DEBUG is on"""
+    if logger.isEnabledFor(logging.DEBUG) and random.random() < PAYLOAD_LOG_SAMPLE_RATE:
+        logger.debug(f"Request payload: {json.dumps({'model': OLLAMA_MODEL, 'messages': messages})}")
+
 class ChatMessageModel(BaseModel):
     role: str
     content: str
@@ -246,212 +287,330 @@ def format_chat_response(response_text: str, email_type: str = "professional") -
     }
 
 @app.post("/chat-sessions")
-async def create_chat_session(session_data: ChatSessionCreate):
+async def create_chat_session(session_data: ChatSessionCreate, db: AsyncSession = Depends(get_db)):
     """Create a new chat session."""
     try:
-        db = SessionLocal()
         session = ChatSession(
             name=session_data.name,
             email_type=session_data.email_type
         )
-        db.add(session)
-        db.commit()
+        async with serialized_writes():
+            db.add(session)
+            await db.commit()
         return {"id": session.id, "name": session.name}
     except Exception as e:
         logger.error(f"Error creating chat session: {str(e)}")
         raise HTTPException(status_code=500, detail="Failed to create chat session")
-    finally:
-        db.close()
 
-@app.get("/chat-sessions")
-async def list_chat_sessions():
-    """List all chat sessions"""
-    db = SessionLocal()
+# Page sizes for the session and message listings
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+
+def encode_message_cursor(msg: ChatMessage) -> str:
+    """Opaque cursor pointing just before a message in (timestamp, id) order"""
+    raw = json.dumps([msg.timestamp.isoformat() if msg.timestamp else None, msg.id])
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+def decode_message_cursor(cursor: str):
     try:
-        sessions = db.query(ChatSession).all()
-        return [{
-            "id": session.id,
-            "name": session.name,
-            "email_type": session.email_type,
-            "created_at": session.created_at,
-            "message_count": len(session.messages)
-        } for session in sessions]
-    finally:
-        db.close()
+        timestamp, message_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return (datetime.fromisoformat(timestamp) if timestamp else None), int(message_id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+@app.get("/chat-sessions")
+async def list_chat_sessions(response: Response,
+                             cursor: Optional[int] = None,
+                             limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+                             db: AsyncSession = Depends(get_db)):
+    """List chat sessions, newest first, one page at a time.
+    
+    Pass the ``X-Next-Cursor`` response header back as ``cursor`` to get
+    the next (older) page; the header is absent on the last page.
+    """
+    query = select(ChatSession)
+    if cursor is not None:
+        query = query.where(ChatSession.id < cursor)
+    pending_counts = chat_buffer.pending_counts()
+    sessions = (await db.scalars(query.order_by(ChatSession.id.desc()).limit(limit + 1))).all()
+    
+    if len(sessions) > limit:
+        sessions = sessions[:limit]
+        response.headers["X-Next-Cursor"] = str(sessions[-1].id)
+    
+    # Count messages for this page only
+    message_counts = dict((await db.execute(
+        select(ChatMessage.session_id, func.count(ChatMessage.id))
+        .where(ChatMessage.session_id.in_([session.id for session in sessions]))
+        .group_by(ChatMessage.session_id)
+    )).all()) if sessions else {}
+    
+    return [{
+        "id": session.id,
+        "name": session.name,
+        "email_type": session.email_type,
+        "created_at": session.created_at,
+        "message_count": message_counts.get(session.id, 0) + pending_counts.get(session.id, 0)
+    } for session in sessions]
 
 @app.get("/chat-sessions/{session_id}/messages")
-async def get_chat_messages(session_id: int):
-    """Get all messages for a chat session"""
-    db = SessionLocal()
-    try:
-        session = db.query(ChatSession).filter(ChatSession.id == session_id).first()
-        if not session:
-            raise HTTPException(status_code=404, detail="Chat session not found")
-        return [{
-            "role": msg.role,
-            "content": msg.content,
-            "timestamp": msg.timestamp
-        } for msg in session.messages]
-    finally:
-        db.close()
+async def get_chat_messages(session_id: int,
+                            response: Response,
+                            cursor: Optional[str] = None,
+                            limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+                            db: AsyncSession = Depends(get_db)):
+    """Get the most recent messages of a chat session, oldest first.
+    
+    When older messages exist, the ``X-Next-Cursor`` response header holds
+    a cursor; pass it back as ``cursor`` to get the page before this one.
+    """
+    if await db.get(ChatSession, session_id) is None:
+        raise HTTPException(status_code=404, detail="Chat session not found")
+    
+    # Snapshot unwritten messages first so a concurrent flush cannot hide them
+    pending = [] if cursor else chat_buffer.pending(session_id)
+    
+    query = select(ChatMessage).where(ChatMessage.session_id == session_id)
+    if cursor:
+        timestamp, message_id = decode_message_cursor(cursor)
+        query = query.where(or_(
+            ChatMessage.timestamp < timestamp,
+            and_(ChatMessage.timestamp == timestamp, ChatMessage.id < message_id)
+        ))
+    messages = list((await db.scalars(
+        query.order_by(ChatMessage.timestamp.desc(), ChatMessage.id.desc()).limit(limit + 1)
+    )).all())
+    
+    if len(messages) > limit:
+        messages = messages[:limit]
+        response.headers["X-Next-Cursor"] = encode_message_cursor(messages[-1])
+    messages.reverse()
+    # The newest page also includes messages still waiting in the write buffer
+    messages = chat_buffer.merge(messages, pending)
+    
+    return [{
+        "role": msg.role,
+        "content": msg.content,
+        "timestamp": msg.timestamp
+    } for msg in messages]
 
 @app.delete("/chat-sessions/{session_id}")
-async def delete_chat_session(session_id: int):
+async def delete_chat_session(session_id: int, db: AsyncSession = Depends(get_db)):
     """Delete a chat session and all its messages"""
-    db = SessionLocal()
-    try:
-        session = db.query(ChatSession).filter(ChatSession.id == session_id).first()
-        if not session:
-            raise HTTPException(status_code=404, detail="Chat session not found")
-        db.delete(session)
+    session = await db.get(ChatSession, session_id)
+    if not session:
+        raise HTTPException(status_code=404, detail="Chat session not found")
+    chat_buffer.discard(session_id)
+    # Bulk deletes instead of loading every message just to cascade
+    async with serialized_writes():
+        await db.execute(delete(ChatMessage).where(ChatMessage.session_id == session_id))
+        await db.execute(delete(ChatSummary).where(ChatSummary.session_id == session_id))
+        await db.delete(session)
+        await db.commit()
+    return {"status": "success", "message": "Chat session deleted"}
+
+def prepare_chat_messages(db: Session, request: ChatRequest) -> List[Dict[str, str]]:
+    """Build the Ollama message list for a chat turn and queue the user message for storage.
+    
+    Creates a session when the request has none and sets ``request.session_id``.
+    """
+    if not request.session_id:
+        # Create a new session if none provided
+        session = ChatSession(
+            name=f"Chat {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}",
+            email_type=request.email_type or "professional"
+        )
+        db.add(session)
         db.commit()
-        return {"status": "success", "message": "Chat session deleted"}
-    finally:
-        db.close()
+        request.session_id = session.id
+    
+    # Recent turns verbatim, older ones as a rolling summary, all within the token budget.
+    # Context from the request is added after the stored history.
+    messages = build_context(
+        db,
+        request.session_id,
+        request.system_prompt or DEFAULT_SYSTEM_PROMPT,
+        extra=[{"role": msg.role, "content": msg.content} for msg in request.context or []],
+        prompt=request.prompt
+    )
+    
+    # Written in the background with other turns' messages, in order
+    chat_buffer.add(request.session_id, "user", request.prompt)
+    
+    return messages
 
 @app.post("/ai/chat")
-async def chat_with_ai(request: ChatRequest):
+async def chat_with_ai(request: ChatRequest, db: AsyncSession = Depends(get_db)):
     """Handle chat requests with AI."""
     try:
-        # Initialize messages with system prompt
-        messages = [
-            {
-                "role": "system",
-                "content": request.system_prompt or DEFAULT_SYSTEM_PROMPT
-            }
-        ]
+        # Build the context in one run_sync call; its queries never run on the event loop
+        messages = await db.run_sync(prepare_chat_messages, request)
+        # Return the connection to the pool instead of holding it during the model call
+        await db.close()
         
-        # Get existing conversation from database if session_id is provided
-        db = SessionLocal()
+        # Make request to Ollama API
         try:
-            if not request.session_id:
-                # Create a new session if none provided
-                session = ChatSession(
-                    name=f"Chat {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}",
-                    email_type=request.email_type or "professional"
-                )
-                db.add(session)
-                db.commit()
-                request.session_id = session.id
+            logger.info(f"Sending request to Ollama API with {len(messages)} messages in context")
+            log_payload(messages)
             
-            # Get existing messages for the session
-            existing_messages = (
-                db.query(ChatMessage)
-                .filter(ChatMessage.session_id == request.session_id)
-                .order_by(ChatMessage.timestamp)
-                .all()
+            start = time.perf_counter()
+            response = await run_blocking(
+                http_client.post,
+                OLLAMA_API,
+                pool='llm',
+                json={
+                    "model": OLLAMA_MODEL,
+                    "messages": messages,
+                    "stream": False
+                }
             )
             
-            # Add existing conversation to messages
-            for msg in existing_messages:
-                messages.append({
-                    "role": msg.role,
-                    "content": msg.content
-                })
+            if response.status_code != 200:
+                metrics.record_llm_call('ollama', OLLAMA_MODEL, time.perf_counter() - start, ok=False)
+                logger.error(f"Ollama API error: {response.text}")
+                raise HTTPException(status_code=500, detail="Failed to get response from AI")
             
-            # Add current context if provided (overrides database context)
-            if request.context:
-                messages.extend([{
-                    "role": msg.role,
-                    "content": msg.content
-                } for msg in request.context])
+            response_data = response.json()
+            metrics.record_llm_call('ollama', OLLAMA_MODEL, time.perf_counter() - start, usage=response_data)
+            response_text = response_data.get("message", {}).get("content", "")
             
-            # Add the current prompt
-            current_message = {
-                "role": "user",
-                "content": request.prompt
-            }
-            messages.append(current_message)
+            if not response_text:
+                logger.error("Empty response from AI")
+                raise HTTPException(status_code=500, detail="Empty response from AI")
             
-            # Store user message immediately
-            user_message = ChatMessage(
-                session_id=request.session_id,
-                role="user",
-                content=request.prompt,
-                timestamp=datetime.now()
-            )
-            db.add(user_message)
-            db.commit()
+            # Store AI response without waiting for the commit
+            chat_buffer.add(request.session_id, "assistant", response_text)
+            
+            # Format the response based on content type
+            formatted_response = format_chat_response(response_text, request.email_type)
             
-            # Make request to Ollama API
-            try:
-                logger.info(f"Sending request to Ollama API with {len(messages)} messages in context")
-                logger.info(f"Request payload: {json.dumps({'model': 'mistral', 'messages': messages})}")
-                
-                response = requests.post(
-                    OLLAMA_API,
-                    json={
-                        "model": "mistral",
-                        "messages": messages,
-                        "stream": False
-                    }
-                )
-                
-                if response.status_code != 200:
-                    logger.error(f"Ollama API error: {response.text}")
-                    raise HTTPException(status_code=500, detail="Failed to get response from AI")
-                
-                response_data = response.json()
-                response_text = response_data.get("message", {}).get("content", "")
-                
-                if not response_text:
-                    logger.error("Empty response from AI")
-                    raise HTTPException(status_code=500, detail="Empty response from AI")
-                
-                # Store AI response
-                ai_message = ChatMessage(
-                    session_id=request.session_id,
-                    role="assistant",
-                    content=response_text,
-                    timestamp=datetime.now()
-                )
-                db.add(ai_message)
-                db.commit()
-                
-                # Format the response based on content type
-                formatted_response = format_chat_response(response_text, request.email_type)
-                
-                # Include session_id in response
-                formatted_response["session_id"] = request.session_id
-                return formatted_response
-                
-            except requests.exceptions.RequestException as e:
-                logger.error(f"Error calling Ollama API: {str(e)}")
-                raise HTTPException(status_code=500, detail="Failed to communicate with AI service")
-        finally:
-            db.close()
+            # Include session_id in response
+            formatted_response["session_id"] = request.session_id
+            return formatted_response
+            
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Error calling Ollama API: {str(e)}")
+            raise HTTPException(status_code=500, detail="Failed to communicate with AI service")
             
     except Exception as e:
         logger.error(f"Error in chat endpoint: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+def stream_chat_events(request: ChatRequest, messages: List[Dict[str, str]]):
+    """Forward Ollama tokens as NDJSON events, then persist and format the reply"""
+    def event(payload: Dict[str, Any]) -> str:
+        return json.dumps(payload, default=str) + "\n"
+    
+    yield event({"type": "start", "session_id": request.session_id})
+    
+    chunks = []
+    log_payload(messages)
+    start = time.perf_counter()
+    try:
+        with http_client.post(
+            OLLAMA_API,
+            json={
+                "model": OLLAMA_MODEL,
+                "messages": messages,
+                "stream": True
+            },
+            stream=True
+        ) as response:
+            if response.status_code != 200:
+                metrics.record_llm_call('ollama', OLLAMA_MODEL, time.perf_counter() - start, ok=False)
+                logger.error(f"Ollama API error: {response.text}")
+                yield event({"type": "error", "message": handle_ollama_error(response.text)})
+                return
+            
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                data = json.loads(line)
+                if data.get("error"):
+                    raise RuntimeError(data["error"])
+                text = data.get("message", {}).get("content", "")
+                if text:
+                    chunks.append(text)
+                    yield event({"type": "token", "content": text})
+                if data.get("done"):
+                    # The final chunk carries the token counts
+                    metrics.record_llm_call('ollama', OLLAMA_MODEL, time.perf_counter() - start, usage=data)
+                    break
+    except Exception as e:
+        metrics.record_llm_call('ollama', OLLAMA_MODEL, time.perf_counter() - start, ok=False)
+        logger.error(f"Error streaming from Ollama API: {str(e)}")
+        yield event({"type": "error", "message": handle_ollama_error(str(e))})
+        return
+    
+    response_text = "".join(chunks)
+    if not response_text:
+        logger.error("Empty response from AI")
+        yield event({"type": "error", "message": "Empty response from AI"})
+        return
+    
+    chat_buffer.add(request.session_id, "assistant", response_text)
+    
+    formatted_response = format_chat_response(response_text, request.email_type)
+    formatted_response["session_id"] = request.session_id
+    yield event({"type": "done", "response": formatted_response})
+
+@app.post("/ai/chat/stream")
+async def stream_chat_with_ai(request: ChatRequest, db: AsyncSession = Depends(get_db)):
+    """Handle chat requests with AI, streaming tokens as they are generated."""
+    try:
+        messages = await db.run_sync(prepare_chat_messages, request)
+        await db.close()
+    except Exception as e:
+        logger.error(f"Error in chat stream endpoint: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+    
+    # The sync generator is iterated on a worker thread, so the loop stays free
+    return StreamingResponse(
+        stream_chat_events(request, messages),
+        media_type="application/x-ndjson",
+        headers={"X-Accel-Buffering": "no", "Cache-Control": "no-cache"}
+    )
+
 @app.post("/ai/generate-newsletter")
 async def generate_newsletter(request: NewsletterRequest):
     try:
         prompt = f"""Generate an HTML newsletter about {request.topic}.
-Content details: {json.dumps(request.content_details)}
-Style preferences: {json.dumps(request.style_preferences) if request.style_preferences else 'None'}
+Content details: {json.dumps(request.content_details, sort_keys=True)}
+Style preferences: {json.dumps(request.style_preferences, sort_keys=True) if request.style_preferences else 'None'}
 
 Please generate a complete, well-formatted HTML newsletter that can be used directly."""
 
-        response = requests.post(
-            OLLAMA_API,
-            json={
-                "model": "mistral",
-                "prompt": f"{DEFAULT_SYSTEM_PROMPT}\n\n{prompt}",
-                "stream": False
-            }
-        )
-        
-        if response.status_code != 200:
-            logger.error(f"Ollama API error: {response.text}")
-            raise HTTPException(status_code=500, detail=f"Failed to generate newsletter: {response.text}")
+        # Users re-click "generate" with identical inputs, so serve repeats from the cache
+        cache_key = make_cache_key("mistral", DEFAULT_SYSTEM_PROMPT, [{"role": "user", "content": prompt}], None)
+        use_cache = response_cache.should_cache(None, opt_in=True)
+        cached = response_cache.get(cache_key) if use_cache else None
         
-        response_data = response.json()
-        newsletter_html = response_data.get("response", "").strip()
-        
-        if not newsletter_html:
-            raise HTTPException(status_code=500, detail="Failed to generate newsletter content")
+        if cached is not None:
+            newsletter_html = cached["response"]
+        else:
+            response = await run_blocking(
+                http_client.post,
+                OLLAMA_API,
+                pool='llm',
+                json={
+                    "model": "mistral",
+                    "prompt": f"{DEFAULT_SYSTEM_PROMPT}\n\n{prompt}",
+                    "stream": False
+                }
+            )
+            
+            if response.status_code != 200:
+                logger.error(f"Ollama API error: {response.text}")
+                raise HTTPException(status_code=500, detail=f"Failed to generate newsletter: {response.text}")
+            
+            response_data = response.json()
+            newsletter_html = response_data.get("response", "").strip()
+            
+            if not newsletter_html:
+                raise HTTPException(status_code=500, detail="Failed to generate newsletter content")
+            
+            if use_cache:
+                response_cache.set(cache_key, {"response": newsletter_html})
         
         # Clean and format the HTML
         if not newsletter_html.startswith('<!DOCTYPE html>'):
@@ -468,6 +627,11 @@ Please generate a complete, well-formatted HTML newsletter that can be used dire
         logger.error(f"Error in generate_newsletter: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/ai/cache-stats")
+async def get_ai_cache_stats():
+    """Hit/miss counters for the AI response cache"""
+    return response_cache.stats()
+
 @app.get("/quota")
 async def get_quota():
     # For local development, we can return unlimited quota
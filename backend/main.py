@@ -1,16 +1,30 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import Depends, FastAPI, HTTPException, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, EmailStr
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from pydantic import BaseModel, ConfigDict, EmailStr
 from typing import List, Optional, Dict, Any
 import smtplib
-from email_service import send_email, improve_content
+from email_service import improve_content
+from smtp_pool import smtp_pool
+from executors import run_blocking, shutdown_executors
+from http_client import http_client
+from response_cache import response_cache
 from ai_service import ai_service
+from campaign_queue import campaign_queue
+from retry_queue import retry_queue
+import metrics
+from quota_service import client_id, quota_service
 import os
 import logging
 import re
-from scheduler_service import NewsletterSchedulerService
+import json
+from scheduler_service import recipient_dict, scheduler_service
 from datetime import datetime
-from sqlalchemy.orm import Session
+from sqlalchemy import delete, func, insert, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from models import GroupRecipient, NewsletterSchedule, RecipientGroup, ScheduleRun, SmtpProfile, conflict_insert
+from credentials import seal_secret
+from database import get_db, dispose_async_engine, serialized_writes
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -32,7 +46,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
-    expose_headers=["Content-Type", "Authorization"]
+    expose_headers=["Content-Type", "Authorization", "X-Next-Cursor"]
 )
 
 # Models
@@ -44,6 +58,9 @@ class SmtpConfig(BaseModel):
     name: str
 
 class Recipient(BaseModel):
+    # Extra fields are kept so templates can use them as [[FIELD]] placeholders
+    model_config = ConfigDict(extra='allow')
+    
     name: str
     email: EmailStr
     organization: Optional[str] = None
@@ -90,36 +107,90 @@ class ScheduleNewsletterRequest(BaseModel):
     recipient_group: str
     frequency: str  # 'monthly' or 'weekly'
     start_date: datetime
+    smtp_profile_id: Optional[int] = None  # Default SMTP profile when omitted
+
+class RecipientGroupRequest(BaseModel):
+    name: str
+    description: Optional[str] = None
+
+class SmtpProfileRequest(SmtpConfig):
+    profile_name: str
+    is_default: bool = False
+
+# Page sizes for recipient listings
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+@app.on_event("startup")
+def start_campaign_queue():
+    """Start the background campaign sender, resuming any interrupted jobs, and the SMTP retry worker"""
+    campaign_queue.start()
+    retry_queue.start()
+
+@app.on_event("startup")
+async def start_scheduler():
+    """Re-register stored schedules and compete for the scheduler leader lease"""
+    await scheduler_service.start()
+
+@app.on_event("startup")
+def validate_ai_providers():
+    """Check AI provider keys in the background instead of blocking startup"""
+    ai_service.start_validation()
+
+@app.on_event("shutdown")
+def close_smtp_connections():
+    """Stop the campaign sender and retry worker, persist quota usage and close pooled connections and worker threads"""
+    campaign_queue.stop()
+    retry_queue.stop()
+    quota_service.stop()
+    smtp_pool.close_all()
+    http_client.close()
+    shutdown_executors(wait=False)
 
-# Email quota tracking
-email_count = 0
-max_email_count = 1  # Only allow one email per IP
+@app.on_event("shutdown")
+async def close_database():
+    """Release the scheduler lease and close the async engine's pooled connections"""
+    await scheduler_service.stop()
+    await dispose_async_engine()
 
-scheduler_service = NewsletterSchedulerService()
+def check_smtp_login(config: SmtpConfig):
+    """Open an SMTP session and log in, raising on failure"""
+    if config.port == "465":
+        server = smtplib.SMTP_SSL(config.server, int(config.port))
+    else:
+        server = smtplib.SMTP(config.server, int(config.port))
+        server.starttls()
+    
+    server.login(config.email, config.password)
+    server.quit()
+
+@app.get("/health")
+async def health():
+    """Report service liveness, AI provider readiness and HTTP pool usage"""
+    return {"status": "ok", **ai_service.provider_status(), "http_pool": http_client.stats()}
+
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheus metrics: LLM, SMTP and DB latency histograms and queue depths"""
+    # Some gauges query the database, so render off the loop
+    return PlainTextResponse(await run_blocking(metrics.render), media_type=metrics.CONTENT_TYPE)
 
 @app.post("/test-smtp")
 async def test_smtp(config: SmtpConfig):
     try:
         # Try to establish SMTP connection
-        if config.port == "465":
-            server = smtplib.SMTP_SSL(config.server, int(config.port))
-        else:
-            server = smtplib.SMTP(config.server, int(config.port))
-            server.starttls()
-        
-        server.login(config.email, config.password)
-        server.quit()
+        await run_blocking(check_smtp_login, config, pool='smtp')
         return {"status": "success", "message": "SMTP configuration is valid"}
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 @app.post("/send-email")
-async def send_email_endpoint(email_content: EmailContent):
-    global email_count
-    
+async def send_email_endpoint(email_content: EmailContent, http_request: Request):
+    client = client_id(http_request)
     try:
-        # Check if email quota is exceeded
-        if email_count >= max_email_count:
+        # Check and use the caller's email quota
+        allowed, remaining_emails = quota_service.consume(client, 'email')
+        if not allowed:
             return {
                 "status": "quota_exceeded",
                 "message": "You've reached your email sending limit. Join our waitlist for continued access!",
@@ -130,93 +201,124 @@ async def send_email_endpoint(email_content: EmailContent):
         if email_content.use_ai:
             content = improve_content(content)
         
-        result = send_email(
+        # Queue the campaign; the background worker sends it
+        job_id = await run_blocking(
+            campaign_queue.enqueue,
             content=content,
             recipients=[dict(r) for r in email_content.recipients],
             smtp_config=dict(email_content.smtp),
             campaign_name="newsletter"
         )
         
-        # Increment email count after successful send
-        email_count += 1
-        
         return {
-            "status": "success",
-            "message": f"Successfully sent {result['successful_sends']} emails",
-            "failed": result['failed_sends'],
-            "remaining_emails": max_email_count - email_count
+            "status": "queued",
+            "message": f"Queued {len(email_content.recipients)} emails for sending",
+            "job_id": job_id,
+            "remaining_emails": remaining_emails
         }
     except Exception as e:
+        # Only accepted campaigns count against the quota
+        quota_service.refund(client, 'email')
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/send-jobs")
+async def list_send_jobs(limit: int = 20):
+    """List the most recent campaign send jobs"""
+    return await run_blocking(campaign_queue.list_jobs, limit=min(limit, 100))
+
+@app.get("/send-jobs/{job_id}")
+async def get_send_job(job_id: int):
+    """Get the status and progress of a campaign send job"""
+    job = await run_blocking(campaign_queue.get_job, job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Send job not found")
+    return job
+
+@app.post("/send-jobs/{job_id}/retry")
+async def retry_send_job(job_id: int, smtp: SmtpConfig):
+    """Requeue a finished campaign; addresses it already delivered to are skipped"""
+    if not await run_blocking(campaign_queue.retry, job_id, dict(smtp)):
+        job = await run_blocking(campaign_queue.get_job, job_id)
+        if not job:
+            raise HTTPException(status_code=404, detail="Send job not found")
+        raise HTTPException(status_code=409, detail="Send job is still queued or running")
+    return {"status": "queued", "job_id": job_id}
+
 @app.post("/improve-content")
 async def improve_content_endpoint(content: ContentRequest):
     try:
-        improved = improve_content(content.content)
+        improved = await run_blocking(improve_content, content.content)
         return {"improved_content": improved}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-# New AI endpoints
-@app.post("/ai/chat")
-async def chat_with_ai(request: ChatRequest):
-    try:
-        # Log the request for debugging
-        logger.info(f"Chat request received with prompt: {request.prompt[:50]}...")
-        if request.contextFiles:
-            logger.info(f"Context files included: {[cf.name for cf in request.contextFiles]}")
+def build_chat_context(request: ChatRequest):
+    """Build the conversation context and system prompt for a chat request"""
+    # Log the request for debugging
+    logger.info(f"Chat request received with prompt: {request.prompt[:50]}...")
+    if request.contextFiles:
+        logger.info(f"Context files included: {[cf.name for cf in request.contextFiles]}")
+    
+    # Build context from previous messages
+    context = [{"role": msg.role, "content": msg.content} for msg in request.context or []]
+    
+    # Create a custom system prompt that emphasizes the importance of context files
+    custom_system_prompt = """You are an AI assistant specialized in helping users create professional and career-focused emails.
+    Your goal is to provide helpful, accurate, and creative responses to user queries about email creation.
+    When asked to generate email content, provide well-structured HTML that can be directly used in an email campaign.
+    Focus on creating content that is visually appealing, mobile-responsive, and follows email best practices."""
+    
+    # Add context files to the system prompt for better understanding
+    if request.contextFiles:
+        custom_system_prompt += "\n\nThe following context files have been provided:\n"
+        
+        for cf in request.contextFiles:
+            custom_system_prompt += f"\n--- BEGIN CONTEXT FILE: {cf.name} ---\n"
+            custom_system_prompt += cf.content
+            custom_system_prompt += f"\n--- END CONTEXT FILE: {cf.name} ---\n"
         
-        # Build context from previous messages
-        context = request.context or []
+        # Check for @filename mentions in the prompt
+        mention_pattern = r'@(\S+)'
+        mentions = re.findall(mention_pattern, request.prompt)
         
-        # Create a custom system prompt that emphasizes the importance of context files
-        custom_system_prompt = """You are an AI assistant specialized in helping users create professional and career-focused emails.
-        Your goal is to provide helpful, accurate, and creative responses to user queries about email creation.
-        When asked to generate email content, provide well-structured HTML that can be directly used in an email campaign.
-        Focus on creating content that is visually appealing, mobile-responsive, and follows email best practices."""
+        # Add mentioned context files as user messages for better visibility
+        for mention in mentions:
+            for cf in request.contextFiles:
+                if cf.name.lower() == mention.lower():
+                    if not context:
+                        context = []
+                    context.append({
+                        "role": "user",
+                        "content": f"Here is the content of {cf.name} that I'm referring to with @{mention}:\n\n{cf.content}"
+                    })
+                    break
         
-        # Add context files to the system prompt for better understanding
-        if request.contextFiles:
-            custom_system_prompt += "\n\nThe following context files have been provided:\n"
-            
+        # Also add the first context file as a user message if it's relevant to the current prompt
+        if not any(mentions) and request.contextFiles:
             for cf in request.contextFiles:
-                custom_system_prompt += f"\n--- BEGIN CONTEXT FILE: {cf.name} ---\n"
-                custom_system_prompt += cf.content
-                custom_system_prompt += f"\n--- END CONTEXT FILE: {cf.name} ---\n"
-            
-            # Check for @filename mentions in the prompt
-            mention_pattern = r'@(\S+)'
-            mentions = re.findall(mention_pattern, request.prompt)
-            
-            # Add mentioned context files as user messages for better visibility
-            for mention in mentions:
-                for cf in request.contextFiles:
-                    if cf.name.lower() == mention.lower():
-                        if not context:
-                            context = []
-                        context.append({
-                            "role": "user",
-                            "content": f"Here is the content of {cf.name} that I'm referring to with @{mention}:\n\n{cf.content}"
-                        })
-                        break
-            
-            # Also add the first context file as a user message if it's relevant to the current prompt
-            if not any(mentions) and request.contextFiles:
-                for cf in request.contextFiles:
-                    if request.prompt.lower().find(cf.name.lower()) >= 0:
-                        if not context:
-                            context = []
-                        context.append({
-                            "role": "user",
-                            "content": f"Here is the content of {cf.name} that I'm referring to:\n\n{cf.content}"
-                        })
-                        break
+                if request.prompt.lower().find(cf.name.lower()) >= 0:
+                    if not context:
+                        context = []
+                    context.append({
+                        "role": "user",
+                        "content": f"Here is the content of {cf.name} that I'm referring to:\n\n{cf.content}"
+                    })
+                    break
+    
+    return context, custom_system_prompt
+
+# New AI endpoints
+@app.post("/ai/chat")
+async def chat_with_ai(request: ChatRequest, http_request: Request):
+    try:
+        context, custom_system_prompt = build_chat_context(request)
         
         # Generate response
-        response = ai_service.generate_response(
+        response = await ai_service.agenerate_response(
             prompt=request.prompt,
             context=context,
-            system_prompt=custom_system_prompt
+            system_prompt=custom_system_prompt,
+            client_id=client_id(http_request)
         )
         
         return response
@@ -224,43 +326,68 @@ async def chat_with_ai(request: ChatRequest):
         logger.error(f"Error in chat_with_ai: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/ai/chat/stream")
+async def stream_chat_with_ai(request: ChatRequest, http_request: Request):
+    """Stream the chat response as newline-delimited JSON events"""
+    context, custom_system_prompt = build_chat_context(request)
+    events = ai_service.stream_response(
+        prompt=request.prompt,
+        context=context,
+        system_prompt=custom_system_prompt,
+        client_id=client_id(http_request)
+    )
+    
+    # The sync generator is iterated on a worker thread, so the loop stays free
+    return StreamingResponse(
+        (json.dumps(event, default=str) + "\n" for event in events),
+        media_type="application/x-ndjson",
+        headers={"X-Accel-Buffering": "no", "Cache-Control": "no-cache"}
+    )
+
 @app.post("/ai/generate-newsletter")
-async def generate_newsletter(request: NewsletterRequest):
+async def generate_newsletter(request: NewsletterRequest, http_request: Request):
     """
     Generate a complete newsletter HTML based on the provided topic and details.
     """
     try:
-        response = ai_service.generate_newsletter_html(
-            topic=request.topic,
-            content_details=request.content_details,
-            style_preferences=request.style_preferences
+        response = await run_blocking(
+            ai_service.generate_newsletter_html,
+            pool='llm',
+            # Sorted keys keep the prompt, and so the cache key, canonical
+            content=f"{request.topic}\n\nContent details: {json.dumps(request.content_details, sort_keys=True)}",
+            style_preferences=json.dumps(request.style_preferences, sort_keys=True) if request.style_preferences else None,
+            client_id=client_id(http_request)
         )
         
         return response
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/ai/cache-stats")
+async def get_ai_cache_stats():
+    """Hit/miss counters for the AI response cache"""
+    return response_cache.stats()
+
 @app.get("/quota")
-async def get_quota():
+async def get_quota(http_request: Request):
     """
-    Get the current usage quota for the user.
+    Get the current usage quota for the calling client (API key or IP address).
     """
+    usage = quota_service.usage(client_id(http_request))
     return {
-        "remaining_chats": ai_service.max_chat_count - ai_service.chat_count,
-        "max_chats": ai_service.max_chat_count,
-        "remaining_emails": max_email_count - email_count,
-        "max_emails": max_email_count
+        "remaining_chats": usage["chat"]["remaining"],
+        "max_chats": usage["chat"]["max"],
+        "remaining_emails": usage["email"]["remaining"],
+        "max_emails": usage["email"]["max"]
     }
 
 @app.post("/reset-quota")
-async def reset_quota():
+async def reset_quota(http_request: Request):
     """
-    Reset the quota for testing purposes.
+    Reset the calling client's quota for testing purposes.
     In production, this would be protected and only used by admins.
     """
-    global email_count
-    email_count = 0
-    ai_service.reset_chat_count()
+    quota_service.reset(client_id(http_request))
     
     return {
         "status": "success",
@@ -268,88 +395,291 @@ async def reset_quota():
     }
 
 @app.post("/schedule-newsletter")
-async def schedule_newsletter(request: ScheduleNewsletterRequest):
+async def schedule_newsletter(request: ScheduleNewsletterRequest, db: AsyncSession = Depends(get_db)):
     """Schedule a recurring newsletter"""
     try:
         result = await scheduler_service.schedule_newsletter(
+            db,
             name=request.name,
             description=request.description,
             template_content=request.template_content,
             recipient_group=request.recipient_group,
             frequency=request.frequency,
-            start_date=request.start_date
+            start_date=request.start_date,
+            smtp_profile_id=request.smtp_profile_id
         )
         return result
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/scheduled-newsletters")
-async def get_scheduled_newsletters():
+async def get_scheduled_newsletters(db: AsyncSession = Depends(get_db)):
     """Get all scheduled newsletters"""
-    session = Session()
-    try:
-        schedules = session.query(NewsletterSchedule).all()
-        return [
-            {
-                "id": s.id,
-                "name": s.name,
-                "description": s.description,
-                "recipient_group": s.recipient_group,
-                "frequency": s.frequency,
-                "next_send_date": s.next_send_date,
-                "last_sent_date": s.last_sent_date,
-                "is_active": s.is_active
-            }
-            for s in schedules
-        ]
-    finally:
-        session.close()
+    schedules = (await db.scalars(select(NewsletterSchedule).order_by(NewsletterSchedule.id))).all()
+    return [
+        {
+            "id": s.id,
+            "name": s.name,
+            "description": s.description,
+            "recipient_group": s.recipient_group,
+            "frequency": s.frequency,
+            "next_send_date": s.next_send_date,
+            "last_sent_date": s.last_sent_date,
+            "is_active": s.is_active,
+            "smtp_profile_id": s.smtp_profile_id
+        }
+        for s in schedules
+    ]
 
 @app.put("/schedule-newsletter/{schedule_id}")
-async def update_newsletter_schedule(schedule_id: int, request: ScheduleNewsletterRequest):
+async def update_newsletter_schedule(schedule_id: int, request: ScheduleNewsletterRequest,
+                                     db: AsyncSession = Depends(get_db)):
     """Update a scheduled newsletter"""
-    session = Session()
-    try:
-        schedule = session.query(NewsletterSchedule).get(schedule_id)
-        if not schedule:
-            raise HTTPException(status_code=404, detail="Schedule not found")
-        
-        schedule.name = request.name
-        schedule.description = request.description
-        schedule.template_content = request.template_content
-        schedule.recipient_group = request.recipient_group
-        schedule.frequency = request.frequency
-        schedule.next_send_date = request.start_date
-        
-        session.commit()
-        
-        # Update the scheduler job
-        scheduler_service._add_newsletter_job(schedule)
-        
-        return {"status": "success", "message": "Schedule updated successfully"}
-    finally:
-        session.close()
+    schedule = await db.get(NewsletterSchedule, schedule_id)
+    if not schedule:
+        raise HTTPException(status_code=404, detail="Schedule not found")
+    
+    schedule.name = request.name
+    schedule.description = request.description
+    schedule.template_content = request.template_content
+    schedule.recipient_group = request.recipient_group
+    schedule.frequency = request.frequency
+    schedule.next_send_date = request.start_date
+    schedule.smtp_profile_id = request.smtp_profile_id
+    
+    async with serialized_writes():
+        await db.commit()
+    
+    # Update the scheduler job
+    await run_blocking(scheduler_service._add_newsletter_job, schedule)
+    
+    return {"status": "success", "message": "Schedule updated successfully"}
 
 @app.delete("/schedule-newsletter/{schedule_id}")
-async def delete_newsletter_schedule(schedule_id: int):
+async def delete_newsletter_schedule(schedule_id: int, db: AsyncSession = Depends(get_db)):
     """Delete a scheduled newsletter"""
-    session = Session()
-    try:
-        schedule = session.query(NewsletterSchedule).get(schedule_id)
-        if not schedule:
-            raise HTTPException(status_code=404, detail="Schedule not found")
-        
-        # Remove the scheduler job
-        job_id = f"newsletter_{schedule_id}"
-        scheduler_service.scheduler.remove_job(job_id)
-        
-        # Delete from database
-        session.delete(schedule)
-        session.commit()
-        
-        return {"status": "success", "message": "Schedule deleted successfully"}
-    finally:
-        session.close()
+    schedule = await db.get(NewsletterSchedule, schedule_id)
+    if not schedule:
+        raise HTTPException(status_code=404, detail="Schedule not found")
+    
+    # Remove the scheduler job
+    await run_blocking(scheduler_service.remove_newsletter_job, schedule_id)
+    
+    # Delete from database, along with its run history
+    async with serialized_writes():
+        await db.execute(delete(ScheduleRun).where(ScheduleRun.schedule_id == schedule_id))
+        await db.delete(schedule)
+        await db.commit()
+    
+    return {"status": "success", "message": "Schedule deleted successfully"}
+
+@app.get("/schedule-newsletter/{schedule_id}/runs")
+async def list_schedule_runs(schedule_id: int, limit: int = Query(20, ge=1, le=100),
+                             db: AsyncSession = Depends(get_db)):
+    """Most recent sends of a schedule with their per-batch progress"""
+    runs = (await db.scalars(
+        select(ScheduleRun)
+        .where(ScheduleRun.schedule_id == schedule_id)
+        .order_by(ScheduleRun.id.desc())
+        .limit(limit)
+    )).all()
+    return [
+        {
+            "id": r.id,
+            "status": r.status,
+            "total": r.total,
+            "batches_done": r.batches_done,
+            "sent_count": r.sent_count,
+            "failed_count": r.failed_count,
+            "error": r.error,
+            "started_at": r.started_at,
+            "finished_at": r.finished_at
+        }
+        for r in runs
+    ]
+
+@app.post("/schedule-newsletter/{schedule_id}/runs/{run_id}/retry")
+async def retry_schedule_run(schedule_id: int, run_id: int, db: AsyncSession = Depends(get_db)):
+    """Send a finished run again to the recipients it has not delivered to.
+    
+    A run still marked running whose worker died is resumed instead.
+    """
+    run = await db.get(ScheduleRun, run_id)
+    if not run or run.schedule_id != schedule_id:
+        raise HTTPException(status_code=404, detail="Schedule run not found")
+    if run.status == 'running' and not scheduler_service.run_is_stale(run):
+        raise HTTPException(status_code=409, detail="Schedule run is still running")
+    await run_blocking(scheduler_service.schedule_retry, run_id)
+    return {"status": "queued", "message": f"Retry of run {run_id} queued"}
+
+@app.post("/recipient-groups")
+async def create_recipient_group(request: RecipientGroupRequest, db: AsyncSession = Depends(get_db)):
+    """Create a named recipient group that schedules can send to"""
+    if await db.scalar(select(RecipientGroup.id).where(RecipientGroup.name == request.name)):
+        raise HTTPException(status_code=409, detail="Recipient group already exists")
+    group = RecipientGroup(name=request.name, description=request.description)
+    db.add(group)
+    async with serialized_writes():
+        await db.commit()
+    return {"id": group.id, "name": group.name, "description": group.description}
+
+@app.get("/recipient-groups")
+async def list_recipient_groups(db: AsyncSession = Depends(get_db)):
+    """List recipient groups with their recipient counts"""
+    counts = (
+        select(GroupRecipient.group_id, func.count(GroupRecipient.id).label("recipient_count"))
+        .group_by(GroupRecipient.group_id)
+        .subquery()
+    )
+    rows = (await db.execute(
+        select(RecipientGroup, func.coalesce(counts.c.recipient_count, 0))
+        .outerjoin(counts, counts.c.group_id == RecipientGroup.id)
+        .order_by(RecipientGroup.id)
+    )).all()
+    return [{
+        "id": group.id,
+        "name": group.name,
+        "description": group.description,
+        "created_at": group.created_at,
+        "recipient_count": recipient_count
+    } for group, recipient_count in rows]
+
+@app.delete("/recipient-groups/{group_id}")
+async def delete_recipient_group(group_id: int, db: AsyncSession = Depends(get_db)):
+    """Delete a recipient group and its recipients"""
+    group = await db.get(RecipientGroup, group_id)
+    if not group:
+        raise HTTPException(status_code=404, detail="Recipient group not found")
+    async with serialized_writes():
+        await db.execute(delete(GroupRecipient).where(GroupRecipient.group_id == group_id))
+        await db.delete(group)
+        await db.commit()
+    return {"status": "success", "message": "Recipient group deleted successfully"}
+
+@app.post("/recipient-groups/{group_id}/recipients")
+async def add_recipients(group_id: int, recipients: List[Recipient], db: AsyncSession = Depends(get_db)):
+    """Add recipients to a group in bulk; addresses already in the group are skipped"""
+    if not await db.get(RecipientGroup, group_id):
+        raise HTTPException(status_code=404, detail="Recipient group not found")
+    
+    rows = []
+    for r in recipients:
+        fields = r.model_extra or {}
+        rows.append({
+            "group_id": group_id,
+            "email": r.email,
+            "name": r.name,
+            "organization": r.organization,
+            "fields": json.dumps(fields) if fields else None,
+            "created_at": datetime.utcnow()
+        })
+    if not rows:
+        return {"status": "success", "added": 0}
+    
+    async with serialized_writes():
+        stmt = conflict_insert(GroupRecipient, db.get_bind().dialect.name)
+        if stmt is not None:
+            result = await db.execute(stmt.on_conflict_do_nothing().returning(GroupRecipient.id), rows)
+            added = len(result.all())
+        else:
+            # No ON CONFLICT: skip the addresses the group already has
+            existing = set((await db.scalars(
+                select(GroupRecipient.email).where(GroupRecipient.group_id == group_id,
+                                                   GroupRecipient.email.in_([r["email"] for r in rows]))
+            )).all())
+            rows = [r for r in {r["email"]: r for r in rows}.values() if r["email"] not in existing]
+            if rows:
+                await db.execute(insert(GroupRecipient), rows)
+            added = len(rows)
+        await db.commit()
+    return {"status": "success", "added": added}
+
+@app.get("/recipient-groups/{group_id}/recipients")
+async def list_recipients(group_id: int, response: Response,
+                          cursor: Optional[int] = None,
+                          limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+                          db: AsyncSession = Depends(get_db)):
+    """List a group's recipients one page at a time.
+    
+    Pass the ``X-Next-Cursor`` response header back as ``cursor`` to get
+    the next page; the header is absent on the last page.
+    """
+    query = select(GroupRecipient).where(GroupRecipient.group_id == group_id)
+    if cursor is not None:
+        query = query.where(GroupRecipient.id > cursor)
+    rows = (await db.scalars(query.order_by(GroupRecipient.id).limit(limit + 1))).all()
+    
+    if len(rows) > limit:
+        rows = rows[:limit]
+        response.headers["X-Next-Cursor"] = str(rows[-1].id)
+    
+    return [{"id": r.id, **recipient_dict(r)} for r in rows]
+
+@app.delete("/recipient-groups/{group_id}/recipients/{recipient_id}")
+async def delete_recipient(group_id: int, recipient_id: int, db: AsyncSession = Depends(get_db)):
+    """Remove one recipient from a group"""
+    recipient = await db.get(GroupRecipient, recipient_id)
+    if not recipient or recipient.group_id != group_id:
+        raise HTTPException(status_code=404, detail="Recipient not found")
+    await db.delete(recipient)
+    async with serialized_writes():
+        await db.commit()
+    return {"status": "success", "message": "Recipient removed successfully"}
+
+def smtp_profile_dict(profile: SmtpProfile) -> dict:
+    """Public view of an SMTP profile; the password is never returned"""
+    return {
+        "id": profile.id,
+        "name": profile.name,
+        "server": profile.server,
+        "port": profile.port,
+        "email": profile.email,
+        "sender_name": profile.sender_name,
+        "is_default": profile.is_default
+    }
+
+@app.post("/smtp-profiles")
+async def create_smtp_profile(request: SmtpProfileRequest, db: AsyncSession = Depends(get_db)):
+    """Store SMTP settings for scheduled newsletters"""
+    if await db.scalar(select(SmtpProfile.id).where(SmtpProfile.name == request.profile_name)):
+        raise HTTPException(status_code=409, detail="SMTP profile already exists")
+    
+    profile = SmtpProfile(
+        name=request.profile_name,
+        server=request.server,
+        port=request.port,
+        email=request.email,
+        password=seal_secret(request.password),
+        sender_name=request.name,
+        is_default=request.is_default
+    )
+    async with serialized_writes():
+        if request.is_default:
+            # Only one profile is the default
+            for other in (await db.scalars(select(SmtpProfile).where(SmtpProfile.is_default))).all():
+                other.is_default = False
+        db.add(profile)
+        await db.commit()
+    return smtp_profile_dict(profile)
+
+@app.get("/smtp-profiles")
+async def list_smtp_profiles(db: AsyncSession = Depends(get_db)):
+    """List stored SMTP profiles without their passwords"""
+    profiles = (await db.scalars(select(SmtpProfile).order_by(SmtpProfile.id))).all()
+    return [smtp_profile_dict(p) for p in profiles]
+
+@app.delete("/smtp-profiles/{profile_id}")
+async def delete_smtp_profile(profile_id: int, db: AsyncSession = Depends(get_db)):
+    """Delete an SMTP profile that no schedule uses"""
+    profile = await db.get(SmtpProfile, profile_id)
+    if not profile:
+        raise HTTPException(status_code=404, detail="SMTP profile not found")
+    if await db.scalar(select(NewsletterSchedule.id).where(NewsletterSchedule.smtp_profile_id == profile_id).limit(1)):
+        raise HTTPException(status_code=409, detail="SMTP profile is used by a schedule")
+    await db.delete(profile)
+    async with serialized_writes():
+        await db.commit()
+    return {"status": "success", "message": "SMTP profile deleted successfully"}
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,107 @@
+import random
+import sys
+import uuid
+from datetime import datetime
+from email import base64mime
+from email.policy import compat32
+from email.utils import formatdate, make_msgid, formataddr
+
+# Same boundary format as email.generator
+_BOUNDARY_WIDTH = len(repr(sys.maxsize - 1))
+_BOUNDARY_FMT = '%%0%dd' % _BOUNDARY_WIDTH
+
+_HTML_PART_HEADERS = (
+    'Content-Type: text/html; charset="utf-8"\n'
+    'MIME-Version: 1.0\n'
+    'Content-Transfer-Encoding: base64\n'
+    '\n'
+)
+
+
+def _make_boundary() -> str:
+    return '=' * 15 + (_BOUNDARY_FMT % random.randrange(sys.maxsize)) + '=='
+
+
+# Message.as_string() serializes with maxheaderlen=0, i.e. without folding
+_AS_STRING_POLICY = compat32.clone(max_line_length=0)
+
+
+def _header(name: str, value: str) -> str:
+    """Serialize one header exactly as Message.as_string() would"""
+    return _AS_STRING_POLICY.fold(name, value)
+
+
+class CampaignMessageBuilder:
+    """Builds per-recipient messages from a skeleton serialized once per campaign.
+
+    The output matches what ``MIMEMultipart('alternative')`` with a single
+    UTF-8 HTML part produces through ``as_string()``. The invariant headers
+    and MIME boundaries are serialized up front. Each recipient only adds
+    the To, Message-ID, List-Unsubscribe and X-Entity-Ref-ID headers and the
+    base64 body. Date is fixed once per campaign.
+    """
+
+    UNSUBSCRIBE_URL = 'https://research.zirodelta.com/unsubscribe'
+
+    def __init__(self, smtp_config: dict, campaign_name: str, subject: str = 'Newsletter'):
+        self.domain = smtp_config['email'].split('@')[1]
+        self.boundary = _make_boundary()
+
+        self._head = ''.join([
+            _header('Content-Type', f'multipart/alternative; boundary="{self.boundary}"'),
+            _header('MIME-Version', '1.0'),
+            _header('Subject', subject),
+            _header('From', formataddr((smtp_config['name'], smtp_config['email']))),
+        ])
+        self._after_message_id = _header(
+            'Authentication-Results', f"spf=pass smtp.mailfrom={smtp_config['email']}"
+        )
+        self._after_unsubscribe = ''.join([
+            _header('List-ID', f'Zirodelta Research <newsletter.{self.domain}>'),
+            _header('Precedence', 'bulk'),
+        ])
+        self._tail_headers = ''.join([
+            _header('X-Campaign-ID', f'{campaign_name}-{datetime.now().strftime("%Y%m")}'),
+            _header('X-Message-Category', 'education'),
+        ])
+        self._date = _header('Date', formatdate(localtime=True))
+        self._body_open = f'\n--{self.boundary}\n' + _HTML_PART_HEADERS
+        self._body_close = f'\n--{self.boundary}--\n'
+
+    def build(self, recipient: dict, html_body: str) -> str:
+        """Serialize the full message for one recipient"""
+        return ''.join([
+            self._head,
+            _header('To', formataddr((recipient['name'], recipient['email']))),
+            self._date,
+            _header('Message-ID', make_msgid(domain=self.domain)),
+            self._after_message_id,
+            _header('List-Unsubscribe', f'<{self.UNSUBSCRIBE_URL}?email={recipient["email"]}>'),
+            self._after_unsubscribe,
+            _header('X-Entity-Ref-ID', str(uuid.uuid4())),
+            self._tail_headers,
+            self._body_open,
+            base64mime.body_encode(html_body.encode('utf-8')),
+            self._body_close,
+        ])
+
+    def build_shared(self, html_body: str) -> str:
+        """Serialize one message for a multi-recipient transaction.
+
+        The recipients are not named in To, and List-Unsubscribe links to
+        the generic unsubscribe page rather than to one address.
+        """
+        return ''.join([
+            self._head,
+            _header('To', 'undisclosed-recipients:;'),
+            self._date,
+            _header('Message-ID', make_msgid(domain=self.domain)),
+            self._after_message_id,
+            _header('List-Unsubscribe', f'<{self.UNSUBSCRIBE_URL}>'),
+            self._after_unsubscribe,
+            _header('X-Entity-Ref-ID', str(uuid.uuid4())),
+            self._tail_headers,
+            self._body_open,
+            base64mime.body_encode(html_body.encode('utf-8')),
+            self._body_close,
+        ])
@@ -0,0 +1,222 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from sqlalchemy import event
+
+# Content type of the Prometheus text exposition format
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Seconds; spans a fast SQLite query up to a slow LLM completion
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+TOKEN_BUCKETS = (16, 64, 256, 512, 1024, 2048, 4096, 8192, 16384)
+
+REGISTRY: List['_Metric'] = []
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = '') -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    """Base for metrics kept in memory and rendered in the Prometheus text format"""
+
+    kind = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], object] = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def labels(self, *values: str):
+        """The child for one combination of label values, created on first use"""
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects labels {self.labelnames}")
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        lines.extend(self._samples())
+        return '\n'.join(lines)
+
+
+class _HistogramChild:
+    __slots__ = ('bounds', 'counts', 'sum', '_lock')
+
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # Last slot is +Inf
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    @contextmanager
+    def time(self):
+        """Observe the seconds spent in the block"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def _samples(self):
+        lines = []
+        for values, child in list(self._children.items()):
+            with child._lock:
+                counts, total = list(child.counts), child.sum
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = 'le="' + _format_value(float(bound)) + '"'
+                lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, values, le)} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(self.labelnames, values)} {_format_value(total)}')
+            lines.append(f'{self.name}_count{_format_labels(self.labelnames, values)} {cumulative}')
+        return lines
+
+
+class Gauge(_Metric):
+    """A gauge read from callbacks when the metrics are scraped"""
+
+    kind = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._functions: Dict[Tuple[str, ...], Callable[[], float]] = {}
+
+    def set_function(self, function: Callable[[], float], *values: str):
+        """Report ``function()`` for these label values at scrape time"""
+        with self._lock:
+            self._functions[values] = function
+
+    def _samples(self):
+        lines = []
+        for values, function in list(self._functions.items()):
+            try:
+                value = function()
+            except Exception:
+                # A failing source is left out rather than failing the scrape
+                continue
+            lines.append(f'{self.name}{_format_labels(self.labelnames, values)} {_format_value(value)}')
+        return lines
+
+
+def render() -> str:
+    """All registered metrics in the Prometheus text exposition format"""
+    return '\n'.join(metric.render() for metric in REGISTRY) + '\n'
+
+
+LLM_REQUEST_SECONDS = Histogram(
+    'llm_request_duration_seconds', 'Latency of LLM calls', ['provider', 'model', 'outcome']
+)
+LLM_TOKENS = Histogram(
+    'llm_tokens', 'Tokens per LLM call', ['provider', 'model', 'direction'], buckets=TOKEN_BUCKETS
+)
+SMTP_PHASE_SECONDS = Histogram(
+    'smtp_phase_duration_seconds', 'Time spent in each SMTP phase', ['phase']
+)
+DB_QUERY_SECONDS = Histogram(
+    'db_query_duration_seconds', 'Database statement execution time', ['operation']
+)
+QUEUE_DEPTH = Gauge('queue_depth', 'Items waiting in a queue', ['queue'])
+
+# Usage keys of each provider's API, as (input, output)
+_USAGE_KEYS = (
+    ('prompt_tokens', 'completion_tokens'),  # X.AI and OpenAI
+    ('input_tokens', 'output_tokens'),  # Anthropic
+    ('prompt_eval_count', 'eval_count'),  # Ollama
+)
+
+
+def record_llm_call(provider: str, model: str, seconds: float, ok: bool = True,
+                    usage: Optional[dict] = None):
+    """Observe one LLM call's latency and, if the provider reported it, its token usage"""
+    LLM_REQUEST_SECONDS.labels(provider, model or '', 'success' if ok else 'error').observe(seconds)
+    if not usage:
+        return
+    for input_key, output_key in _USAGE_KEYS:
+        if input_key in usage or output_key in usage:
+            if usage.get(input_key) is not None:
+                LLM_TOKENS.labels(provider, model or '', 'in').observe(usage[input_key])
+            if usage.get(output_key) is not None:
+                LLM_TOKENS.labels(provider, model or '', 'out').observe(usage[output_key])
+            return
+
+
+_OPERATIONS = {'SELECT', 'INSERT', 'UPDATE', 'DELETE', 'PRAGMA', 'CREATE', 'ALTER', 'BEGIN', 'COMMIT', 'ROLLBACK'}
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get('query_start')
+    if not starts:
+        return
+    elapsed = time.perf_counter() - starts.pop()
+    operation = statement.lstrip()[:8].split(None, 1)[0].upper() if statement.strip() else ''
+    DB_QUERY_SECONDS.labels(operation if operation in _OPERATIONS else 'OTHER').observe(elapsed)
+
+
+def _handle_error(context):
+    # A failed statement never reaches after_cursor_execute
+    if context.connection is not None:
+        starts = context.connection.info.get('query_start')
+        if starts:
+            starts.pop()
+
+
+def instrument_engine(sync_engine):
+    """Time every statement run through an engine (use ``.sync_engine`` for async engines)"""
+    event.listen(sync_engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(sync_engine, 'after_cursor_execute', _after_cursor_execute)
+    event.listen(sync_engine, 'handle_error', _handle_error)
@@ -1,7 +1,27 @@
-from sqlalchemy import Column, Integer, String, DateTime, Text, Boolean, ForeignKey, create_engine
+import logging
+import os
+
+from sqlalchemy import Column, Integer, Float, String, DateTime, Text, Boolean, ForeignKey, Index, create_engine, event, text
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 from datetime import datetime
+from credentials import FERNET_PREFIX, seal_secret, unseal_secret
+from metrics import instrument_engine
+
+logger = logging.getLogger(__name__)
+
+# Connection settings; SQL_ECHO logs every statement and is meant for debugging only
+DATABASE_URL = os.getenv('DATABASE_URL', 'sqlite:///./newsletter.db')
+SQL_ECHO = os.getenv('SQL_ECHO', 'false').lower() == 'true'
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '5'))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', '10'))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '30'))
+# Seconds a SQLite connection waits on a lock held by another writer
+SQLITE_BUSY_TIMEOUT = float(os.getenv('SQLITE_BUSY_TIMEOUT', '5'))
+# Page cache per connection in KiB
+SQLITE_CACHE_KB = int(os.getenv('SQLITE_CACHE_KB', '20000'))
 
 Base = declarative_base()
 
@@ -14,6 +34,7 @@ class ChatSession(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     messages = relationship("ChatMessage", back_populates="session", cascade="all, delete-orphan")
+    summary = relationship("ChatSummary", cascade="all, delete-orphan", uselist=False)
 
 class ChatMessage(Base):
     __tablename__ = 'chat_messages'
@@ -24,6 +45,19 @@ class ChatMessage(Base):
     content = Column(Text, nullable=False)
     timestamp = Column(DateTime, default=datetime.utcnow)
     session = relationship("ChatSession", back_populates="messages")
+    
+    __table_args__ = (
+        # Chat turns read a session's latest messages in timestamp order
+        Index('ix_chat_messages_session_timestamp', 'session_id', 'timestamp'),
+    )
+
+class ChatSummary(Base):
+    __tablename__ = 'chat_summaries'
+    
+    session_id = Column(Integer, ForeignKey('chat_sessions.id', ondelete='CASCADE'), primary_key=True)
+    summary = Column(Text, nullable=False, default='')
+    covered_until = Column(DateTime)  # Timestamp of the newest message folded into the summary
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
 class NewsletterSchedule(Base):
     __tablename__ = 'newsletter_schedules'
@@ -37,9 +71,294 @@ class NewsletterSchedule(Base):
     next_send_date = Column(DateTime, nullable=False)
     last_sent_date = Column(DateTime)
     is_active = Column(Boolean, default=True)
+    smtp_profile_id = Column(Integer, ForeignKey('smtp_profiles.id'))  # Falls back to the default profile
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    __table_args__ = (
+        # The scheduler looks up active schedules that are due
+        Index('ix_newsletter_schedules_active_next_send', 'is_active', 'next_send_date'),
+    )
+
+class RecipientGroup(Base):
+    __tablename__ = 'recipient_groups'
+    
+    id = Column(Integer, primary_key=True)
+    name = Column(String(255), nullable=False, unique=True)  # Referenced by NewsletterSchedule.recipient_group
+    description = Column(Text)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class GroupRecipient(Base):
+    __tablename__ = 'group_recipients'
+    
+    id = Column(Integer, primary_key=True)
+    group_id = Column(Integer, ForeignKey('recipient_groups.id', ondelete='CASCADE'), nullable=False)
+    email = Column(String(320), nullable=False)
+    name = Column(String(255), nullable=False)
+    organization = Column(String(255))
+    fields = Column(Text)  # JSON object of extra template fields
+    created_at = Column(DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        # One entry per address per group; also serves keyset paging by group
+        Index('ux_group_recipients_group_email', 'group_id', 'email', unique=True),
+        Index('ix_group_recipients_group_id', 'group_id', 'id'),
+    )
+
+class SmtpProfile(Base):
+    __tablename__ = 'smtp_profiles'
+    
+    id = Column(Integer, primary_key=True)
+    name = Column(String(255), nullable=False, unique=True)
+    server = Column(String(255), nullable=False)
+    port = Column(String(10), nullable=False)
+    email = Column(String(320), nullable=False)
+    password = Column(Text, nullable=False)  # Sealed with credentials.seal_secret
+    sender_name = Column(String(255), nullable=False)
+    is_default = Column(Boolean, default=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    
+    def to_config(self) -> dict:
+        """The smtp_config dict that send_email expects"""
+        return {
+            'server': self.server,
+            'port': self.port,
+            'email': self.email,
+            'password': unseal_secret(self.password),
+            'name': self.sender_name
+        }
+
+class ScheduleRun(Base):
+    __tablename__ = 'schedule_runs'
+    
+    id = Column(Integer, primary_key=True)
+    schedule_id = Column(Integer, ForeignKey('newsletter_schedules.id', ondelete='CASCADE'), nullable=False)
+    status = Column(String(50), nullable=False, default='running')  # 'running', 'completed' or 'failed'
+    total = Column(Integer, nullable=False, default=0)
+    batches_done = Column(Integer, nullable=False, default=0)
+    sent_count = Column(Integer, nullable=False, default=0)
+    failed_count = Column(Integer, nullable=False, default=0)
+    last_recipient_id = Column(Integer)  # Keyset cursor of the last batch sent
+    error = Column(Text)
+    started_at = Column(DateTime, default=datetime.utcnow)
+    finished_at = Column(DateTime)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    __table_args__ = (
+        Index('ix_schedule_runs_schedule_id', 'schedule_id', 'id'),
+    )
+
+class SendLedger(Base):
+    __tablename__ = 'send_ledger'
+    
+    run_key = Column(String(64), primary_key=True)  # 'send_job:<id>' or 'schedule_run:<id>'
+    email = Column(String(320), primary_key=True)
+    status = Column(String(10), nullable=False)  # 'sent', 'failed' or 'deferred' (awaiting a retry)
+    smtp_code = Column(Integer)
+    error = Column(Text)
+    updated_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    
+    # Clustered on (run_key, email): skip checks and per-run stats are range reads
+    __table_args__ = {'sqlite_with_rowid': False}
+
+class RetryBatch(Base):
+    __tablename__ = 'send_retry_batches'
+    
+    id = Column(Integer, primary_key=True)
+    run_key = Column(String(64))  # Send ledger key of the original send, if any
+    campaign_name = Column(String(255), nullable=False)
+    content = Column(Text, nullable=False)  # Final HTML, shared by the batch's retries
+    smtp_config = Column(Text, nullable=False)  # Sealed with credentials.seal; deleted with the batch
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class SendRetry(Base):
+    __tablename__ = 'send_retries'
+    
+    id = Column(Integer, primary_key=True)
+    batch_id = Column(Integer, ForeignKey('send_retry_batches.id', ondelete='CASCADE'), nullable=False)
+    email = Column(String(320), nullable=False)
+    recipient = Column(Text, nullable=False)  # JSON recipient dict
+    domain = Column(String(255), nullable=False)
+    attempts = Column(Integer, nullable=False, default=1)
+    next_attempt_at = Column(DateTime, nullable=False)
+    last_code = Column(Integer)
+    last_error = Column(Text)
     created_at = Column(DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        Index('ix_send_retries_next_attempt_at', 'next_attempt_at'),
+        Index('ix_send_retries_domain', 'domain'),
+        Index('ix_send_retries_batch_id', 'batch_id'),
+    )
+
+class QuotaBucket(Base):
+    __tablename__ = 'quota_buckets'
+    
+    client_id = Column(String(128), primary_key=True)  # 'ip:<address>' or 'key:<hash>'
+    kind = Column(String(20), primary_key=True)  # 'chat' or 'email'
+    tokens = Column(Float, nullable=False)
+    updated_at = Column(Float, nullable=False)  # Unix time the tokens were counted at
+    
+    # Full buckets are deleted, so the table only holds clients that used quota recently
+    __table_args__ = {'sqlite_with_rowid': False}
+
+class SchedulerLease(Base):
+    __tablename__ = 'scheduler_leases'
+    
+    name = Column(String(100), primary_key=True)
+    holder = Column(String(255), nullable=False)  # Worker id of the current leader
+    expires_at = Column(DateTime, nullable=False)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
-# Create SQLite database
-engine = create_engine('sqlite:///./newsletter.db', echo=True)
-Base.metadata.create_all(engine) 
\ No newline at end of file
+class ContentValidation(Base):
+    __tablename__ = 'content_validations'
+    
+    content_hash = Column(String(64), primary_key=True)  # SHA-256 of the HTML
+    warnings = Column(Text, nullable=False)  # JSON list of warning strings
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class AIResponseCache(Base):
+    __tablename__ = 'ai_response_cache'
+    
+    cache_key = Column(String(64), primary_key=True)  # SHA-256 of model, prompts and temperature
+    response = Column(Text, nullable=False)  # JSON
+    expires_at = Column(DateTime, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class SendJob(Base):
+    __tablename__ = 'send_jobs'
+    
+    id = Column(Integer, primary_key=True)
+    campaign_name = Column(String(255), nullable=False, default='newsletter')
+    status = Column(String(50), nullable=False, default='queued')  # 'queued', 'running', 'completed' or 'failed'
+    content = Column(Text, nullable=False)
+    recipients = Column(Text, nullable=False)  # JSON list of recipient dicts
+    smtp_config = Column(Text)  # Sealed with credentials.seal, cleared once the job finishes
+    total = Column(Integer, nullable=False, default=0)
+    cursor = Column(Integer, nullable=False, default=0)  # Index of the next recipient to send
+    sent_count = Column(Integer, nullable=False, default=0)
+    failed_count = Column(Integer, nullable=False, default=0)
+    deferred_count = Column(Integer, nullable=False, default=0)  # Handed to the retry queue
+    failures = Column(Text)  # JSON list of {'email', 'error'}
+    error = Column(Text)
+    worker_id = Column(String(255))
+    heartbeat_at = Column(DateTime)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    started_at = Column(DateTime)
+    finished_at = Column(DateTime)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    __table_args__ = (
+        # Workers claim the oldest queued job, or a running one whose heartbeat went stale
+        Index('ix_send_jobs_status_id', 'status', 'id'),
+    )
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """Tune each new SQLite connection; shared by the sync and async engines"""
+    cursor = dbapi_connection.cursor()
+    # WAL lets readers in both API processes proceed while one of them writes
+    cursor.execute('PRAGMA journal_mode=WAL')
+    # Safe with WAL; only the last transactions can be lost on power failure
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute(f'PRAGMA cache_size=-{SQLITE_CACHE_KB}')
+    cursor.execute('PRAGMA temp_store=MEMORY')
+    cursor.close()
+
+
+def conflict_insert(model, dialect_name: str):
+    """An INSERT that supports ON CONFLICT clauses, or None on dialects without them"""
+    if dialect_name == 'sqlite':
+        return sqlite_insert(model)
+    if dialect_name == 'postgresql':
+        return postgresql_insert(model)
+    return None
+
+
+def _create_engine(url: str):
+    if not url.startswith('sqlite'):
+        return create_engine(url, echo=SQL_ECHO, pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW,
+                             pool_timeout=DB_POOL_TIMEOUT, pool_pre_ping=True)
+    
+    db_engine = create_engine(
+        url,
+        echo=SQL_ECHO,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        # Sessions are used from executor threads, one thread at a time
+        connect_args={'check_same_thread': False, 'timeout': SQLITE_BUSY_TIMEOUT}
+    )
+    
+    event.listen(db_engine, 'connect', set_sqlite_pragmas)
+    
+    return db_engine
+
+
+def _create_indexes(connection):
+    """Add indexes declared on models to tables created before they existed"""
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(connection, checkfirst=True)
+
+
+def _add_schedule_smtp_profile(connection):
+    """newsletter_schedules.smtp_profile_id, for databases created before it existed"""
+    columns = {row[1] for row in connection.execute(text('PRAGMA table_info(newsletter_schedules)'))}
+    if 'smtp_profile_id' not in columns:
+        connection.execute(text(
+            'ALTER TABLE newsletter_schedules ADD COLUMN smtp_profile_id INTEGER REFERENCES smtp_profiles (id)'
+        ))
+
+
+def _seal_smtp_passwords(connection):
+    """Encrypt SMTP profile passwords stored in plaintext before sealing existed"""
+    rows = connection.execute(text('SELECT id, password FROM smtp_profiles')).all()
+    for profile_id, password in rows:
+        if not password.startswith(FERNET_PREFIX):
+            connection.execute(text('UPDATE smtp_profiles SET password = :password WHERE id = :id'),
+                               {'password': seal_secret(password), 'id': profile_id})
+
+
+def _add_send_job_deferred_count(connection):
+    """send_jobs.deferred_count, for databases created before it existed"""
+    columns = {row[1] for row in connection.execute(text('PRAGMA table_info(send_jobs)'))}
+    if 'deferred_count' not in columns:
+        connection.execute(text(
+            'ALTER TABLE send_jobs ADD COLUMN deferred_count INTEGER NOT NULL DEFAULT 0'
+        ))
+
+
+# Schema changes applied in order. The version is kept in SQLite's
+# user_version pragma. Add new steps at the end and never edit old ones.
+MIGRATIONS = [
+    (1, _create_indexes),
+    (2, _add_schedule_smtp_profile),
+    (3, _seal_smtp_passwords),
+    (4, _add_send_job_deferred_count),
+]
+
+
+def migrate(db_engine) -> int:
+    """Create missing tables and bring the schema up to the latest version"""
+    Base.metadata.create_all(db_engine)
+    if db_engine.dialect.name != 'sqlite':
+        # No version tracking outside SQLite; only the idempotent steps apply
+        with db_engine.begin() as connection:
+            _create_indexes(connection)
+            _seal_smtp_passwords(connection)
+        return 0
+    
+    with db_engine.begin() as connection:
+        version = connection.execute(text('PRAGMA user_version')).scalar()
+        for target, step in MIGRATIONS:
+            if target > version:
+                logger.info(f"Migrating database schema to version {target}")
+                step(connection)
+                connection.execute(text(f'PRAGMA user_version = {target}'))
+                version = target
+    return version
+
+
+engine = _create_engine(DATABASE_URL)
+instrument_engine(engine)
+migrate(engine)
@@ -0,0 +1,294 @@
+import atexit
+import hashlib
+import logging
+import os
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import delete, select, tuple_
+from sqlalchemy.orm import sessionmaker
+
+from models import QuotaBucket, conflict_insert, engine
+
+logger = logging.getLogger(__name__)
+Session = sessionmaker(bind=engine)
+
+# Requests allowed per client, and the seconds it takes an empty bucket to refill
+QUOTA_CHAT_LIMIT = int(os.getenv('QUOTA_CHAT_LIMIT', '10'))
+QUOTA_CHAT_WINDOW = float(os.getenv('QUOTA_CHAT_WINDOW', '86400'))
+QUOTA_EMAIL_LIMIT = int(os.getenv('QUOTA_EMAIL_LIMIT', '1'))
+QUOTA_EMAIL_WINDOW = float(os.getenv('QUOTA_EMAIL_WINDOW', '86400'))
+# Seconds between writes of quota usage to the database
+QUOTA_FLUSH_INTERVAL = float(os.getenv('QUOTA_FLUSH_INTERVAL', '2'))
+# Trust the first X-Forwarded-For address; only enable behind a proxy that sets it
+QUOTA_TRUST_PROXY = os.getenv('QUOTA_TRUST_PROXY', 'false').lower() == 'true'
+# Comma-separated API keys that get their own quota; any other X-API-Key is ignored
+QUOTA_API_KEYS = {key.strip() for key in os.getenv('QUOTA_API_KEYS', '').split(',') if key.strip()}
+# Seconds between sweeps that drop refilled buckets from memory
+QUOTA_EVICT_INTERVAL = float(os.getenv('QUOTA_EVICT_INTERVAL', '60'))
+# Buckets per IN (...) lookup, well under SQLite's bound-parameter limit
+KEY_CHUNK = 400
+
+
+def client_id(request) -> str:
+    """Quota key of a request: its API key if it is a configured one, else its IP address"""
+    api_key = request.headers.get('x-api-key')
+    # An unchecked key would let callers mint fresh buckets at will
+    if api_key and api_key in QUOTA_API_KEYS:
+        # Only a digest is kept in memory and in the database
+        return 'key:' + hashlib.sha256(api_key.encode()).hexdigest()[:32]
+    forwarded = request.headers.get('x-forwarded-for') if QUOTA_TRUST_PROXY else None
+    if forwarded:
+        return 'ip:' + forwarded.split(',')[0].strip()
+    return 'ip:' + (request.client.host if request.client else 'unknown')
+
+
+class _Bucket:
+    __slots__ = ('tokens', 'updated_at', 'consumed', 'reset', 'epoch')
+
+    def __init__(self, tokens: float, updated_at: float):
+        self.tokens = tokens
+        self.updated_at = updated_at
+        self.consumed = 0.0  # Tokens taken since the last flush
+        self.reset = False  # Refilled since the last flush
+        self.epoch = 0  # Bumped on every reset
+
+
+class QuotaService:
+    """Per-client token buckets with an in-memory fast path.
+
+    Each (client, kind) pair has a bucket of ``limit`` tokens that refills
+    at ``limit / window`` tokens per second. Checks only touch a dict under
+    a lock. A background thread writes the usage to ``quota_buckets``
+    every ``flush_interval`` seconds. Each flush applies this process's
+    consumption to the stored value, so several workers sharing the
+    database converge within one interval; a denied check also rereads
+    the stored bucket on the next flush. Full buckets are dropped from the
+    database and from memory, and stored buckets are loaded once when the
+    service starts.
+    """
+
+    def __init__(self, limits: Optional[Dict[str, Tuple[int, float]]] = None,
+                 flush_interval: float = QUOTA_FLUSH_INTERVAL):
+        self.limits = limits or {
+            'chat': (QUOTA_CHAT_LIMIT, QUOTA_CHAT_WINDOW),
+            'email': (QUOTA_EMAIL_LIMIT, QUOTA_EMAIL_WINDOW),
+        }
+        self.flush_interval = flush_interval
+        self._buckets: Dict[Tuple[str, str], _Bucket] = {}
+        self._dirty = set()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._loaded = False
+
+    def set_limit(self, kind: str, limit: int, window: Optional[float] = None):
+        """Change a limit at runtime, e.g. for tests and benchmarks"""
+        self.limits[kind] = (limit, window or self.limits[kind][1])
+
+    def _refill(self, tokens: float, updated_at: float, kind: str, now: float) -> float:
+        limit, window = self.limits[kind]
+        return min(float(limit), tokens + (now - updated_at) * limit / window)
+
+    def _bucket(self, client: str, kind: str, now: float) -> _Bucket:
+        bucket = self._buckets.get((client, kind))
+        if bucket is None:
+            bucket = self._buckets[(client, kind)] = _Bucket(float(self.limits[kind][0]), now)
+        else:
+            bucket.tokens = self._refill(bucket.tokens, bucket.updated_at, kind, now)
+            bucket.updated_at = now
+        return bucket
+
+    def consume(self, client: str, kind: str, cost: int = 1) -> Tuple[bool, int]:
+        """Take ``cost`` tokens if available; returns (allowed, remaining)"""
+        if not self._loaded:
+            self.start()
+        now = time.time()
+        with self._lock:
+            bucket = self._bucket(client, kind, now)
+            if bucket.tokens < cost:
+                # Recheck against the database on the next flush, in case another worker reset it
+                self._dirty.add((client, kind))
+                return False, int(bucket.tokens)
+            bucket.tokens -= cost
+            bucket.consumed += cost
+            self._dirty.add((client, kind))
+            return True, int(bucket.tokens)
+
+    def refund(self, client: str, kind: str, cost: int = 1):
+        """Give back tokens taken for a request that then failed"""
+        now = time.time()
+        with self._lock:
+            bucket = self._bucket(client, kind, now)
+            bucket.tokens = min(float(self.limits[kind][0]), bucket.tokens + cost)
+            bucket.consumed -= cost
+            self._dirty.add((client, kind))
+
+    def remaining(self, client: str, kind: str) -> int:
+        if not self._loaded:
+            self.start()
+        with self._lock:
+            bucket = self._buckets.get((client, kind))
+            if bucket is None:
+                return self.limits[kind][0]
+            return int(self._refill(bucket.tokens, bucket.updated_at, kind, time.time()))
+
+    def usage(self, client: str) -> Dict[str, Dict[str, int]]:
+        """Remaining and maximum tokens of every kind for a client"""
+        return {kind: {"remaining": self.remaining(client, kind), "max": limit}
+                for kind, (limit, _) in self.limits.items()}
+
+    def reset(self, client: str, kind: Optional[str] = None):
+        """Refill a client's buckets, all kinds unless one is given"""
+        if not self._loaded:
+            self.start()
+        now = time.time()
+        with self._lock:
+            for k in ([kind] if kind else list(self.limits)):
+                bucket = self._bucket(client, k, now)
+                bucket.tokens = float(self.limits[k][0])
+                bucket.consumed = 0.0
+                bucket.reset = True
+                bucket.epoch += 1
+                self._dirty.add((client, k))
+
+    def load(self):
+        """Read the stored buckets into memory"""
+        session = Session()
+        try:
+            rows = session.scalars(select(QuotaBucket)).all()
+        finally:
+            session.close()
+        with self._lock:
+            for row in rows:
+                if row.kind in self.limits and (row.client_id, row.kind) not in self._buckets:
+                    self._buckets[(row.client_id, row.kind)] = _Bucket(row.tokens, row.updated_at)
+            self._loaded = True
+
+    def flush(self) -> int:
+        """Apply the usage since the last flush to the stored buckets; returns buckets written"""
+        with self._flush_lock:
+            with self._lock:
+                if not self._dirty:
+                    return 0
+                keys = list(self._dirty)
+                self._dirty.clear()
+                pending = {key: (self._buckets[key].consumed, self._buckets[key].reset, self._buckets[key].epoch)
+                           for key in keys}
+
+            now = time.time()
+            session = Session()
+            try:
+                stored = {}
+                for i in range(0, len(keys), KEY_CHUNK):
+                    for row in session.execute(
+                        select(QuotaBucket.client_id, QuotaBucket.kind, QuotaBucket.tokens, QuotaBucket.updated_at)
+                        .where(tuple_(QuotaBucket.client_id, QuotaBucket.kind).in_(keys[i:i + KEY_CHUNK]))
+                    ):
+                        stored[(row.client_id, row.kind)] = row
+                upserts: List[dict] = []
+                full = []
+                written: Dict[Tuple[str, str], float] = {}
+                for key, (consumed, reset, _) in pending.items():
+                    client, kind = key
+                    row = stored.get(key)
+                    if reset or row is None:
+                        base = float(self.limits[kind][0])
+                    else:
+                        base = self._refill(row.tokens, row.updated_at, kind, now)
+                    tokens = max(0.0, base - consumed)
+                    written[key] = tokens
+                    if tokens >= self.limits[kind][0]:
+                        full.append(key)
+                    else:
+                        upserts.append({"client_id": client, "kind": kind, "tokens": tokens, "updated_at": now})
+
+                stmt = conflict_insert(QuotaBucket, session.get_bind().dialect.name)
+                if upserts and stmt is not None:
+                    session.execute(stmt.on_conflict_do_update(
+                        index_elements=['client_id', 'kind'],
+                        set_={"tokens": stmt.excluded.tokens, "updated_at": stmt.excluded.updated_at}
+                    ), upserts)
+                else:
+                    for values in upserts:
+                        session.merge(QuotaBucket(**values))
+                for i in range(0, len(full), KEY_CHUNK):
+                    session.execute(delete(QuotaBucket).where(
+                        tuple_(QuotaBucket.client_id, QuotaBucket.kind).in_(full[i:i + KEY_CHUNK])
+                    ))
+                session.commit()
+            except Exception as e:
+                session.rollback()
+                with self._lock:
+                    self._dirty.update(keys)
+                logger.error(f"Failed to flush {len(keys)} quota buckets: {str(e)}")
+                raise
+            finally:
+                session.close()
+
+            full_keys = set(full)
+            with self._lock:
+                for key, tokens in written.items():
+                    bucket = self._buckets[key]
+                    consumed, _, epoch = pending[key]
+                    if bucket.epoch != epoch:
+                        # Reset during the flush; the next flush writes it
+                        continue
+                    # Keep what was taken during the flush, on top of the stored value
+                    bucket.consumed -= consumed
+                    bucket.reset = False
+                    bucket.tokens = max(0.0, tokens - bucket.consumed)
+                    bucket.updated_at = now
+                    if key in full_keys and key not in self._dirty:
+                        # A full bucket is what a new one would be, so keep memory bounded
+                        del self._buckets[key]
+            return len(written)
+
+    def evict_full(self) -> int:
+        """Drop buckets that have refilled and have nothing left to write; returns how many"""
+        now = time.time()
+        with self._lock:
+            idle = [key for key, bucket in self._buckets.items()
+                    if key not in self._dirty
+                    and self._refill(bucket.tokens, bucket.updated_at, key[1], now) >= self.limits[key[1]][0]]
+            for key in idle:
+                del self._buckets[key]
+        return len(idle)
+
+    def start(self):
+        """Load stored buckets and start the background flush thread"""
+        if self._thread and self._thread.is_alive():
+            return
+        with self._flush_lock:
+            if self._thread and self._thread.is_alive():
+                return
+            if not self._loaded:
+                self.load()
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='quota-flush', daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout: float = 10):
+        """Stop the flush thread and write any pending usage"""
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
+        self.flush()
+
+    def _run(self):
+        last_evict = time.monotonic()
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception:
+                # Usage stays pending and is retried on the next tick
+                pass
+            if time.monotonic() - last_evict >= QUOTA_EVICT_INTERVAL:
+                self.evict_full()
+                last_evict = time.monotonic()
+
+
+quota_service = QuotaService()
+atexit.register(quota_service.stop)
@@ -0,0 +1,157 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy.orm import sessionmaker
+
+from models import AIResponseCache, engine
+
+logger = logging.getLogger(__name__)
+Session = sessionmaker(bind=engine)
+
+# In-memory entries and their lifetime in seconds
+AI_CACHE_SIZE = int(os.getenv('AI_CACHE_SIZE', '512'))
+AI_CACHE_TTL = float(os.getenv('AI_CACHE_TTL', '3600'))
+# Also keep entries in SQLite so they survive restarts and are shared between workers
+AI_CACHE_PERSIST = os.getenv('AI_CACHE_PERSIST', 'false').lower() == 'true'
+# Cache sampled (temperature > 0) generations even when the caller did not opt in
+AI_CACHE_NONDETERMINISTIC = os.getenv('AI_CACHE_NONDETERMINISTIC', 'false').lower() == 'true'
+
+
+def make_cache_key(model: str, system_prompt: Optional[str], messages: List[Dict[str, str]],
+                   temperature: Optional[float]) -> str:
+    """Canonical hash of everything that determines a generation"""
+    payload = json.dumps(
+        {"model": model, "system": system_prompt or "", "messages": messages, "temperature": temperature},
+        sort_keys=True,
+        separators=(',', ':'),
+        ensure_ascii=False
+    )
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    """Two-tier cache for LLM generations: an in-memory LRU with TTL and an optional SQLite tier.
+
+    Only deterministic requests (temperature 0) are cached by default.
+    Sampled requests are cached only when the caller opts in, or when
+    ``AI_CACHE_NONDETERMINISTIC`` is set.
+    """
+
+    def __init__(self, max_size: int = AI_CACHE_SIZE, ttl: float = AI_CACHE_TTL,
+                 persist: bool = AI_CACHE_PERSIST):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.persist = persist
+        self._memory: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "bypassed": 0, "stores": 0}
+
+    def _count(self, name: str):
+        with self._lock:
+            self.counters[name] += 1
+
+    def should_cache(self, temperature: Optional[float], opt_in: bool = False) -> bool:
+        """Whether a request at this temperature may be served from the cache"""
+        if temperature is not None and temperature <= 0:
+            return True
+        if opt_in or AI_CACHE_NONDETERMINISTIC:
+            return True
+        self._count("bypassed")
+        return False
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > now:
+                    self._memory.move_to_end(key)
+                    self.counters["memory_hits"] += 1
+                    return value
+                del self._memory[key]
+
+        if self.persist:
+            value = self._load(key)
+            if value is not None:
+                self._count("disk_hits")
+                self._remember(key, value)
+                return value
+
+        self._count("misses")
+        return None
+
+    def set(self, key: str, value: Dict[str, Any]):
+        self._remember(key, value)
+        self._count("stores")
+        if self.persist:
+            self._store(key, value)
+
+    def _remember(self, key: str, value: Dict[str, Any]):
+        with self._lock:
+            self._memory[key] = (time.monotonic() + self.ttl, value)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_size:
+                self._memory.popitem(last=False)
+
+    def _load(self, key: str) -> Optional[Dict[str, Any]]:
+        session = Session()
+        try:
+            row = session.get(AIResponseCache, key)
+            if row is None:
+                return None
+            if row.expires_at < datetime.utcnow():
+                session.delete(row)
+                session.commit()
+                return None
+            return json.loads(row.response)
+        except Exception as e:
+            logger.warning(f"AI cache read failed: {str(e)}")
+            return None
+        finally:
+            session.close()
+
+    def _store(self, key: str, value: Dict[str, Any]):
+        session = Session()
+        try:
+            session.merge(AIResponseCache(
+                cache_key=key,
+                response=json.dumps(value),
+                expires_at=datetime.utcnow() + timedelta(seconds=self.ttl)
+            ))
+            session.commit()
+        except Exception as e:
+            logger.warning(f"AI cache write failed: {str(e)}")
+            session.rollback()
+        finally:
+            session.close()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            counters = dict(self.counters)
+            size = len(self._memory)
+        hits = counters["memory_hits"] + counters["disk_hits"]
+        lookups = hits + counters["misses"]
+        return {
+            **counters,
+            "hits": hits,
+            "hit_ratio": round(hits / lookups, 4) if lookups else None,
+            "memory_entries": size,
+            "max_entries": self.max_size,
+            "ttl_seconds": self.ttl,
+            "persistent": self.persist
+        }
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+
+
+response_cache = ResponseCache()
@@ -0,0 +1,428 @@
+import json
+import logging
+import os
+import random
+import re
+import smtplib
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Set, Tuple
+
+from sqlalchemy import delete, func, select, update
+from sqlalchemy.orm import sessionmaker
+
+import send_ledger
+from credentials import CredentialsUnavailable, seal, unseal
+from metrics import QUEUE_DEPTH
+from models import RetryBatch, SendRetry, engine
+
+logger = logging.getLogger(__name__)
+Session = sessionmaker(bind=engine)
+
+# Retry transient (4xx) SMTP failures in the background instead of failing them
+SMTP_RETRY_TRANSIENT = os.getenv('SMTP_RETRY_TRANSIENT', 'true').lower() == 'true'
+# Attempts per recipient, counting the first send
+SMTP_RETRY_MAX_ATTEMPTS = int(os.getenv('SMTP_RETRY_MAX_ATTEMPTS', '5'))
+# Backoff in seconds: base * 2^(attempt - 1), capped, with up to half of it jittered away
+SMTP_RETRY_BASE_DELAY = float(os.getenv('SMTP_RETRY_BASE_DELAY', '60'))
+SMTP_RETRY_MAX_DELAY = float(os.getenv('SMTP_RETRY_MAX_DELAY', '3600'))
+# Seconds to hold off a domain after it signals throttling
+SMTP_RETRY_DOMAIN_COOLDOWN = float(os.getenv('SMTP_RETRY_DOMAIN_COOLDOWN', '300'))
+# Seconds between polls for due retries when the worker is idle
+SMTP_RETRY_POLL_INTERVAL = float(os.getenv('SMTP_RETRY_POLL_INTERVAL', '5'))
+# Retries claimed per poll
+SMTP_RETRY_CLAIM_SIZE = int(os.getenv('SMTP_RETRY_CLAIM_SIZE', '200'))
+# A claimed retry whose worker died becomes due again after this many seconds;
+# a live worker renews its claims every third of this while it sends
+SMTP_RETRY_CLAIM_TIMEOUT = float(os.getenv('SMTP_RETRY_CLAIM_TIMEOUT', '300'))
+# Recipients of a claim sent per delivery, so outcomes are written as they come in
+SMTP_RETRY_SEND_CHUNK = int(os.getenv('SMTP_RETRY_SEND_CHUNK', '50'))
+
+# Reply text of a 4xx that asks the client to slow down rather than try later
+THROTTLE_PATTERN = re.compile(r'rate|too many|throttl|slow down|limit exceeded|try again later', re.I)
+
+
+class DomainThrottled(Exception):
+    """Raised for recipients held back because their domain asked us to slow down"""
+
+
+def _reply(error: Exception) -> Tuple[Optional[int], str]:
+    """The SMTP reply code and text behind a send failure"""
+    if isinstance(error, smtplib.SMTPRecipientsRefused) and error.recipients:
+        code, text = next(iter(error.recipients.values()))
+        return code, text.decode('utf-8', 'replace') if isinstance(text, bytes) else str(text)
+    if isinstance(error, smtplib.SMTPResponseException):
+        text = error.smtp_error
+        return error.smtp_code, text.decode('utf-8', 'replace') if isinstance(text, bytes) else str(text)
+    return None, str(error)
+
+
+def is_transient(error: Exception) -> bool:
+    """True for failures worth retrying: 4xx replies, dropped connections and network errors"""
+    if isinstance(error, DomainThrottled):
+        return True
+    code, _ = _reply(error)
+    if code is not None:
+        return 400 <= code < 500
+    if isinstance(error, smtplib.SMTPServerDisconnected):
+        return True
+    # Socket errors; other SMTPExceptions (also OSErrors) are protocol failures
+    return isinstance(error, OSError) and not isinstance(error, smtplib.SMTPException)
+
+
+def is_throttle(error: Exception) -> bool:
+    """True when the server asks for fewer connections or messages rather than rejecting one"""
+    code, text = _reply(error)
+    return code == 421 or (code is not None and 400 <= code < 500 and bool(THROTTLE_PATTERN.search(text)))
+
+
+def backoff(attempts: int, base: float = None, cap: float = None) -> float:
+    """Seconds to wait after the given number of failed attempts, with equal jitter"""
+    base = SMTP_RETRY_BASE_DELAY if base is None else base
+    cap = SMTP_RETRY_MAX_DELAY if cap is None else cap
+    delay = min(cap, base * 2 ** max(0, attempts - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def domain_of(email: str) -> str:
+    return email.rsplit('@', 1)[-1].lower()
+
+
+def _failure(recipient: dict, error: Exception) -> dict:
+    return {'email': recipient['email'], 'error': str(error), 'code': send_ledger.smtp_code(error)}
+
+
+class RetryQueue:
+    """Durable queue of recipients whose send failed transiently.
+
+    ``send_email`` hands over 4xx and connection failures with ``defer``.
+    They are stored in ``send_retries`` and sent again by a background
+    thread with jittered exponential backoff, so a slow or greylisting
+    domain never holds up the rest of a campaign. A domain that signals
+    throttling (421, or a 4xx about rates) is held off for a cooldown:
+    its pending retries are pushed back and new sends to it are deferred
+    without being attempted. Due retries are claimed by pushing their
+    ``next_attempt_at`` forward, so several workers can share the queue
+    and a crashed worker's claims come due again; claims are renewed until
+    their outcome is written. A delivery that raises counts as a failed
+    attempt. Outcomes go to the send ledger under the original run key.
+    """
+
+    def __init__(self, max_attempts: int = SMTP_RETRY_MAX_ATTEMPTS,
+                 domain_cooldown: float = SMTP_RETRY_DOMAIN_COOLDOWN,
+                 poll_interval: float = SMTP_RETRY_POLL_INTERVAL,
+                 claim_size: int = SMTP_RETRY_CLAIM_SIZE,
+                 claim_timeout: float = SMTP_RETRY_CLAIM_TIMEOUT,
+                 send_chunk: int = SMTP_RETRY_SEND_CHUNK):
+        self.max_attempts = max_attempts
+        self.domain_cooldown = domain_cooldown
+        self.poll_interval = poll_interval
+        self.claim_size = claim_size
+        self.claim_timeout = claim_timeout
+        self.send_chunk = send_chunk
+        self._throttled: Dict[str, float] = {}  # domain -> monotonic time the cooldown ends
+        self._lock = threading.Lock()
+        self._claim_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def throttled_until(self, domain: str) -> Optional[float]:
+        """End of a domain's cooldown in seconds from now, or None if it is not throttled"""
+        with self._lock:
+            until = self._throttled.get(domain)
+            if until is None:
+                return None
+            remaining = until - time.monotonic()
+            if remaining <= 0:
+                del self._throttled[domain]
+                return None
+            return remaining
+
+    def hold_throttled(self, recipients: List[dict]) -> Tuple[List[dict], List[Tuple[dict, Exception]]]:
+        """Split off recipients at throttled domains; returns (to_send, held)"""
+        if not self._throttled:
+            return recipients, []
+        to_send, held = [], []
+        for recipient in recipients:
+            domain = domain_of(recipient['email'])
+            if self.throttled_until(domain) is None:
+                to_send.append(recipient)
+            else:
+                held.append((recipient, DomainThrottled(f"Deferred while {domain} is throttled")))
+        return to_send, held
+
+    def _throttle(self, session, domain: str):
+        """Start a cooldown for a domain and push its pending retries past it"""
+        with self._lock:
+            self._throttled[domain] = time.monotonic() + self.domain_cooldown
+        logger.info(f"Throttling sends to {domain} for {self.domain_cooldown:.0f}s")
+        until = datetime.utcnow() + timedelta(seconds=self.domain_cooldown)
+        session.execute(
+            update(SendRetry)
+            .where(SendRetry.domain == domain, SendRetry.next_attempt_at < until)
+            .values(next_attempt_at=until)
+        )
+
+    def _next_attempt(self, domain: str, attempts: int) -> datetime:
+        delay = backoff(attempts)
+        remaining = self.throttled_until(domain)
+        if remaining is not None:
+            delay = max(delay, remaining)
+        return datetime.utcnow() + timedelta(seconds=delay)
+
+    def defer(self, content: str, smtp_config: dict, campaign_name: str, run_key: Optional[str],
+              failed: List[Tuple[dict, Exception]]) -> Tuple[List[Tuple[dict, Exception]], List[dict]]:
+        """Queue the transient failures of a send.
+
+        Returns the permanent failures, still as (recipient, error) pairs,
+        and the deferred ones as ``{'email', 'error', 'code'}`` dicts.
+        """
+        transient = [(r, e) for r, e in failed if is_transient(e)]
+        if not transient:
+            return failed, []
+        permanent = [(r, e) for r, e in failed if not is_transient(e)]
+
+        session = Session()
+        try:
+            batch = RetryBatch(run_key=run_key, campaign_name=campaign_name, content=content,
+                               smtp_config=seal(smtp_config))
+            session.add(batch)
+            session.flush()
+            for domain in {domain_of(r['email']) for r, e in transient if is_throttle(e)}:
+                self._throttle(session, domain)
+            session.execute(SendRetry.__table__.insert(), [
+                {
+                    "batch_id": batch.id,
+                    "email": r['email'],
+                    "recipient": json.dumps(r),
+                    "domain": domain_of(r['email']),
+                    "attempts": 1,
+                    "next_attempt_at": self._next_attempt(domain_of(r['email']), 1),
+                    "last_code": send_ledger.smtp_code(e),
+                    "last_error": str(e),
+                }
+                for r, e in transient
+            ])
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+        self._wakeup.set()
+        return permanent, [_failure(r, e) for r, e in transient]
+
+    def pending_count(self) -> int:
+        """Recipients waiting for a retry"""
+        session = Session()
+        try:
+            return session.query(func.count(SendRetry.id)).scalar()
+        finally:
+            session.close()
+
+    def start(self):
+        """Start the background retry thread"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='smtp-retry', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 10):
+        """Stop the retry thread after its current batch"""
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join(timeout)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                processed = self.process_due()
+            except Exception as e:
+                logger.error(f"Error processing send retries: {str(e)}")
+                processed = 0
+            if not processed:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+
+    def _claim(self) -> List[SendRetry]:
+        """Claim due retries by moving their next attempt past the claim timeout"""
+        now = datetime.utcnow()
+        with self._lock:
+            throttled = [d for d, until in self._throttled.items() if until > time.monotonic()]
+        session = Session()
+        try:
+            query = select(SendRetry.id).where(SendRetry.next_attempt_at <= now)
+            if throttled:
+                query = query.where(SendRetry.domain.not_in(throttled))
+            ids = session.scalars(query.order_by(SendRetry.next_attempt_at).limit(self.claim_size)).all()
+            if not ids:
+                return []
+            # Only rows no other worker claimed in the meantime
+            claimed = session.scalars(
+                update(SendRetry)
+                .where(SendRetry.id.in_(ids), SendRetry.next_attempt_at <= now)
+                .values(next_attempt_at=now + timedelta(seconds=self.claim_timeout))
+                .returning(SendRetry.id)
+            ).all()
+            session.commit()
+            rows = session.scalars(select(SendRetry).where(SendRetry.id.in_(claimed))).all()
+            session.expunge_all()
+            return rows
+        finally:
+            session.close()
+
+    def _renew_claims(self, held: Set[int], done: threading.Event):
+        """Keep pushing the claims in ``held`` forward until ``done`` is set"""
+        while not done.wait(self.claim_timeout / 3):
+            session = Session()
+            try:
+                with self._claim_lock:
+                    if held:
+                        session.execute(
+                            update(SendRetry)
+                            .where(SendRetry.id.in_(held))
+                            .values(next_attempt_at=datetime.utcnow() + timedelta(seconds=self.claim_timeout))
+                        )
+                        session.commit()
+            except Exception as e:
+                logger.error(f"Error renewing send retry claims: {str(e)}")
+            finally:
+                session.close()
+
+    def _release(self, held: Set[int], ids: List[int]):
+        """Stop renewing claims whose outcome is about to be written"""
+        with self._claim_lock:
+            held.difference_update(ids)
+
+    def process_due(self) -> int:
+        """Send one claim of due retries; returns how many recipients were attempted"""
+        rows = self._claim()
+        if not rows:
+            return 0
+        held = {row.id for row in rows}
+        done = threading.Event()
+        threading.Thread(target=self._renew_claims, args=(held, done), name='smtp-retry-renew',
+                         daemon=True).start()
+        try:
+            by_batch = defaultdict(list)
+            for row in rows:
+                by_batch[row.batch_id].append(row)
+            for batch_id, batch_rows in by_batch.items():
+                for i in range(0, len(batch_rows), self.send_chunk):
+                    try:
+                        self._retry_batch(batch_id, batch_rows[i:i + self.send_chunk], held)
+                    except Exception as e:
+                        # The claims lapse and the rows come due again
+                        logger.error(f"Error retrying send batch {batch_id}: {str(e)}")
+        finally:
+            done.set()
+        self._delete_finished_batches()
+        return len(rows)
+
+    def _fail_rows(self, rows: List[SendRetry], error: Exception, run_key: Optional[str], held: Set[int]):
+        """Give up on retries that cannot be sent at all"""
+        logger.error(f"Dropping {len(rows)} send retries: {str(error)}")
+        ids = [row.id for row in rows]
+        self._release(held, ids)
+        session = Session()
+        try:
+            session.execute(delete(SendRetry).where(SendRetry.id.in_(ids)))
+            session.commit()
+        finally:
+            session.close()
+        if run_key:
+            send_ledger.record(run_key, [], [_failure(json.loads(row.recipient), error) for row in rows])
+
+    def _retry_batch(self, batch_id: int, rows: List[SendRetry], held: Set[int]):
+        # email_service imports this module, so import it here
+        from email_service import deliver
+
+        session = Session()
+        try:
+            batch = session.get(RetryBatch, batch_id)
+        finally:
+            session.close()
+        if batch is None:
+            self._fail_rows(rows, Exception(f"Retry batch {batch_id} no longer exists"), None, held)
+            return
+        run_key, content, campaign_name = batch.run_key, batch.content, batch.campaign_name
+        try:
+            smtp_config = unseal(batch.smtp_config)
+        except CredentialsUnavailable as e:
+            self._fail_rows(rows, e, run_key, held)
+            return
+
+        by_email = {row.email: row for row in rows}
+        done: List[int] = []
+        if run_key:
+            # A manual retry of the run may have delivered some of them already
+            already = send_ledger.delivered(run_key, list(by_email))
+            done.extend(by_email.pop(email).id for email in already)
+
+        recipients = [json.loads(row.recipient) for row in by_email.values()]
+        recipients, throttled = self.hold_throttled(recipients)
+        crashed = False
+        try:
+            sent, failed = deliver(content, recipients, smtp_config, campaign_name) if recipients else ([], [])
+        except Exception as e:
+            logger.error(f"Error retrying send batch {batch_id}: {str(e)}")
+            sent, failed, crashed = [], [(r, e) for r in recipients], True
+        failed.extend(throttled)
+
+        self._release(held, [row.id for row in rows])
+        permanent, deferred = [], []
+        session = Session()
+        try:
+            for domain in {domain_of(r['email']) for r, e in failed if is_throttle(e)}:
+                self._throttle(session, domain)
+            for recipient, error in failed:
+                row = by_email[recipient['email']]
+                attempts = row.attempts if isinstance(error, DomainThrottled) else row.attempts + 1
+                if not (crashed or is_transient(error)) or attempts >= self.max_attempts:
+                    permanent.append(_failure(recipient, error))
+                    done.append(row.id)
+                    continue
+                deferred.append(_failure(recipient, error))
+                session.execute(
+                    update(SendRetry).where(SendRetry.id == row.id).values(
+                        attempts=attempts,
+                        next_attempt_at=self._next_attempt(row.domain, attempts),
+                        last_code=send_ledger.smtp_code(error),
+                        last_error=str(error),
+                    )
+                )
+            done.extend(by_email[r['email']].id for r in sent)
+            if done:
+                session.execute(delete(SendRetry).where(SendRetry.id.in_(done)))
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+        if run_key:
+            send_ledger.record(run_key, [r['email'] for r in sent], permanent, deferred)
+        logger.info(f"Retried {len(rows)} recipients: {len(sent)} sent, {len(deferred)} deferred, "
+                    f"{len(permanent)} failed")
+
+    def _delete_finished_batches(self):
+        """Drop batches, and the credentials in them, once no retries are left"""
+        session = Session()
+        try:
+            session.execute(delete(RetryBatch).where(
+                ~select(SendRetry.id).where(SendRetry.batch_id == RetryBatch.id).exists()
+            ))
+            session.commit()
+        finally:
+            session.close()
+
+
+retry_queue = RetryQueue()
+QUEUE_DEPTH.set_function(retry_queue.pending_count, 'send_retries')
@@ -1,23 +1,219 @@
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from apscheduler.events import EVENT_JOB_MISSED
+from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
+from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.cron import CronTrigger
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import func, or_, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
 from datetime import datetime, timedelta
-from models import NewsletterSchedule, engine
+from typing import AsyncIterator, List, Optional
+from models import (GroupRecipient, NewsletterSchedule, RecipientGroup, ScheduleRun, SchedulerLease,
+                    SmtpProfile, engine)
+from database import AsyncSessionLocal, serialized_writes
 from email_service import send_email
+from executors import run_blocking
+import send_ledger
+import asyncio
+import json
 import logging
+import os
+import socket
+import uuid
 
 logger = logging.getLogger(__name__)
-Session = sessionmaker(bind=engine)
+
+# Recipients read from the database and handed to send_email at a time
+SCHEDULE_BATCH_SIZE = int(os.getenv('SCHEDULE_BATCH_SIZE', '100'))
+# Seconds a leader lease is valid; the leader renews it every third of that.
+# A running schedule run's heartbeat follows the same rhythm, and a run whose
+# heartbeat is older than this is resumed by the leader.
+SCHEDULER_LEASE_TTL = float(os.getenv('SCHEDULER_LEASE_TTL', '30'))
+# A fire missed by more than this many seconds (e.g. during downtime) is skipped
+SCHEDULER_MISFIRE_GRACE = int(os.getenv('SCHEDULER_MISFIRE_GRACE', str(6 * 3600)))
+
+LEASE_NAME = 'newsletter_scheduler'
 
 class NewsletterSchedulerService:
-    def __init__(self):
-        self.scheduler = AsyncIOScheduler()
-        self.scheduler.start()
+    """Recurring newsletter sends, shared by every API worker.
+
+    Jobs live in the ``apscheduler_jobs`` table, so they survive restarts
+    and any worker can add or remove them. Only the worker holding the
+    ``scheduler_leases`` row fires jobs; the others keep their scheduler
+    paused and take over once the lease expires. Fires missed while no
+    worker was running are coalesced into one send if they are less than
+    ``SCHEDULER_MISFIRE_GRACE`` seconds late. A run left ``running`` by a
+    worker that died is resumed by the leader after its last sent batch.
+    
+    The job store uses the sync engine, so the scheduler runs on its own
+    thread and async callers go through run_blocking. Blocking on the
+    event loop instead would stall any async write transaction that holds
+    the SQLite lock across an await. Fired jobs run their coroutine back on
+    the application's loop.
+    """
+    
+    def __init__(self, lease_ttl: float = SCHEDULER_LEASE_TTL,
+                 misfire_grace: int = SCHEDULER_MISFIRE_GRACE):
+        self.lease_ttl = lease_ttl
+        self.worker_id = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.is_leader = False
+        self.scheduler = BackgroundScheduler(
+            jobstores={'default': SQLAlchemyJobStore(engine=engine)},
+            job_defaults={'coalesce': True, 'misfire_grace_time': misfire_grace, 'max_instances': 1}
+        )
+        self.scheduler.add_listener(self._on_missed, EVENT_JOB_MISSED)
+        self._lease_task: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+    
+    async def start(self):
+        """Start the scheduler paused and begin competing for the leader lease"""
+        if self._lease_task:
+            return
+        self._loop = asyncio.get_running_loop()
+        await run_blocking(self.scheduler.start, paused=True)
+        await self._renew_lease()
+        self._lease_task = asyncio.create_task(self._lease_loop())
+    
+    async def stop(self):
+        """Stop firing jobs and hand the lease to another worker"""
+        if self._lease_task:
+            self._lease_task.cancel()
+            try:
+                await self._lease_task
+            except asyncio.CancelledError:
+                pass
+            self._lease_task = None
+        if self.scheduler.running:
+            await run_blocking(self.scheduler.shutdown, wait=False)
+        if self.is_leader:
+            self.is_leader = False
+            try:
+                await self._release_lease()
+            except Exception as e:
+                logger.error(f"Error releasing scheduler lease: {str(e)}")
+    
+    async def _lease_loop(self):
+        while True:
+            await asyncio.sleep(self.lease_ttl / 3)
+            try:
+                await self._renew_lease()
+            except Exception as e:
+                logger.error(f"Error renewing scheduler lease: {str(e)}")
+                if self.is_leader:
+                    # Without a confirmed lease another worker may take over
+                    self.is_leader = False
+                    self.scheduler.pause()
+    
+    async def _renew_lease(self):
+        """Take or extend the lease, then resume or pause the scheduler to match"""
+        leader = await self._acquire_lease()
+        if leader and not self.is_leader:
+            logger.info(f"Scheduler worker {self.worker_id} is now the leader")
+            self.is_leader = True
+            await self.rehydrate()
+            self.scheduler.resume()
+            await self._resume_stale_runs()
+        elif not leader and self.is_leader:
+            logger.warning(f"Scheduler worker {self.worker_id} lost the leader lease")
+            self.is_leader = False
+            self.scheduler.pause()
+        elif leader:
+            # Pick up jobs that other workers wrote to the job store
+            self.scheduler.wakeup()
+            await self._resume_stale_runs()
+    
+    def run_is_stale(self, run: ScheduleRun) -> bool:
+        """True for a run still marked running whose heartbeat stopped"""
+        return (run.status == 'running' and run.updated_at is not None
+                and run.updated_at < datetime.utcnow() - timedelta(seconds=self.lease_ttl))
+    
+    async def _resume_stale_runs(self):
+        """Queue a resume of every run whose worker died mid-send"""
+        stale = datetime.utcnow() - timedelta(seconds=self.lease_ttl)
+        async with AsyncSessionLocal() as session:
+            run_ids = (await session.scalars(
+                select(ScheduleRun.id).where(ScheduleRun.status == 'running', ScheduleRun.updated_at < stale)
+            )).all()
+        for run_id in run_ids:
+            logger.warning(f"Resuming schedule run {run_id}; its worker stopped sending")
+            await run_blocking(self.schedule_retry, run_id)
+    
+    async def _acquire_lease(self) -> bool:
+        now = datetime.utcnow()
+        expires_at = now + timedelta(seconds=self.lease_ttl)
+        async with AsyncSessionLocal() as session:
+            async with serialized_writes():
+                # Extend our own lease, or take over one that has expired
+                result = await session.execute(
+                    update(SchedulerLease)
+                    .where(SchedulerLease.name == LEASE_NAME,
+                           or_(SchedulerLease.holder == self.worker_id, SchedulerLease.expires_at < now))
+                    .values(holder=self.worker_id, expires_at=expires_at)
+                )
+                if result.rowcount:
+                    await session.commit()
+                    return True
+                
+                session.add(SchedulerLease(name=LEASE_NAME, holder=self.worker_id, expires_at=expires_at))
+                try:
+                    await session.commit()
+                    return True
+                except IntegrityError:
+                    # Another worker holds an unexpired lease
+                    await session.rollback()
+                    return False
+    
+    async def _release_lease(self):
+        async with AsyncSessionLocal() as session:
+            async with serialized_writes():
+                await session.execute(
+                    update(SchedulerLease)
+                    .where(SchedulerLease.name == LEASE_NAME, SchedulerLease.holder == self.worker_id)
+                    .values(expires_at=datetime.utcnow())
+                )
+                await session.commit()
+    
+    async def rehydrate(self):
+        """Make the job store match the active schedules.
         
-    async def schedule_newsletter(self, name: str, description: str, template_content: str,
-                                recipient_group: str, frequency: str, start_date: datetime):
-        """Schedule a new recurring newsletter"""
-        session = Session()
+        Missing jobs are added and jobs of deleted or inactive schedules
+        are removed. Existing jobs are left alone, so a fire missed during
+        downtime still goes through the misfire policy.
+        """
+        async with AsyncSessionLocal() as session:
+            schedules = (await session.scalars(
+                select(NewsletterSchedule).where(NewsletterSchedule.is_active)
+            )).all()
+        
+        await run_blocking(self._sync_jobs, schedules)
+        logger.info(f"Scheduler rehydrated {len(schedules)} newsletter jobs")
+    
+    def _sync_jobs(self, schedules: List[NewsletterSchedule]):
+        wanted = {self._job_id(s.id): s for s in schedules}
+        existing = {job.id for job in self.scheduler.get_jobs()}
+        for job_id, schedule in wanted.items():
+            if job_id not in existing:
+                self._add_newsletter_job(schedule)
+        for job_id in existing - wanted.keys():
+            if job_id.startswith('newsletter_'):
+                self.scheduler.remove_job(job_id)
+    
+    def run_on_loop(self, coro):
+        """Run a coroutine on the application's loop from a scheduler thread"""
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+    
+    def _on_missed(self, event):
+        logger.warning(f"Skipped scheduled run of {event.job_id} due at {event.scheduled_run_time}: "
+                       f"more than {SCHEDULER_MISFIRE_GRACE}s late")
+    
+    @staticmethod
+    def _job_id(schedule_id: int) -> str:
+        return f"newsletter_{schedule_id}"
+    
+
+    async def schedule_newsletter(self, session: AsyncSession, name: str, description: str, template_content: str,
+                                recipient_group: str, frequency: str, start_date: datetime,
+                                smtp_profile_id: Optional[int] = None):
+        """Schedule a new recurring newsletter using the caller's session"""
         try:
             # Create new schedule
             schedule = NewsletterSchedule(
@@ -26,25 +222,25 @@ class NewsletterSchedulerService:
                 template_content=template_content,
                 recipient_group=recipient_group,
                 frequency=frequency,
-                next_send_date=start_date
+                next_send_date=start_date,
+                smtp_profile_id=smtp_profile_id
             )
             session.add(schedule)
-            session.commit()
+            async with serialized_writes():
+                await session.commit()
             
             # Add job to scheduler
-            self._add_newsletter_job(schedule)
+            await run_blocking(self._add_newsletter_job, schedule)
             
             return {"status": "success", "message": f"Newsletter '{name}' scheduled successfully"}
         except Exception as e:
             logger.error(f"Error scheduling newsletter: {str(e)}")
-            session.rollback()
+            await session.rollback()
             raise
-        finally:
-            session.close()
     
     def _add_newsletter_job(self, schedule: NewsletterSchedule):
         """Add a newsletter job to the scheduler"""
-        job_id = f"newsletter_{schedule.id}"
+        job_id = self._job_id(schedule.id)
         
         # Convert frequency to cron expression
         if schedule.frequency == "monthly":
@@ -59,52 +255,233 @@ class NewsletterSchedulerService:
             raise ValueError(f"Unsupported frequency: {schedule.frequency}")
         
         self.scheduler.add_job(
-            self._send_newsletter,
+            # Stored jobs reference a module-level function, not this instance
+            send_scheduled_newsletter,
             trigger=trigger,
             args=[schedule.id],
             id=job_id,
             replace_existing=True
         )
     
+    def remove_newsletter_job(self, schedule_id: int):
+        """Remove a schedule's job if it exists"""
+        job_id = self._job_id(schedule_id)
+        if self.scheduler.get_job(job_id):
+            self.scheduler.remove_job(job_id)
+    
     async def _send_newsletter(self, schedule_id: int):
-        """Send a scheduled newsletter"""
-        session = Session()
+        """Send a scheduled newsletter and advance the schedule"""
         try:
-            schedule = session.query(NewsletterSchedule).get(schedule_id)
-            if not schedule or not schedule.is_active:
-                return
-            
-            # Send the newsletter
-            result = send_email(
-                content=schedule.template_content,
-                recipients=self._get_recipients(schedule.recipient_group),
-                smtp_config=self._get_smtp_config(),
-                campaign_name=schedule.name
+            async with AsyncSessionLocal() as session:
+                schedule = await session.get(NewsletterSchedule, schedule_id)
+                if not schedule or not schedule.is_active:
+                    return
+                
+                run = ScheduleRun(schedule_id=schedule.id)
+                session.add(run)
+                async with serialized_writes():
+                    await session.commit()
+                
+                result = await self._dispatch(session, schedule, run)
+                
+                # Update schedule
+                schedule.last_sent_date = datetime.utcnow()
+                if schedule.frequency == "monthly":
+                    schedule.next_send_date = schedule.next_send_date + timedelta(days=30)
+                elif schedule.frequency == "weekly":
+                    schedule.next_send_date = schedule.next_send_date + timedelta(days=7)
+                
+                async with serialized_writes():
+                    await session.commit()
+                return result
+        except Exception as e:
+            logger.error(f"Error sending newsletter: {str(e)}")
+            raise
+    
+    def schedule_retry(self, run_id: int):
+        """Queue a retry of a finished or stale run; the leader picks it up right away"""
+        self.scheduler.add_job(
+            retry_schedule_run,
+            args=[run_id],
+            id=f"schedule_run_retry_{run_id}",
+            replace_existing=True
+        )
+    
+    async def _retry_run(self, run_id: int):
+        """Send a finished run again, or resume a stale one after its last sent batch.
+        
+        Addresses the run already delivered to are skipped either way.
+        """
+        try:
+            async with AsyncSessionLocal() as session:
+                run = await session.get(ScheduleRun, run_id)
+                if not run:
+                    return
+                schedule = await session.get(NewsletterSchedule, run.schedule_id)
+                if not schedule:
+                    return
+                
+                resume = run.status == 'running'
+                now = datetime.utcnow()
+                values = {'status': 'running', 'error': None, 'finished_at': None, 'updated_at': now}
+                if not resume:
+                    values.update(batches_done=0, last_recipient_id=None)
+                # Claim the run, unless another worker is still sending it
+                async with serialized_writes():
+                    result = await session.execute(
+                        update(ScheduleRun)
+                        .where(ScheduleRun.id == run_id,
+                               or_(ScheduleRun.status != 'running',
+                                   ScheduleRun.updated_at < now - timedelta(seconds=self.lease_ttl)))
+                        .values(**values)
+                    )
+                    await session.commit()
+                if not result.rowcount:
+                    return
+                await session.refresh(run)
+                return await self._dispatch(session, schedule, run, after_id=run.last_recipient_id or 0)
+        except Exception as e:
+            logger.error(f"Error retrying newsletter run {run_id}: {str(e)}")
+            raise
+    
+    async def _keep_run_alive(self, run_id: int):
+        """Refresh a run's heartbeat while its batches are sending"""
+        while True:
+            await asyncio.sleep(self.lease_ttl / 3)
+            try:
+                async with AsyncSessionLocal() as session:
+                    async with serialized_writes():
+                        await session.execute(
+                            update(ScheduleRun)
+                            .where(ScheduleRun.id == run_id, ScheduleRun.status == 'running')
+                            .values(updated_at=datetime.utcnow())
+                        )
+                        await session.commit()
+            except Exception as e:
+                logger.error(f"Error refreshing heartbeat of schedule run {run_id}: {str(e)}")
+    
+    async def _dispatch(self, session: AsyncSession, schedule: NewsletterSchedule, run: ScheduleRun,
+                        after_id: int = 0):
+        """Send a newsletter to its recipient group, one batch at a time.
+        
+        Recipients are paged out of the database ``SCHEDULE_BATCH_SIZE`` at a
+        time, so the group is never loaded whole. Every outcome goes to the
+        send ledger under the run's key, and the run's counts are refreshed
+        from the ledger after each batch. ``after_id`` resumes a run after
+        the last recipient of its last finished batch.
+        """
+        run_key = schedule_run_key(run.id)
+        heartbeat = asyncio.create_task(self._keep_run_alive(run.id))
+        try:
+            group = await session.scalar(
+                select(RecipientGroup).where(RecipientGroup.name == schedule.recipient_group)
             )
+            if not group:
+                raise ValueError(f"Recipient group '{schedule.recipient_group}' not found")
+            smtp_config = await self._get_smtp_config(session, schedule.smtp_profile_id)
             
-            # Update schedule
-            schedule.last_sent_date = datetime.utcnow()
-            if schedule.frequency == "monthly":
-                schedule.next_send_date = schedule.next_send_date + timedelta(days=30)
-            elif schedule.frequency == "weekly":
-                schedule.next_send_date = schedule.next_send_date + timedelta(days=7)
-            
-            session.commit()
+            run.total = await session.scalar(
+                select(func.count()).select_from(GroupRecipient).where(GroupRecipient.group_id == group.id)
+            )
+            # Commit before sending; an open write would lock out the ledger writes
+            async with serialized_writes():
+                await session.commit()
             
-            logger.info(f"Newsletter '{schedule.name}' sent successfully")
-            return result
+            async for batch, last_id in self._get_recipients(session, group.id, after_id=after_id):
+                # Send the newsletter
+                await run_blocking(
+                    send_email,
+                    pool='smtp',
+                    content=schedule.template_content,
+                    recipients=batch,
+                    smtp_config=smtp_config,
+                    campaign_name=schedule.name,
+                    run_key=run_key
+                )
+                
+                counts = await run_blocking(send_ledger.stats, run_key)
+                run.batches_done += 1
+                run.sent_count = counts['sent']
+                run.failed_count = counts['failed']
+                run.last_recipient_id = last_id
+                async with serialized_writes():
+                    await session.commit()
+            run.status = 'completed'
         except Exception as e:
-            logger.error(f"Error sending newsletter: {str(e)}")
+            run.status = 'failed'
+            run.error = str(e)
             raise
         finally:
-            session.close()
+            heartbeat.cancel()
+            run.finished_at = datetime.utcnow()
+            async with serialized_writes():
+                await session.commit()
+        
+        logger.info(f"Newsletter '{schedule.name}' delivered to {run.sent_count}/{run.total} recipients "
+                    f"in {run.batches_done} batches")
+        return {
+            'success': True,
+            'run_id': run.id,
+            'successful_sends': run.sent_count,
+            'failed_sends': run.failed_count
+        }
     
-    def _get_recipients(self, group_name: str) -> list:
-        """Get recipients for a group"""
-        # TODO: Implement recipient group lookup
-        return []
+    async def _get_recipients(self, session: AsyncSession, group_id: int,
+                              batch_size: int = None, after_id: int = 0) -> AsyncIterator[tuple]:
+        """Yield (recipients, last id) pages of a group, keyset-paged by id from ``after_id``"""
+        batch_size = batch_size or SCHEDULE_BATCH_SIZE
+        last_id = after_id
+        while True:
+            rows = (await session.scalars(
+                select(GroupRecipient)
+                .where(GroupRecipient.group_id == group_id, GroupRecipient.id > last_id)
+                .order_by(GroupRecipient.id)
+                .limit(batch_size)
+            )).all()
+            if not rows:
+                return
+            last_id = rows[-1].id
+            yield [recipient_dict(r) for r in rows], last_id
+            if len(rows) < batch_size:
+                return
     
-    def _get_smtp_config(self) -> dict:
-        """Get SMTP configuration"""
-        # TODO: Implement SMTP config lookup
-        return {} 
\ No newline at end of file
+    async def _get_smtp_config(self, session: AsyncSession, profile_id: Optional[int] = None) -> dict:
+        """SMTP settings of the schedule's profile, else the default one (the oldest if none is marked)"""
+        if profile_id is not None:
+            profile = await session.get(SmtpProfile, profile_id)
+        else:
+            profile = await session.scalar(
+                select(SmtpProfile).order_by(SmtpProfile.is_default.desc(), SmtpProfile.id).limit(1)
+            )
+        if not profile:
+            raise ValueError("No SMTP profile configured")
+        return profile.to_config()
+
+
+def schedule_run_key(run_id: int) -> str:
+    """Send ledger key of a schedule run"""
+    return f"schedule_run:{run_id}"
+
+
+def recipient_dict(recipient: GroupRecipient) -> dict:
+    """The recipient dict send_email expects, with extra fields for [[FIELD]] placeholders"""
+    fields = json.loads(recipient.fields) if recipient.fields else {}
+    return {
+        **fields,
+        'name': recipient.name,
+        'email': recipient.email,
+        'organization': recipient.organization
+    }
+
+
+scheduler_service = NewsletterSchedulerService()
+
+
+def send_scheduled_newsletter(schedule_id: int):
+    """Job entry point; fired only by the worker holding the leader lease"""
+    return scheduler_service.run_on_loop(scheduler_service._send_newsletter(schedule_id))
+
+
+def retry_schedule_run(run_id: int):
+    """Job entry point for run retries"""
+    return scheduler_service.run_on_loop(scheduler_service._retry_run(run_id))
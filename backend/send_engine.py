@@ -0,0 +1,115 @@
+import threading
+import time
+import os
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, Dict, Iterable, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Number of parallel SMTP sessions used for a single campaign
+SMTP_MAX_CONNECTIONS = int(os.getenv('SMTP_MAX_CONNECTIONS', '4'))
+# Process-wide cap on concurrent sessions against one SMTP server
+SMTP_MAX_CONNECTIONS_PER_SERVER = int(os.getenv('SMTP_MAX_CONNECTIONS_PER_SERVER', '8'))
+# Messages per second per SMTP server, 0 disables the limiter
+SMTP_RATE_LIMIT = float(os.getenv('SMTP_RATE_LIMIT', '0'))
+
+
+class RateLimiter:
+    """Thread-safe token bucket limiting calls to ``rate`` per second"""
+
+    def __init__(self, rate: float, burst: int = None):
+        self.rate = rate
+        self.capacity = burst or max(1, int(rate))
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a token is available"""
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class SendEngine:
+    """Fans a campaign out over several SMTP sessions.
+
+    Concurrency is bounded twice: by ``max_connections`` for a single
+    campaign and by a process-wide semaphore per SMTP server, so concurrent
+    campaigns against the same server share its cap. Each server also gets
+    its own messages-per-second limiter.
+    """
+
+    def __init__(self, max_connections: int = SMTP_MAX_CONNECTIONS,
+                 per_server_limit: int = SMTP_MAX_CONNECTIONS_PER_SERVER,
+                 rate_limit: float = SMTP_RATE_LIMIT):
+        self.max_connections = max(1, max_connections)
+        self.per_server_limit = max(1, per_server_limit)
+        self.rate_limit = rate_limit
+        self._server_slots: Dict[str, threading.BoundedSemaphore] = {}
+        self._limiters: Dict[str, RateLimiter] = {}
+        self._lock = threading.Lock()
+
+    def _slot(self, server: str) -> threading.BoundedSemaphore:
+        with self._lock:
+            if server not in self._server_slots:
+                self._server_slots[server] = threading.BoundedSemaphore(self.per_server_limit)
+            return self._server_slots[server]
+
+    def _limiter(self, server: str) -> RateLimiter:
+        with self._lock:
+            if server not in self._limiters:
+                self._limiters[server] = RateLimiter(self.rate_limit)
+            return self._limiters[server]
+
+    def run(self, server: str, items: Iterable, send_one: Callable,
+            max_connections: int = None) -> Tuple[List, List[Tuple[object, Exception]]]:
+        """Call ``send_one(item)`` for every item and collect the outcomes.
+
+        Returns the items that were sent and a list of (item, exception)
+        pairs for the ones that failed.
+        """
+        items = list(items)
+        workers = min(max_connections or self.max_connections, self.per_server_limit, len(items)) or 1
+        slot = self._slot(server)
+        limiter = self._limiter(server)
+
+        def task(item):
+            with slot:
+                limiter.acquire()
+                send_one(item)
+
+        sent, failed = [], []
+        if workers == 1:
+            for item in items:
+                try:
+                    task(item)
+                    sent.append(item)
+                except Exception as e:
+                    failed.append((item, e))
+            return sent, failed
+
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='smtp-send') as executor:
+            futures = {executor.submit(task, item): item for item in items}
+            for future in as_completed(futures):
+                item = futures[future]
+                try:
+                    future.result()
+                    sent.append(item)
+                except Exception as e:
+                    failed.append((item, e))
+        return sent, failed
+
+
+# Shared engine so per-server caps apply across concurrent campaigns
+send_engine = SendEngine()
@@ -0,0 +1,110 @@
+import smtplib
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Set
+
+from sqlalchemy import func, select
+from sqlalchemy.orm import sessionmaker
+
+from models import SendLedger, conflict_insert, engine
+
+Session = sessionmaker(bind=engine)
+
+# Addresses per IN (...) lookup, well under SQLite's bound-parameter limit
+LOOKUP_CHUNK = 500
+
+
+def smtp_code(error: Exception) -> Optional[int]:
+    """The SMTP reply code behind a send failure, if the server gave one"""
+    if isinstance(error, smtplib.SMTPResponseException):
+        return error.smtp_code
+    if isinstance(error, smtplib.SMTPRecipientsRefused) and error.recipients:
+        code, _ = next(iter(error.recipients.values()))
+        return code
+    return None
+
+
+def delivered(run_key: str, emails: Iterable[str]) -> Set[str]:
+    """The addresses among ``emails`` that this run has already delivered to"""
+    emails = list(emails)
+    found = set()
+    session = Session()
+    try:
+        for i in range(0, len(emails), LOOKUP_CHUNK):
+            found.update(session.scalars(
+                select(SendLedger.email).where(
+                    SendLedger.run_key == run_key,
+                    SendLedger.email.in_(emails[i:i + LOOKUP_CHUNK]),
+                    SendLedger.status == 'sent'
+                )
+            ))
+        return found
+    finally:
+        session.close()
+
+
+def record(run_key: str, sent: Iterable[str], failed: Iterable[dict], deferred: Iterable[dict] = ()):
+    """Write the outcome of a batch in one statement.
+
+    ``failed`` and ``deferred`` hold ``{'email', 'error', 'code'}`` dicts as
+    returned in send_email's ``failed_sends`` and ``deferred_sends``. A
+    failure never overwrites an earlier delivery to the same address.
+    """
+    now = datetime.utcnow()
+    rows: List[dict] = [
+        {"run_key": run_key, "email": email, "status": "sent", "smtp_code": 250, "error": None, "updated_at": now}
+        for email in sent
+    ]
+    rows.extend(
+        {"run_key": run_key, "email": f['email'], "status": "failed", "smtp_code": f.get('code'),
+         "error": f.get('error'), "updated_at": now}
+        for f in failed
+    )
+    rows.extend(
+        {"run_key": run_key, "email": d['email'], "status": "deferred", "smtp_code": d.get('code'),
+         "error": d.get('error'), "updated_at": now}
+        for d in deferred
+    )
+    if not rows:
+        return
+
+    session = Session()
+    try:
+        stmt = conflict_insert(SendLedger, session.get_bind().dialect.name)
+        if stmt is not None:
+            session.execute(stmt.on_conflict_do_update(
+                index_elements=['run_key', 'email'],
+                set_={
+                    "status": stmt.excluded.status,
+                    "smtp_code": stmt.excluded.smtp_code,
+                    "error": stmt.excluded.error,
+                    "updated_at": stmt.excluded.updated_at
+                },
+                where=SendLedger.status != 'sent'
+            ), rows)
+        else:
+            # No ON CONFLICT: merge row by row, still never overwriting a delivery
+            done = delivered(run_key, [row['email'] for row in rows])
+            for row in rows:
+                if row['email'] not in done:
+                    session.merge(SendLedger(**row))
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+def stats(run_key: str) -> Dict[str, int]:
+    """Delivered, failed and deferred address counts of a run"""
+    session = Session()
+    try:
+        counts = dict(session.execute(
+            select(SendLedger.status, func.count())
+            .where(SendLedger.run_key == run_key)
+            .group_by(SendLedger.status)
+        ).all())
+        return {"sent": counts.get('sent', 0), "failed": counts.get('failed', 0),
+                "deferred": counts.get('deferred', 0)}
+    finally:
+        session.close()
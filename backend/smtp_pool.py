@@ -0,0 +1,178 @@
+import hashlib
+import smtplib
+import threading
+import time
+import logging
+import os
+from contextlib import contextmanager
+from typing import Dict, List, Tuple
+
+from metrics import SMTP_PHASE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Pool tuning, overridable from the environment
+SMTP_POOL_MAX_MESSAGES = int(os.getenv('SMTP_POOL_MAX_MESSAGES', '100'))
+SMTP_POOL_IDLE_TIMEOUT = float(os.getenv('SMTP_POOL_IDLE_TIMEOUT', '60'))
+SMTP_POOL_MAX_IDLE = int(os.getenv('SMTP_POOL_MAX_IDLE', '8'))
+SMTP_TIMEOUT = float(os.getenv('SMTP_TIMEOUT', '30'))
+
+PoolKey = Tuple[str, str, str, str]
+
+
+def pool_key(smtp_config: dict) -> PoolKey:
+    """Build the pool key for an SMTP configuration.
+
+    A digest of the password is part of the key, so a session logged in
+    with one password is never handed to a caller that supplied another.
+    """
+    password = hashlib.sha256(smtp_config.get('password', '').encode()).hexdigest()
+    return (smtp_config['server'], str(smtp_config['port']), smtp_config['email'], password)
+
+
+class PooledConnection:
+    """An authenticated SMTP session plus the bookkeeping the pool needs"""
+
+    def __init__(self, key: PoolKey, server: smtplib.SMTP):
+        self.key = key
+        self.server = server
+        self.messages_sent = 0
+        self.last_used = time.monotonic()
+
+    def sendmail(self, from_addr: str, to_addrs, msg: str):
+        with SMTP_PHASE_SECONDS.labels('send').time():
+            result = self.server.sendmail(from_addr, to_addrs, msg)
+        self.messages_sent += 1
+        self.last_used = time.monotonic()
+        return result
+
+    def close(self):
+        try:
+            self.server.quit()
+        except Exception:
+            try:
+                self.server.close()
+            except Exception:
+                pass
+
+
+class SMTPConnectionPool:
+    """Reusable authenticated SMTP sessions keyed by (server, port, user).
+
+    A session is recycled after ``max_messages`` messages or once it has sat
+    idle for longer than ``idle_timeout`` seconds. Sends that hit a dropped
+    connection are retried once on a fresh session.
+    """
+
+    def __init__(self, max_messages: int = SMTP_POOL_MAX_MESSAGES,
+                 idle_timeout: float = SMTP_POOL_IDLE_TIMEOUT,
+                 max_idle_per_key: int = SMTP_POOL_MAX_IDLE,
+                 timeout: float = SMTP_TIMEOUT):
+        self.max_messages = max_messages
+        self.idle_timeout = idle_timeout
+        self.max_idle_per_key = max_idle_per_key
+        self.timeout = timeout
+        self._idle: Dict[PoolKey, List[PooledConnection]] = {}
+        self._lock = threading.Lock()
+
+    def _connect(self, smtp_config: dict) -> PooledConnection:
+        """Open and authenticate a new SMTP session"""
+        # Connect includes the TLS handshake
+        with SMTP_PHASE_SECONDS.labels('connect').time():
+            if str(smtp_config['port']) == "465":
+                server = smtplib.SMTP_SSL(smtp_config['server'], int(smtp_config['port']), timeout=self.timeout)
+            else:
+                server = smtplib.SMTP(smtp_config['server'], int(smtp_config['port']), timeout=self.timeout)
+                server.starttls()
+
+        with SMTP_PHASE_SECONDS.labels('login').time():
+            server.login(smtp_config['email'], smtp_config['password'])
+        return PooledConnection(pool_key(smtp_config), server)
+
+    def _is_expired(self, conn: PooledConnection) -> bool:
+        if conn.messages_sent >= self.max_messages:
+            return True
+        return time.monotonic() - conn.last_used > self.idle_timeout
+
+    def acquire(self, smtp_config: dict) -> PooledConnection:
+        """Check out a live session for the given config, opening one if needed"""
+        key = pool_key(smtp_config)
+        expired = []
+        conn = None
+        with self._lock:
+            idle = self._idle.get(key, [])
+            while idle:
+                candidate = idle.pop()
+                if self._is_expired(candidate):
+                    expired.append(candidate)
+                else:
+                    conn = candidate
+                    break
+
+        for stale in expired:
+            stale.close()
+
+        return conn or self._connect(smtp_config)
+
+    def release(self, conn: PooledConnection):
+        """Return a session to the pool, or close it if it is due for recycling"""
+        if self._is_expired(conn):
+            conn.close()
+            return
+
+        with self._lock:
+            idle = self._idle.setdefault(conn.key, [])
+            if len(idle) < self.max_idle_per_key:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def discard(self, conn: PooledConnection):
+        """Drop a broken session without returning it to the pool"""
+        conn.close()
+
+    @contextmanager
+    def connection(self, smtp_config: dict):
+        """Context manager that checks a session out and returns it afterwards"""
+        conn = self.acquire(smtp_config)
+        try:
+            yield conn
+        except (smtplib.SMTPServerDisconnected, OSError):
+            self.discard(conn)
+            raise
+        else:
+            self.release(conn)
+
+    def send(self, smtp_config: dict, to_addrs, msg: str):
+        """Send one message over a pooled session, reconnecting once if it was dropped"""
+        for attempt in range(2):
+            conn = self.acquire(smtp_config)
+            try:
+                result = conn.sendmail(smtp_config['email'], to_addrs, msg)
+            except smtplib.SMTPServerDisconnected:
+                self.discard(conn)
+                if attempt:
+                    raise
+                logger.info(f"SMTP session to {smtp_config['server']} dropped, reconnecting")
+                continue
+            except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError):
+                # Per-message rejections leave the session usable
+                self.release(conn)
+                raise
+            except Exception:
+                self.discard(conn)
+                raise
+            self.release(conn)
+            return result
+
+    def close_all(self):
+        """Close every idle session"""
+        with self._lock:
+            idle = [conn for conns in self._idle.values() for conn in conns]
+            self._idle.clear()
+        for conn in idle:
+            conn.close()
+
+
+# Shared pool used by the email service
+smtp_pool = SMTPConnectionPool()
@@ -0,0 +1,93 @@
+import re
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple, Union
+
+# [[FIELD]] or [[FIELD|default value]]
+PLACEHOLDER_PATTERN = re.compile(r'\[\[([A-Z][A-Z0-9_]*)(?:\|([^\]]*))?\]\]')
+
+# Recipient keys that do not get a bare [[KEY]] alias; [[NAME]] is the sender
+RESERVED_FIELDS = {'name', 'email'}
+
+
+class Slot:
+    """A placeholder in a compiled template"""
+    __slots__ = ('field', 'default', 'raw')
+
+    def __init__(self, field: str, default: Optional[str], raw: str):
+        self.field = field
+        self.default = default
+        self.raw = raw
+
+
+class CompiledTemplate:
+    """A template split once into literal chunks and placeholder slots.
+
+    Rendering walks the segment list and joins the pieces, so the cost per
+    recipient is proportional to the output size rather than to the number
+    of placeholders times the template size.
+    """
+
+    def __init__(self, source: str):
+        self.source = source
+        self.segments: List[Union[str, Slot]] = []
+        position = 0
+        for match in PLACEHOLDER_PATTERN.finditer(source):
+            if match.start() > position:
+                self.segments.append(source[position:match.start()])
+            self.segments.append(Slot(match.group(1), match.group(2), match.group(0)))
+            position = match.end()
+        if position < len(source):
+            self.segments.append(source[position:])
+
+    @property
+    def fields(self) -> Tuple[str, ...]:
+        """Names of the placeholders used by the template"""
+        return tuple(dict.fromkeys(seg.field for seg in self.segments if isinstance(seg, Slot)))
+
+    @property
+    def is_static(self) -> bool:
+        """True when the template has no placeholders at all"""
+        return not any(isinstance(seg, Slot) for seg in self.segments)
+
+    def render(self, values: Dict[str, str]) -> str:
+        """Fill the slots from ``values``.
+
+        A missing field falls back to the slot's default. If there is no
+        default, the placeholder is left as written.
+        """
+        parts = []
+        for seg in self.segments:
+            if seg.__class__ is str:
+                parts.append(seg)
+                continue
+            value = values.get(seg.field)
+            if value is None:
+                value = seg.default if seg.default is not None else seg.raw
+            parts.append(str(value))
+        return ''.join(parts)
+
+
+@lru_cache(maxsize=32)
+def compile_template(source: str) -> CompiledTemplate:
+    """Compile a template, reusing the result for identical sources"""
+    return CompiledTemplate(source)
+
+
+def recipient_fields(recipient: dict, smtp_config: dict) -> Dict[str, str]:
+    """Build the placeholder values for one recipient.
+
+    ``[[NAME]]`` is the sender name. Every recipient field ``foo`` is
+    available as ``[[RECIPIENT_FOO]]`` and, unless reserved, as ``[[FOO]]``.
+    ``[[ORGANIZATION]]`` is only filled when the recipient has one.
+    """
+    values = {}
+    for key, value in recipient.items():
+        if value is None:
+            continue
+        values[f'RECIPIENT_{key.upper()}'] = value
+        if key not in RESERVED_FIELDS:
+            values[key.upper()] = value
+    if not recipient.get('organization'):
+        values.pop('ORGANIZATION', None)
+    values['NAME'] = smtp_config['name']
+    return values
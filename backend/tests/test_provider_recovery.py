@@ -0,0 +1,57 @@
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ai_service import AIService  # noqa: E402
+
+
+class ProviderRecoveryTest(unittest.TestCase):
+    """A provider whose key check fails is retried by its circuit breaker, not dropped"""
+
+    def setUp(self):
+        self.service = AIService(anthropic_api_key="", openai_api_key="", xai_api_key="test-key")
+        self.service.temperature = 0
+        self.breaker = self.service.router.breakers["xai"]
+        self.breaker.reset_timeout = 0
+        self.xai = self.service.router.adapters[0]
+
+    def test_failed_validation_recovers(self):
+        with mock.patch.object(self.service, "_validate_provider", side_effect=Exception("timeout")):
+            self.service.validate_providers()
+        self.assertIs(self.service.providers["xai"]["ready"], False)
+        self.assertEqual(self.breaker.state, "open")
+        # Still the preferred provider, so requests are not simulated
+        self.assertEqual(self.service.preferred_provider, "xai")
+
+        reply = {"message": "hello", "usage": {}}
+        with mock.patch.object(self.xai, "complete", return_value=reply) as complete:
+            response = self.service.generate_response("Hi")
+        complete.assert_called_once()
+        self.assertTrue(response["success"])
+        self.assertEqual(response["provider"], "xai")
+        self.assertEqual(self.breaker.state, "closed")
+
+    def test_failed_trial_keeps_circuit_open(self):
+        self.service._mark_provider("xai", False, "timeout")
+        self.breaker.reset_timeout = 60
+        with mock.patch.object(self.xai, "complete") as complete:
+            response = self.service.generate_response("Hi")
+        complete.assert_not_called()
+        self.assertFalse(response["success"])
+
+        self.breaker.reset_timeout = 0
+        with mock.patch.object(self.xai, "complete", side_effect=Exception("down")):
+            self.service.generate_response("Hi")
+        self.assertEqual(self.breaker.state, "open")
+
+        with mock.patch.object(self.service, "_validate_provider"):
+            self.service.validate_providers()
+        self.assertIs(self.service.providers["xai"]["ready"], True)
+        self.assertEqual(self.breaker.state, "closed")
+
+
+if __name__ == "__main__":
+    unittest.main()